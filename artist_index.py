@@ -0,0 +1,130 @@
+"""
+The purpose of this script is to remember which Spotify artist each artist name resolved to, so the artist search
+only has to run for names never looked up before.
+
+"""
+
+import json
+import os
+import re
+import threading
+import unicodedata
+
+
+DEFAULT_INDEX_PATH = 'cache/artist_aliases.json'
+
+# Holds the index shared by every lookup which isn't handed one explicitly
+_shared_index = None
+
+
+def normalize_artist_name(name: str) -> str:
+    """
+    Folds an artist name into the form it is indexed under, so spellings differing only in accents, case,
+    punctuation or '&' vs 'and' share one entry (e.g. 'bela fleck' and 'Béla Fleck')
+
+    :param name: artist/band name as typed or as returned by the API
+    :return: normalized name string
+    """
+
+    # split accented letters into the letter and its accent, then drop the accents
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    name = name.casefold().replace('&', ' and ')
+    # any run of punctuation or whitespace becomes a single space
+    name = re.sub(r'[\W_]+', ' ', name)
+
+    return name.strip()
+
+
+class ArtistAliasIndex:
+    """
+    Persisted mapping of normalized artist names to Spotify artist IDs
+    """
+
+    def __init__(self, path: str = DEFAULT_INDEX_PATH):
+        self.path = path
+        self.aliases = {}
+        self.changed = False
+        self.lock = threading.Lock()
+
+        if path is not None and os.path.isfile(path):
+            with open(path) as index_file:
+                self.aliases = json.load(index_file)
+
+    def get(self, name: str) -> str:
+        """
+        :param name: artist/band name
+        :return: the artist ID the name resolved to before, or None
+        """
+
+        with self.lock:
+            return self.aliases.get(normalize_artist_name(name))
+
+    def add(self, name: str, artist_id: str):
+        """
+        Records the artist ID a name resolved to
+
+        :param name: artist/band name, as searched for or as returned by the API
+        :param artist_id: Spotify artist ID
+        """
+
+        key = normalize_artist_name(name)
+        with self.lock:
+            if self.aliases.get(key) != artist_id:
+                self.aliases[key] = artist_id
+                self.changed = True
+
+    def save(self):
+        """
+        Writes the index to disk if anything was added since it was loaded
+        """
+
+        if self.path is None:
+            return
+
+        with self.lock:
+            if not self.changed:
+                return
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # written to a temporary file first, so a crash never leaves half an index behind
+            temp_path = self.path + '.partial'
+            with open(temp_path, 'w') as index_file:
+                json.dump(self.aliases, index_file, indent=1, sort_keys=True)
+            os.replace(temp_path, self.path)
+            self.changed = False
+
+
+def pick_search_result(artist_name: str, items: list) -> dict:
+    """
+    Picks the search result whose name matches the searched name, falling back on the top result
+
+    :param artist_name: artist/band name searched for
+    :param items: artist records returned by the search
+    :return: the chosen artist record, or None if the search found nothing
+    """
+
+    if len(items) == 0:
+        return None
+
+    key = normalize_artist_name(artist_name)
+    for item in items:
+        if isinstance(item.get('name'), str) and normalize_artist_name(item['name']) == key:
+            return item
+
+    return items[0]
+
+
+def get_artist_index() -> ArtistAliasIndex:
+    """
+    Returns the index shared across the ingest run, loading it on first use
+
+    :return: ArtistAliasIndex object
+    """
+
+    global _shared_index
+    if _shared_index is None:
+        _shared_index = ArtistAliasIndex()
+
+    return _shared_index
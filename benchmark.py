@@ -0,0 +1,257 @@
+"""
+The purpose of this script is to time transform, load and every view over synthetic catalogs of several sizes,
+and to compare the results against a stored baseline, so a change which slows the pipeline down shows up.
+
+"""
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import re
+import resource
+import sqlite3
+import sys
+import time
+
+
+DEFAULT_SIZES = [10000, 100000]
+BENCHMARK_DIR = 'benchmarks'
+DEFAULT_RESULTS_PATH = 'benchmarks/results.json'
+DEFAULT_BASELINE_PATH = 'benchmarks/baseline.json'
+VIEW_PATTERN = 'database/create_view_*.sql'
+
+# Rule file generate_catalog writes next to the synthetic feathers, naming the synthetic artists
+SYNTHETIC_RULES_PATH = 'raw_data/transform_rules.yaml'
+
+# Every stage is run this many times and its fastest run kept, which filters out most of the noise of small sizes
+DEFAULT_REPEAT = 3
+
+# A stage counts as regressed once its throughput drops more than this share below the baseline
+DEFAULT_TOLERANCE = 0.10
+
+
+def peak_rss_mb() -> float:
+    """
+    :return: peak resident set size of this process so far, in MB
+    """
+
+    # On Linux getrusage's peak is carried over from the parent the stage's process was spawned by, so the peak of
+    # the process's own memory is read from /proc instead
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def run_view(view_path: str) -> int:
+    """
+    Creates one view in the database of the working directory and reads every row of it
+
+    :param view_path: path to a create_view_*.sql file
+    :return: number of rows the view returned
+    """
+
+    with open(view_path) as view_file:
+        sql = view_file.read()
+    view_name = re.search(r'CREATE\s+VIEW\s+(\w+)', sql, re.IGNORECASE).group(1)
+
+    conn = sqlite3.connect('database/music_data.sqlite')
+    try:
+        conn.execute(f'DROP VIEW IF EXISTS {view_name}')
+        conn.executescript(sql)
+        return len(conn.execute(f'SELECT * FROM {view_name}').fetchall())
+    finally:
+        conn.close()
+
+
+def run_stage(stage: str, workdir: str, results: multiprocessing.Queue):
+    """
+    Runs one stage in the benchmark's working directory and reports its wall time and peak memory.
+    Each stage runs in a fresh process, so its peak RSS is its own; the stage's RSS is how far it raised the peak
+    above what the process held once the stage's modules were imported.
+
+    :param stage: 'transform', 'transform_chunked', 'load' or the path of a view's .sql file
+    :param workdir: directory holding raw_data, cleaned_data and database for this catalog size
+    :param results: queue the measurements are put on
+    """
+
+    # the view files are found relative to the repository, before moving into the working directory
+    view_path = os.path.abspath(stage) if stage.endswith('.sql') else None
+    os.chdir(workdir)
+
+    # the stage's module is imported before the clock starts, so its import time isn't counted
+    if stage == 'transform':
+        import transform
+        # every run cleans every table, rather than reusing the cleaned feathers of the run before
+        run = lambda: transform.transform(rules_path=SYNTHETIC_RULES_PATH, incremental=False)
+    elif stage == 'transform_chunked':
+        import transform
+        run = lambda: transform.transform(rules_path=SYNTHETIC_RULES_PATH, chunk_rows=transform.DEFAULT_CHUNK_ROWS)
+    elif stage == 'load':
+        import load
+        run = lambda: load.load('cleaned_data')
+    else:
+        run = lambda: run_view(view_path)
+
+    baseline_rss_mb = peak_rss_mb()
+    t0 = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - t0
+
+    peak = peak_rss_mb()
+    results.put({'seconds': seconds, 'peak_rss_mb': peak, 'stage_rss_mb': peak - baseline_rss_mb})
+
+
+def measure(stage: str, workdir: str, repeat: int = DEFAULT_REPEAT) -> dict:
+    """
+    :return: dictionary of the stage's fastest wall time in seconds, and highest peak RSS and stage RSS in MB,
+             over repeat runs
+    """
+
+    context = multiprocessing.get_context('spawn')
+    runs = []
+    for _ in range(repeat):
+        results = context.Queue()
+        process = context.Process(target=run_stage, args=(stage, workdir, results))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f'Benchmark stage {stage} failed with exit code {process.exitcode}.')
+        runs.append(results.get())
+
+    return {'seconds': min(run['seconds'] for run in runs), 'peak_rss_mb': max(run['peak_rss_mb'] for run in runs),
+            'stage_rss_mb': max(run['stage_rss_mb'] for run in runs)}
+
+
+def benchmark(sizes: list = None, seed: int = 0, repeat: int = DEFAULT_REPEAT) -> list:
+    """
+    Generates a synthetic catalog of every size and times transform, load and each view over it
+
+    :param sizes: numbers of tracks in the catalogs
+    :param seed: seed of the synthetic catalogs
+    :param repeat: number of runs of every stage, of which the fastest is kept
+    :return: list of result dictionaries, one per size and stage
+    """
+
+    # imported here rather than at the top, so the process every stage is spawned in (which imports this module)
+    # doesn't load the ingest and its dependencies too
+    from synthetic_catalog import generate_catalog
+
+    sizes = DEFAULT_SIZES if sizes is None else sizes
+    views = sorted(glob.glob(VIEW_PATTERN))
+    results = []
+
+    for size in sizes:
+        workdir = os.path.join(BENCHMARK_DIR, 'data', str(size))
+        for directory in ('cleaned_data', 'database'):
+            os.makedirs(os.path.join(workdir, directory), exist_ok=True)
+        counts = generate_catalog(size, seed=seed, directory=os.path.join(workdir, 'raw_data'))
+
+        # rows/s counts the catalog's tracks for every stage, so stages of the same size are on the same scale
+        for stage in ['transform', 'transform_chunked', 'load'] + views:
+            measurement = measure(stage, workdir, repeat)
+            result = {
+                'size': size,
+                'stage': os.path.splitext(os.path.basename(stage))[0],
+                'seconds': round(measurement['seconds'], 4),
+                'peak_rss_mb': round(measurement['peak_rss_mb'], 1),
+                'stage_rss_mb': round(measurement['stage_rss_mb'], 1),
+                'rows': counts['track'],
+                'rows_per_second': round(counts['track'] / measurement['seconds'], 1)
+            }
+            print(f'\t{size} tracks, {result["stage"]}: {result["seconds"]}s, {result["peak_rss_mb"]} MB peak '
+                  f'({result["stage_rss_mb"]} MB for the stage), {result["rows_per_second"]} rows/s')
+            results.append(result)
+
+    return results
+
+
+def write_results(results: list, path: str):
+    """
+    Writes the results with a note of the machine they were measured on
+
+    :param results: list of result dictionaries from benchmark()
+    :param path: JSON file to write
+    """
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.platform(),
+        'results': results
+    }
+    with open(path, 'w') as results_file:
+        json.dump(report, results_file, indent=2)
+
+
+def compare_to_baseline(results: list, baseline_path: str, tolerance: float = DEFAULT_TOLERANCE) -> list:
+    """
+    Compares every stage's throughput with the baseline's for the same size
+
+    :param results: list of result dictionaries from benchmark()
+    :param baseline_path: JSON file written by an earlier run
+    :param tolerance: share by which throughput may drop before it counts as a regression
+    :return: list of (size, stage, change) for every stage which regressed, change being the relative drop
+    """
+
+    with open(baseline_path) as baseline_file:
+        baseline = {(result['size'], result['stage']): result for result in json.load(baseline_file)['results']}
+
+    regressions = []
+    for result in results:
+        before = baseline.get((result['size'], result['stage']))
+        if before is None:
+            continue
+        change = result['rows_per_second'] / before['rows_per_second'] - 1
+        memory_change = result['peak_rss_mb'] / before['peak_rss_mb'] - 1
+        print(f'\t{result["size"]} tracks, {result["stage"]}: {round(change * 100, 1):+}% rows/s, '
+              f'{round(memory_change * 100, 1):+}% peak RSS')
+        if change < -tolerance:
+            regressions.append((result['size'], result['stage'], change))
+
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark transform, load and the views over synthetic catalogs.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='numbers of tracks')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='runs per stage, fastest kept')
+    parser.add_argument('--output', default=DEFAULT_RESULTS_PATH)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    t0 = time.time()
+    results = benchmark(args.sizes, args.seed, args.repeat)
+    write_results(results, args.output)
+    print(f'Benchmark completed. Results written to {args.output}. Total time: {round(time.time() - t0, 2)}s')
+
+    if args.save_baseline:
+        write_results(results, args.baseline)
+        print(f'Baseline stored in {args.baseline}')
+    elif os.path.isfile(args.baseline):
+        regressions = compare_to_baseline(results, args.baseline, args.tolerance)
+        for size, stage, change in regressions:
+            print(f'Regression: {stage} at {size} tracks is {round(-change * 100, 1)}% slower than the baseline')
+        if len(regressions) > 0:
+            sys.exit(1)
+    else:
+        print(f'No baseline in {args.baseline} to compare against; run with --save-baseline to store these results '
+              f'as the baseline')
@@ -0,0 +1,166 @@
+"""
+The purpose of this script is to save the partial results of each ingest stage as it goes, so a crashed run can be
+resumed without fetching everything again.
+
+"""
+
+import json
+import os
+import shutil
+import pyarrow as pa
+from feather_io import FeatherBatchWriter, iter_feather_batches, read_feather_column
+
+
+CHECKPOINT_DIR = 'raw_data/checkpoints'
+
+# Number of input IDs (artist names, artist IDs, album IDs or track IDs) fetched between two checkpoints
+DEFAULT_CHUNK_SIZE = 500
+
+
+class StageCheckpoint:
+    """
+    Append-only checkpoint of one ingest stage: every chunk of rows is streamed into its own feather,
+    and a progress manifest lists which input IDs each chunk covers
+    """
+
+    def __init__(self, stage: str, resume: bool = False, directory: str = CHECKPOINT_DIR):
+        self.stage = stage
+        self.path = os.path.join(directory, stage)
+        self.manifest_path = os.path.join(self.path, 'progress.jsonl')
+
+        # a fresh run must not pick up chunks left behind by an older one
+        if not resume and os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path, exist_ok=True)
+
+        self.chunks = self.read_manifest()
+
+    def read_manifest(self) -> list:
+        """
+        Reads the chunks recorded so far
+
+        :return: list of dictionaries with the chunk's file name and the input IDs it covers
+        """
+
+        chunks = []
+        if not os.path.isfile(self.manifest_path):
+            return chunks
+
+        with open(self.manifest_path) as manifest:
+            for line in manifest:
+                # a line cut short by a crash means its chunk never counted as done
+                try:
+                    chunk = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                if os.path.isfile(os.path.join(self.path, chunk['file'])):
+                    chunks.append(chunk)
+
+        return chunks
+
+    def done_ids(self) -> set:
+        """
+        :return: set of every input ID already covered by a saved chunk
+        """
+
+        done = set()
+        for chunk in self.chunks:
+            done.update(chunk['ids'])
+
+        return done
+
+    def save_chunk(self, ids: list, rows, schema: pa.Schema, key_column: str):
+        """
+        Streams one chunk of rows into its own feather, then records it in the manifest
+
+        :param ids: input IDs the rows were fetched for
+        :param rows: iterable of row dictionaries fetched for those IDs
+        :param schema: pa.Schema of the stage's table
+        :param key_column: column uniquely identifying a row, e.g. 'track_id'
+        """
+
+        file_name = f'chunk_{len(self.chunks):05d}.feather'
+        with FeatherBatchWriter(os.path.join(self.path, file_name), schema, key_column=key_column) as writer:
+            for row in rows:
+                writer.append(row)
+
+        # the manifest line is only written once the chunk is safely on disk
+        chunk = {'file': file_name, 'ids': list(ids)}
+        with open(self.manifest_path, 'a') as manifest:
+            manifest.write(json.dumps(chunk) + '\n')
+            manifest.flush()
+            os.fsync(manifest.fileno())
+
+        self.chunks.append(chunk)
+
+    def iter_batches(self):
+        """
+        Reads every saved chunk back, one record batch at a time
+
+        :return: generator of pa.RecordBatch holding all rows fetched for this stage so far
+        """
+
+        for chunk in self.chunks:
+            yield from iter_feather_batches(os.path.join(self.path, chunk['file']))
+
+
+def run_checkpointed(stage: str, ids: list, iter_rows, schema: pa.Schema, key_column: str, resume: bool = False,
+                     chunk_size: int = DEFAULT_CHUNK_SIZE, **kwargs) -> StageCheckpoint:
+    """
+    Runs a row generator over the input IDs chunk by chunk, saving each chunk as it finishes
+
+    :param stage: name of the stage, used for its checkpoint directory
+    :param ids: list of input IDs for the stage
+    :param iter_rows: function taking a list of input IDs (plus kwargs) and yielding row dictionaries
+    :param schema: pa.Schema of the stage's table
+    :param key_column: column uniquely identifying a row, e.g. 'track_id'
+    :param resume: skip the input IDs already covered by an earlier, interrupted run
+    :param chunk_size: number of input IDs per chunk
+    :return: StageCheckpoint holding every chunk of the stage
+    """
+
+    checkpoint = StageCheckpoint(stage, resume=resume)
+    done = checkpoint.done_ids()
+    todo = [id for id in ids if id not in done]
+    if resume and len(done) > 0:
+        print(f'\tResuming {stage}: {len(ids) - len(todo)} of {len(ids)} already fetched.')
+
+    for start in range(0, len(todo), chunk_size):
+        chunk = todo[start:start + chunk_size]
+        checkpoint.save_chunk(chunk, iter_rows(chunk, **kwargs), schema, key_column)
+
+    return checkpoint
+
+
+def load_known_ids(name: str, read_ids, resume: bool = False, directory: str = CHECKPOINT_DIR) -> set:
+    """
+    Returns the IDs an incremental run started from, e.g. those of the albums stored by the run before.
+    They are read once, at the start of the run, and saved with its checkpoints: the run overwrites the feathers
+    they were read from, so a resumed run reads them back from the checkpoints instead.
+
+    :param name: what the IDs identify, e.g. 'album'
+    :param read_ids: function returning the list of IDs, called unless a resumed run finds them saved
+    :param resume: read back the IDs saved by an earlier, interrupted run if there are any
+    :return: set of IDs
+    """
+
+    path = os.path.join(directory, f'known_{name}_ids.feather')
+    if resume and os.path.isfile(path):
+        return set(read_feather_column(path, 'id'))
+
+    ids = read_ids()
+    os.makedirs(directory, exist_ok=True)
+    schema = pa.schema([('id', pa.string())])
+    with FeatherBatchWriter(path, schema) as writer:
+        writer.write_batch(pa.RecordBatch.from_arrays([pa.array(ids, type=pa.string())], schema=schema))
+
+    return set(ids)
+
+
+def clear_checkpoints(directory: str = CHECKPOINT_DIR):
+    """
+    Removes every stage's checkpoint once a run has completed
+    """
+
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
@@ -1,11 +1,12 @@
 import pandas as pd
 import matplotlib
 import matplotlib.pyplot as plt
+from feather_io import read_feather_df
 # import seaborn as sns
 
 
 def create_followers_viz():
-    artist_df = pd.read_feather('cleaned_data/cleaned_artist.feather')
+    artist_df = read_feather_df('cleaned_data/cleaned_artist.feather', ['artist_name', 'followers'])
 
 def create_danceability_viz():
     fig, ax = plt.subplots(figsize=(17, 17))
@@ -0,0 +1,382 @@
+"""
+The purpose of this script is to build feathers column by column, in record batches of a fixed size,
+so no stage has to hold a whole table as Python dictionaries before it can be stored.
+
+"""
+
+import os
+from contextlib import contextmanager
+import pandas as pd
+import pyarrow as pa
+
+
+# Number of rows gathered in the column buffers before they are flushed as one record batch
+DEFAULT_BATCH_SIZE = 10000
+
+# Same compression pandas uses for to_feather
+DEFAULT_COMPRESSION = 'lz4'
+
+
+class ArrowTableBuilder:
+    """
+    Appends rows into one typed buffer per column of the schema and cuts them into record batches of batch_size rows.
+    If a key column is given, rows repeating a key already appended are skipped.
+    """
+
+    def __init__(self, schema: pa.Schema, key_column: str = None, batch_size: int = DEFAULT_BATCH_SIZE):
+        self.schema = schema
+        self.key_column = key_column
+        self.batch_size = batch_size
+        self.columns = {name: [] for name in schema.names}
+        self.seen_keys = set()
+        self.batches = []
+        self.rows = 0
+
+    def append(self, row: dict) -> bool:
+        """
+        Adds one row; fields missing from the row are stored as nulls
+
+        :param row: dictionary of validated fields
+        :return: True if the row was added, False if its key had already been seen
+        """
+
+        if self.key_column is not None:
+            key = row.get(self.key_column)
+            if key in self.seen_keys:
+                return False
+            self.seen_keys.add(key)
+
+        for name, column in self.columns.items():
+            column.append(row.get(name))
+        self.rows += 1
+
+        if len(self.columns[self.schema.names[0]]) >= self.batch_size:
+            self.batches.append(self.cut_batch())
+
+        return True
+
+    def cut_batch(self) -> pa.RecordBatch:
+        """
+        Turns the buffered rows into a typed record batch and empties the buffers
+
+        :return: pa.RecordBatch of the buffered rows
+        """
+
+        arrays = [pa.array(self.columns[field.name], type=field.type) for field in self.schema]
+        for column in self.columns.values():
+            column.clear()
+
+        return pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+    def pending_batches(self) -> list:
+        """
+        Hands over the record batches cut so far
+
+        :return: list of pa.RecordBatch, no longer held by the builder
+        """
+
+        batches = self.batches
+        self.batches = []
+
+        return batches
+
+    def finish(self) -> list:
+        """
+        Cuts whatever is left in the buffers and hands over every remaining batch
+
+        :return: list of pa.RecordBatch
+        """
+
+        if len(self.columns[self.schema.names[0]]) > 0:
+            self.batches.append(self.cut_batch())
+
+        return self.pending_batches()
+
+    def to_pandas(self) -> pd.DataFrame:
+        """
+        Builds a pandas DataFrame out of every row appended
+
+        :return: pd.DataFrame with one column per field of the schema
+        """
+
+        return pa.Table.from_batches(self.finish(), schema=self.schema).to_pandas()
+
+
+class FeatherBatchWriter:
+    """
+    Writes a feather incrementally: rows are buffered by an ArrowTableBuilder and every full record batch
+    goes straight to disk. The feather only replaces any file at its path once the writer is closed.
+    """
+
+    def __init__(self, path: str, schema: pa.Schema, key_column: str = None, batch_size: int = DEFAULT_BATCH_SIZE,
+                 compression: str = DEFAULT_COMPRESSION):
+        self.path = path
+        self.temp_path = path + '.partial'
+        self.builder = ArrowTableBuilder(schema, key_column=key_column, batch_size=batch_size)
+        options = pa.ipc.IpcWriteOptions(compression=compression)
+        self.writer = pa.ipc.new_file(self.temp_path, schema, options=options)
+
+    def append(self, row: dict) -> bool:
+        """
+        Adds one row, writing a record batch whenever batch_size rows have been gathered
+
+        :param row: dictionary of validated fields
+        :return: True if the row was added, False if its key had already been seen
+        """
+
+        added = self.builder.append(row)
+        for batch in self.builder.pending_batches():
+            self.writer.write_batch(batch)
+
+        return added
+
+    def write_batch(self, batch: pa.RecordBatch):
+        """
+        Writes an already built record batch (e.g. one read back from another feather), skipping repeated keys
+
+        :param batch: pa.RecordBatch holding (at least) the writer's columns
+        """
+
+        # rows appended earlier go to disk first, so the order of rows is kept
+        for pending in self.builder.finish():
+            self.writer.write_batch(pending)
+
+        batch = conform_batch(batch, self.builder.schema)
+        if self.builder.key_column is not None:
+            keep = []
+            for key in batch.column(self.builder.key_column).to_pylist():
+                keep.append(key not in self.builder.seen_keys)
+                self.builder.seen_keys.add(key)
+            batch = batch.filter(pa.array(keep, type=pa.bool_()))
+
+        self.builder.rows += batch.num_rows
+        self.writer.write_batch(batch)
+
+    @property
+    def rows(self) -> int:
+        return self.builder.rows
+
+    def close(self) -> int:
+        """
+        Writes the last record batch and moves the finished feather into place
+
+        :return: number of rows written
+        """
+
+        for batch in self.builder.finish():
+            self.writer.write_batch(batch)
+        self.writer.close()
+        os.replace(self.temp_path, self.path)
+
+        return self.rows
+
+    def abort(self):
+        """
+        Throws away what has been written, leaving whatever was at the path untouched
+        """
+
+        self.writer.close()
+        os.remove(self.temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # leave whatever was at the path untouched if the stage failed
+            self.abort()
+
+
+def write_feather_df(df: pd.DataFrame, path: str, compression: str = DEFAULT_COMPRESSION):
+    """
+    Writes a DataFrame to a feather. It only replaces any file at the path once it's complete, so a DataFrame
+    read from the old file through its memory map (see read_feather_df) can still be written back over it.
+
+    :param df: DataFrame to write; its index is not kept
+    :param path: path to the feather
+    :param compression: 'lz4', 'zstd' or None; only an uncompressed feather can be read zero-copy
+    """
+
+    temp_path = path + '.partial'
+    df.reset_index(drop=True).to_feather(temp_path, compression='uncompressed' if compression is None else compression)
+    os.replace(temp_path, path)
+
+
+def conform_batch(batch: pa.RecordBatch, schema: pa.Schema) -> pa.RecordBatch:
+    """
+    Casts a record batch to the given schema; columns it doesn't have are filled with nulls
+
+    :param batch: pa.RecordBatch, e.g. read from a feather written by pandas
+    :param schema: schema the batch should have
+    :return: pa.RecordBatch with exactly the schema's columns and types
+    """
+
+    arrays = []
+    for field in schema:
+        if field.name in batch.schema.names:
+            arrays.append(batch.column(field.name).cast(field.type))
+        else:
+            arrays.append(pa.nulls(batch.num_rows, type=field.type))
+
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def is_read_in_place(source: pa.MemoryMappedFile, batch: pa.RecordBatch) -> bool:
+    """
+    :param source: memory map of a feather
+    :param batch: record batch read from it
+    :return: True if the batch's buffers point into the map, i.e. the feather is uncompressed and was read zero-copy
+    """
+
+    source.seek(0)
+    start = source.read_buffer(1).address
+    end = start + source.size()
+
+    return any(buffer is not None and start <= buffer.address < end
+               for column in batch.columns for buffer in column.buffers())
+
+
+@contextmanager
+def open_feather(path: str, columns: list = None):
+    """
+    Opens a feather so that reading it decodes as little as possible. An uncompressed feather is memory-mapped
+    and read in place, every column alike, since a column only takes up memory once it's touched.
+    A compressed feather has to be decompressed anyway, so it's read from the file, only the given columns.
+
+    :param path: path to the feather
+    :param columns: names of the columns to read; every column if None
+    :return: context manager of a pa.ipc.RecordBatchFileReader, whose batches may hold more columns than asked for
+    """
+
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        if reader.num_record_batches == 0 or is_read_in_place(source, reader.get_batch(0)):
+            yield reader
+            return
+
+    options = pa.ipc.IpcReadOptions()
+    if columns is not None:
+        names = reader.schema.names
+        missing = [column for column in columns if column not in names]
+        if len(missing) > 0:
+            raise KeyError(f'Columns {missing} are not in the feather.')
+        options = pa.ipc.IpcReadOptions(included_fields=sorted(names.index(column) for column in columns))
+
+    with pa.OSFile(path) as source:
+        yield pa.ipc.open_file(source, options=options)
+
+
+def iter_feather_batches(path: str, columns: list = None):
+    """
+    Yields the record batches of a feather one at a time
+
+    :param path: path to the feather
+    :param columns: names of the columns to read; every column if None
+    :return: generator of pa.RecordBatch
+    """
+
+    with open_feather(path, columns) as reader:
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            if columns is not None:
+                batch = batch.select(columns)
+            yield batch
+
+
+def read_feather_table(path: str, columns: list = None) -> pa.Table:
+    """
+    Reads a feather, or only some of its columns, as an Arrow table; an uncompressed feather's table is backed
+    by a memory map of the file
+
+    :param path: path to the feather
+    :param columns: names of the columns to read, in the order wanted; every column if None
+    :return: pa.Table
+    """
+
+    with open_feather(path, columns) as reader:
+        table = reader.read_all()
+
+    return table if columns is None else table.select(columns)
+
+
+def read_feather_df(path: str, columns: list = None) -> pd.DataFrame:
+    """
+    Reads a feather, or only some of its columns, into a DataFrame. The stages read their tables through this
+    rather than pd.read_feather, so a column they don't need is never materialized.
+
+    :param path: path to the feather
+    :param columns: names of the columns to read, in the order wanted; every column if None
+    :return: pd.DataFrame
+    """
+
+    # each column becomes its own block, and is freed from the table as soon as it's converted,
+    # so the table and the DataFrame are never both held in full
+    return read_feather_table(path, columns).to_pandas(split_blocks=True, self_destruct=True)
+
+
+def read_feather_column(path: str, column: str) -> list:
+    """
+    Reads a single column of a feather into a list, without decoding the other columns
+
+    :param path: path to the feather
+    :param column: name of the column
+    :return: list of the column's values
+    """
+
+    values = []
+    for batch in iter_feather_batches(path, [column]):
+        values.extend(batch.column(0).to_pylist())
+
+    return values
+
+
+def iter_feather_chunks(path: str, chunk_rows: int, columns: list = None):
+    """
+    Yields a feather in tables of chunk_rows rows, whatever the size of the record batches it was written in.
+    A feather without rows yields one empty table, so its schema still comes through.
+
+    :param path: path to the feather
+    :param chunk_rows: number of rows per chunk (the last chunk may hold fewer)
+    :param columns: names of the columns to read; every column if None
+    :return: generator of pa.Table
+    """
+
+    pending = []
+    pending_rows = 0
+    yielded = False
+    for batch in iter_feather_batches(path, columns):
+        while batch.num_rows > 0:
+            take = min(batch.num_rows, chunk_rows - pending_rows)
+            pending.append(batch.slice(0, take))
+            pending_rows += take
+            batch = batch.slice(take)
+            if pending_rows == chunk_rows:
+                yield pa.Table.from_batches(pending)
+                pending = []
+                pending_rows = 0
+                yielded = True
+
+    if pending_rows > 0:
+        yield pa.Table.from_batches(pending)
+    elif not yielded:
+        yield read_feather_schema(path, columns).empty_table()
+
+
+def read_feather_schema(path: str, columns: list = None) -> pa.Schema:
+    """
+    Reads the schema of a feather without reading any of its rows
+
+    :param path: path to the feather
+    :param columns: names of the columns to keep; every column if None
+    :return: pa.Schema, without the pandas metadata of the file (which describes the index of the whole table)
+    """
+
+    with pa.memory_map(path) as source:
+        schema = pa.ipc.open_file(source).schema.remove_metadata()
+
+    if columns is not None:
+        schema = pa.schema([schema.field(name) for name in columns])
+
+    return schema
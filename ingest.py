@@ -3,11 +3,19 @@ The purpose of this script is to retrieve the needed information from the Spotif
 
 """
 
+import asyncio
+import os
 import time
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
+import pyarrow as pa
+import pyarrow.compute as pc
+from feather_io import ArrowTableBuilder, FeatherBatchWriter, conform_batch, iter_feather_batches, read_feather_column
+from validation import FIRST, Field, TableSchema
+from artist_index import ArtistAliasIndex, get_artist_index, pick_search_result
+from checkpoint import clear_checkpoints, load_known_ids, run_checkpointed
+from spotify_client import DEFAULT_POOL_SIZE, SpotifyClient, create_spotify_client, get_spotify_client
 
 
 # tasks:
@@ -18,15 +26,281 @@ from spotipy.oauth2 import SpotifyClientCredentials
 #   track info
 #   track features
 
+# The audio-features endpoint accepts at most 100 track IDs per request
+AUDIO_FEATURES_BATCH_SIZE = 100
+
+# The several-artists endpoint accepts at most 50 artist IDs per request
+SEVERAL_ARTISTS_BATCH_SIZE = 50
+
+# The several-albums endpoint accepts at most 20 album IDs per request
+SEVERAL_ALBUMS_BATCH_SIZE = 20
+
+# The album-listing endpoints return at most 50 items per page
+PAGE_LIMIT = 50
+
+# How many further pages of a listing may be requested at the same time
+PAGE_PREFETCH = 4
+
+# An incremental run finds new releases through the artists' album listings, so their cached responses
+# (and cached pages of listings without a total) are thrown away at its start
+INCREMENTAL_REFRESH_ENDPOINTS = ['artist_albums', 'next']
+
+# Declarative schemas of the four raw tables: where each column comes from in the API record, its type,
+# and whether a record without it is kept. Columns are stored in this order.
+ARTIST_SCHEMA = TableSchema('artist', [
+    Field('artist_id', 'string', path=('id',), nullable=False),
+    Field('artist_name', 'string', path=('name',)),
+    # for artists with multiple urls, we will use the spotify one
+    Field('external url', 'string', path=('external_urls', 'spotify')),
+    # for artists with multiple genres, we'll just choose the first one
+    Field('genre', 'string', path=('genres', FIRST)),
+    # for artists with multiple images, we'll just choose the first one
+    Field('image_url', 'string', path=('images', FIRST, 'url')),
+    Field('followers', 'int', path=('followers', 'total'), coerce=True),
+    Field('popularity', 'int', coerce=True),
+    Field('type', 'string', constant='artist'),
+    Field('artist_uri', 'string', path=('uri',))
+])
+
+ALBUM_SCHEMA = TableSchema('album', [
+    Field('album_id', 'string', path=('id',), nullable=False),
+    Field('album_name', 'string', path=('name',)),
+    Field('external_url', 'string', path=('external_urls', 'spotify')),
+    Field('image_url', 'string', path=('images', FIRST, 'url')),
+    # Album release dates vary in precision (year, year and month, or full date)
+    Field('release_date', 'timestamp'),
+    Field('total_tracks', 'int'),
+    Field('type', 'string', path=('album_type',)),
+    Field('album_uri', 'string', path=('uri',)),
+    Field('artist_id', 'string', context='artist_id')
+])
+
+TRACK_SCHEMA = TableSchema('track', [
+    Field('track_id', 'string', path=('id',), nullable=False),
+    Field('song_name', 'string', path=('name',)),
+    Field('external_url', 'string', path=('external_urls', 'spotify')),
+    Field('duration_ms', 'int'),
+    Field('explicit', 'bool'),
+    Field('disc_number', 'int'),
+    Field('type', 'string'),
+    Field('song_uri', 'string', path=('uri',)),
+    Field('album_id', 'string', context='album_id')
+])
+
+TRACK_FEATURE_SCHEMA = TableSchema('track_feature', [
+    Field('track_id', 'string', path=('id',), nullable=False),
+    Field('danceability', 'float'),
+    Field('energy', 'float'),
+    Field('instrumentalness', 'float'),
+    Field('liveness', 'float'),
+    Field('loudness', 'float'),
+    Field('speechiness', 'float'),
+    Field('tempo', 'float'),
+    Field('type', 'string'),
+    Field('valence', 'float'),
+    Field('song_uri', 'string', path=('uri',))
+])
+
+VALIDATION_SCHEMAS = {
+    'artist': ARTIST_SCHEMA,
+    'album': ALBUM_SCHEMA,
+    'track': TRACK_SCHEMA,
+    'track_feature': TRACK_FEATURE_SCHEMA
+}
+
+# Column names and types of the four raw tables, in the order they are stored
+RAW_SCHEMAS = {table_name: schema.arrow_schema() for table_name, schema in VALIDATION_SCHEMAS.items()}
+
+# Column uniquely identifying a row of each raw table
+RAW_KEYS = {
+    'artist': 'artist_id',
+    'album': 'album_id',
+    'track': 'track_id',
+    'track_feature': 'track_id'
+}
+
+# **********
+# TABLE functions
+
+def rows_to_table(rows, table_name: str) -> pd.DataFrame:
+    """
+    Builds a pandas DataFrame out of row dictionaries through typed Arrow column buffers.
+    Rows repeating an ID already seen are skipped.
+
+    :param rows: iterable of row dictionaries
+    :param table_name: name of the raw table, e.g. 'track'
+    :return: pd.DataFrame with the table's columns
+    """
+
+    builder = ArrowTableBuilder(RAW_SCHEMAS[table_name], key_column=RAW_KEYS[table_name])
+    for row in rows:
+        builder.append(row)
+
+    return builder.to_pandas()
+
+def store_table(table_name: str, *batch_sources) -> int:
+    """
+    Streams record batches into raw_data/<table_name>.feather, one batch at a time
+
+    :param table_name: name of the raw table, e.g. 'track'
+    :param batch_sources: iterables of pa.RecordBatch, written in order; rows repeating an ID already written
+                          are skipped, so earlier sources win
+    :return: number of rows stored
+    """
+
+    with FeatherBatchWriter(f'raw_data/{table_name}.feather', RAW_SCHEMAS[table_name],
+                            key_column=RAW_KEYS[table_name]) as writer:
+        for source in batch_sources:
+            for batch in source:
+                writer.write_batch(batch)
+
+    return writer.rows
+
+def store_rows(table_name: str, rows) -> int:
+    """
+    Streams row dictionaries into raw_data/<table_name>.feather, one record batch at a time
+
+    :param table_name: name of the raw table, e.g. 'track'
+    :param rows: iterable of row dictionaries; rows repeating an ID already written are skipped
+    :return: number of rows stored
+    """
+
+    with FeatherBatchWriter(f'raw_data/{table_name}.feather', RAW_SCHEMAS[table_name],
+                            key_column=RAW_KEYS[table_name]) as writer:
+        for row in rows:
+            writer.append(row)
+
+    return writer.rows
+
+def read_stored_ids(table_name: str) -> list:
+    """
+    Reads the ID column of a stored raw table without loading the rest of it
+
+    :param table_name: name of the raw table, e.g. 'track'
+    :return: list of IDs, or an empty list if the table hasn't been stored
+    """
+
+    path = f'raw_data/{table_name}.feather'
+    if not os.path.isfile(path):
+        return []
+
+    return read_feather_column(path, RAW_KEYS[table_name])
+
+def iter_previous_batches(table_name: str, parent_column: str, parent_ids: list):
+    """
+    Yields the rows of an earlier run's raw table which still belong to something in the table above
+
+    :param table_name: name of the raw table, e.g. 'track'
+    :param parent_column: column linking a row to the table above it, e.g. 'album_id'
+    :param parent_ids: IDs still present in the table above; earlier rows belonging to anything else are dropped
+    :return: generator of pa.RecordBatch
+    """
+
+    path = f'raw_data/{table_name}.feather'
+    if not os.path.isfile(path):
+        return
+
+    parent_id_array = pa.array(parent_ids, type=pa.string())
+    for batch in iter_feather_batches(path):
+        batch = conform_batch(batch, RAW_SCHEMAS[table_name])
+        yield batch.filter(pc.is_in(batch.column(parent_column), value_set=parent_id_array))
+
+# **********
+# PAGINATION functions
+
+def iter_pages(first_page: dict, fetch_page, spotify: SpotifyClient):
+    """
+    Yields every item of a paged Spotify listing, starting from its first page
+
+    When the first page reports the listing's total, the remaining pages are requested by offset,
+    up to PAGE_PREFETCH at a time, while earlier items are being consumed.
+    Otherwise the 'next' links are followed one page at a time.
+
+    :param first_page: first paging object of the listing
+    :param fetch_page: function taking an offset and returning the paging object starting there
+    :param spotify: client used to follow 'next' links
+    :return: generator of the listing's items, in order
+    """
+
+    yield from first_page['items']
+
+    if first_page['next'] is None:
+        return
+
+    total = first_page.get('total')
+    if total is None:
+        page = first_page
+        while page['next'] is not None:
+            page = spotify.next(page)
+            yield from page['items']
+        return
+
+    limit = first_page.get('limit') or PAGE_LIMIT
+    offsets = range(first_page.get('offset', 0) + len(first_page['items']), total, limit)
+
+    # Keep only a few pages in flight so a long listing is never held in memory all at once
+    with ThreadPoolExecutor(max_workers=PAGE_PREFETCH) as executor:
+        pending = deque()
+        for offset in offsets:
+            pending.append(executor.submit(fetch_page, offset))
+            if len(pending) >= PAGE_PREFETCH:
+                yield from pending.popleft().result()['items']
+        while pending:
+            yield from pending.popleft().result()['items']
+
 # **********
 # ARTIST functions
 
-def get_artist_info(artist_name: str) -> dict:
+def resolve_artist_id(artist_name: str, spotify: SpotifyClient = None, index: ArtistAliasIndex = None) -> str:
     """
-    Gets artist information from the Spotify API
+    Finds the Spotify artist ID for an artist name, searching the API only for names not already in the alias index
 
     :param artist_name: artist/band name string to search
-    :return: dictionary of all required features
+    :param spotify: shared Spotify client; the session-wide client is used if none is given
+    :param index: alias index of names resolved before; the shared index is used if none is given,
+                  or none at all if the client records or replays its responses
+    :return: artist ID string, or None if the search finds nothing
+    """
+
+    # reuse the shared Spotify client (credentials stored on local machine as environment variables)
+    if spotify is None:
+        spotify = get_spotify_client()
+
+    if index is None:
+        # While recording, names resolved by earlier runs still have to be searched for, so the search ends up in
+        # the recording; while replaying, the replayed artists aren't added to the index kept on disk
+        if getattr(spotify, 'recording_mode', None) is not None:
+            index = ArtistAliasIndex(None)
+        else:
+            index = get_artist_index()
+
+    artist_id = index.get(artist_name)
+    if artist_id is not None:
+        return artist_id
+
+    # search for artist by name
+    results = spotify.search(q=f'artist: {artist_name}', type='artist')
+    # if the search returns no results, 'items' will be an empty list
+    artist = pick_search_result(artist_name, results['artists']['items'])
+    if artist is None or not isinstance(artist.get('id'), str):
+        return None
+
+    # both the name searched for and the artist's own spelling resolve to the artist from now on
+    index.add(artist_name, artist['id'])
+    if isinstance(artist.get('name'), str):
+        index.add(artist['name'], artist['id'])
+    index.save()
+
+    return artist['id']
+
+def get_artist_info_batch(artist_ids: list, spotify: SpotifyClient = None) -> dict:
+    """
+    Gets artist information from the Spotify API for many artists at once, using the several-artists endpoint
+    (SEVERAL_ARTISTS_BATCH_SIZE artist IDs per request)
+
+    :param artist_ids: list of strings of artist IDs
+    :param spotify: shared Spotify client; the session-wide client is used if none is given
+    :return: dictionary keyed by artist ID of artist dictionaries (None for unknown or rejected artists)
     """
 
     # Here is the list of artist features required:
@@ -41,114 +315,80 @@ def get_artist_info(artist_name: str) -> dict:
     #     'uri'
     # ]
 
-    # create a spotipy object using the credentials stored on local machine as environment variables
-    spotify = spotipy.Spotify(auth_manager=SpotifyClientCredentials())
+    if spotify is None:
+        spotify = get_spotify_client()
 
-    # search for artist by name
-    results = spotify.search(q=f'artist: {artist_name}', type='artist')
-    items = results['artists']['items']
-    # if the search returns no results, 'items' will be an empty list
-    if len(items) > 0:
-        artist = items[0]
-    else:
-        return None
+    # an artist asked for twice is only requested once
+    artist_ids = list(dict.fromkeys(artist_ids))
+    complete_artists_dict = {}
 
-    # create dictionary of artist details
-    # each item is validated before being inserted into the artist_info dictionary
-    artist_info = {}
+    for start in range(0, len(artist_ids), SEVERAL_ARTISTS_BATCH_SIZE):
+        chunk = artist_ids[start:start + SEVERAL_ARTISTS_BATCH_SIZE]
+        results = spotify.artists(chunk)['artists']
 
-    artist_id = artist['id']
-    # artist_id must be a string, otherwise we'll insert a null
-    if isinstance(artist_id, str) and len(artist_id) > 0:
-        artist_info['artist_id'] = artist_id
-    else:
-        artist_info['artist_id'] = None
+        if len(results) != len(chunk):
+            raise Exception(f'Several-artists response does not match the {len(chunk)} artist IDs requested.')
 
-    # artist_name must be a string, otherwise we'll insert a null
-    name = artist['name']
-    if isinstance(name, str) and len(name) > 0:
-        artist_info['artist_name'] = name
-    else:
-        artist_info['artist_name'] = None
+        for artist_id, artist in zip(chunk, results):
+            # unknown artist IDs come back as null
+            if artist is None:
+                complete_artists_dict[artist_id] = None
+            else:
+                # each item is validated against the artist schema before being stored
+                complete_artists_dict[artist_id] = ARTIST_SCHEMA.validate_one(artist)
 
-    # external_url must be a single string, otherwise we'll insert a null
-    # for artists with multiple urls, we will use the spotify one
-    artist_url = artist['external_urls']['spotify']
-    if len(artist_url) > 0:
-        artist_info['external url'] = artist_url
-    else:
-        artist_info['external url'] = None
+    return complete_artists_dict
 
-    # artist_name must be a single string, otherwise we'll insert a null
-    # for artists with multiple genres, we'll just choose the first one
-    genre = artist['genres']
-    if isinstance(genre, list):
-        if len(genre) > 0:
-            artist_info['genre'] = genre[0]
-        else:
-            artist_info['genre'] = None
-    elif isinstance(genre, str) and len(genre) > 0:
-        artist_info['genre'] = genre
-    else:
-        artist_info['genre'] = None
+def get_artist_info(artist_name: str, spotify: SpotifyClient = None, index: ArtistAliasIndex = None) -> dict:
+    """
+    Gets artist information from the Spotify API
 
-    # image_url must be a single string, otherwise we'll insert a null
-    # for artists with multiple images, we'll just choose the first one
-    artist_image = artist['images']
-    if isinstance(artist_image, dict) and len(artist_image) > 0:
-        artist_info['image_url'] = artist_image['url']
-    elif isinstance(artist_image, list) and len(artist_image) > 0:
-        artist_info['image_url'] = artist_image[0]['url']
-    else:
-        artist_info['image_url'] = None
+    :param artist_name: artist/band name string to search
+    :param spotify: shared Spotify client; the session-wide client is used if none is given
+    :param index: alias index of names resolved before; the shared index is used if none is given
+    :return: dictionary of all required features
+    """
 
-    # followers must be an integer, otherwise we'll insert a null
-    try:
-        artist_followers = int(artist['followers']['total'])
-    except:
-        artist_followers = None
-    artist_info['followers'] = artist_followers
+    if spotify is None:
+        spotify = get_spotify_client()
 
-    # popularity must be an integer, otherwise we'll insert a null
-    try:
-        artist_popularity = int(artist['popularity'])
-    except:
-        artist_popularity = None
-    artist_info['popularity'] = artist_popularity
-
-    # type must be the string 'artist'
-    artist_info['type'] = 'artist'
-
-    # artist_uri must be a string, otherwise we'll insert a null
-    artist_uri = artist['uri']
-    if isinstance(artist_uri, str) and len(artist_uri) > 0:
-        artist_info['artist_uri'] = artist_uri
-    else:
-        artist_info['artist_uri'] = None
+    artist_id = resolve_artist_id(artist_name, spotify, index)
+    if artist_id is None:
+        return None
 
-    return artist_info
+    return get_artist_info_batch([artist_id], spotify)[artist_id]
 
-def make_artist_table(artist_names: list) -> pd.DataFrame:
+def make_artist_table(artist_names: list, spotify: SpotifyClient = None) -> pd.DataFrame:
     """
     Takes the list of artist names supplied by the user and returns a pandas DataFrame of all artists
 
     :param artist_names: list of strings of artist/band names
+    :param spotify: shared Spotify client, passed on to every request
     :return: pd.DataFrame of all artist info
     """
 
-    artist_dict = {}
+    return rows_to_table(iter_artist_rows(artist_names, spotify), 'artist')
 
-    for name in artist_names:
-        artist_info = get_artist_info(name)
-        artist_dict[artist_info['artist_id']] = artist_info
+def iter_artist_rows(artist_names: list, spotify: SpotifyClient = None, index: ArtistAliasIndex = None):
+    """
+    Yields the artist info for each artist name supplied by the user.
+    Names are resolved to artist IDs first (searching only for names not in the alias index),
+    then every artist is fetched by ID in several-artists batches.
 
-    artist_table = pd.DataFrame.from_dict(artist_dict, orient='index')
+    :param artist_names: list of strings of artist/band names
+    :param spotify: shared Spotify client, passed on to every request
+    :param index: alias index of names resolved before; the shared index is used if none is given
+    :return: generator of artist dictionaries
+    """
 
-    # clean up the df
-    artist_table.reset_index(inplace=True)
-    artist_table.drop('index', axis=1, inplace=True)
+    artist_ids = [resolve_artist_id(name, spotify, index) for name in artist_names]
+    # artists the search can't find are left out
+    artist_ids = [id for id in artist_ids if id is not None]
+    artists_info = get_artist_info_batch(artist_ids, spotify)
 
-    return artist_table
+    for id in artist_ids:
+        if artists_info[id] is not None:
+            yield artists_info[id]
 
 def get_artist_ids(artist_table: pd.DataFrame) -> list:
     """
@@ -165,106 +405,73 @@ def get_artist_ids(artist_table: pd.DataFrame) -> list:
 # **********
 # ALBUM functions
 
-def get_album_info(artist_id: str) -> dict:
+def get_album_info(artist_id: str, spotify: SpotifyClient = None) -> dict:
     """
     Gets album information from the Spotify API
 
     :param artist_id: ID (string) for artist as retrieved by get_artist_ids
+    :param spotify: shared Spotify client; the session-wide client is used if none is given
     :return: dictionary of all available album information for artist
     """
 
-    spotify = spotipy.Spotify(auth_manager=SpotifyClientCredentials())
-    results = spotify.artist_albums(artist_id=artist_id, country='US', limit=50)
-    albums = results['items']
-
-    # if the search returns no results, items will be an empty list
-    if len(albums) == 0:
-        raise Exception('No albums returned for this artist')
-
-    # create dictionary of album details
     complete_albums_dict = {}
 
-    for album in albums:
-        album_dict = {}
-        # each item is validated before being inserted into the album_dict dictionary
-
-        if len(album['id']) > 0 and isinstance(album['id'], str):
-            album_dict['album_id'] = album['id']
-        else:
-            raise Exception('Album does not have a unique identifier.')
-
-        if len(album['name']) > 0 and isinstance(album['name'], str):
-            album_dict['album_name'] = album['name']
-        else:
-            album_dict['album_name'] = None
-
-        if len(album['external_urls']['spotify']) > 0 and isinstance(album['external_urls']['spotify'], str):
-            album_dict['external_url'] = album['external_urls']['spotify']
-        else:
-            album_dict['external_url'] = None
+    for album_dict in iter_album_info(artist_id, spotify):
+        complete_albums_dict[album_dict['album_id']] = album_dict
 
-        if len(album['images'][0]['url']) > 0 and isinstance(album['images'][0]['url'], str):
-            album_dict['image_url'] = album['images'][0]['url']
-        else:
-            album_dict['image_url'] = None
-
-        # Album release dates vary in precision
-        release_str = album['release_date']
-        if len(release_str) == 4:
-            # release date is year only
-            album_dict['release_date'] = datetime.strptime(release_str, '%Y')
-        elif len(release_str) == 7:
-            # release date is year and month only
-            album_dict['release_date'] = datetime.strptime(release_str, '%Y-%m')
-        elif len(release_str) == 10:
-            # release date is year, month, and day
-            album_dict['release_date'] = datetime.strptime(release_str, '%Y-%m-%d')
-        else:
-            album_dict['release_date'] = None
+    # if the search returns no results, there will be nothing in the dictionary
+    if len(complete_albums_dict) == 0:
+        raise Exception('No albums returned for this artist')
 
-        if isinstance(album['total_tracks'], int):
-            album_dict['total_tracks'] = album['total_tracks']
-        else:
-            album_dict['total_tracks'] = None
+    return complete_albums_dict
 
-        if len(album['album_type']) > 0 and isinstance(album['album_type'], str):
-            album_dict['type'] = album['album_type']
-        else:
-            album_dict['type'] = None
+def iter_album_info(artist_id: str, spotify: SpotifyClient = None):
+    """
+    Yields validated album information for an artist one album at a time, reading every page of results
 
-        if len(album['uri']) > 0 and isinstance(album['uri'], str):
-            album_dict['album_uri'] = album['uri']
-        else:
-            album_dict['album_uri'] = None
+    :param artist_id: ID (string) for artist as retrieved by get_artist_ids
+    :param spotify: shared Spotify client; the session-wide client is used if none is given
+    :return: generator of album dictionaries
+    """
 
-        album_dict['artist_id'] = artist_id
+    if spotify is None:
+        spotify = get_spotify_client()
 
-        complete_albums_dict[album['id']] = album_dict
+    def fetch_page(offset: int) -> dict:
+        return spotify.artist_albums(artist_id=artist_id, country='US', limit=PAGE_LIMIT, offset=offset)
 
-    return complete_albums_dict
+    # each page of albums is validated against the album schema as a batch
+    yield from ALBUM_SCHEMA.iter_rows(iter_pages(fetch_page(0), fetch_page, spotify), batch_size=PAGE_LIMIT,
+                                      artist_id=artist_id)
 
-def make_album_table(artist_ids: list) -> pd.DataFrame:
+def make_album_table(artist_ids: list, spotify: SpotifyClient = None) -> pd.DataFrame:
     """
     Takes the list of artist IDs and returns a pandas DataFrame of all albums
 
     :param artist_ids: list of strings of artist IDs
+    :param spotify: shared Spotify client, passed on to every request
     :return: pd.DataFrame of all album info
     """
 
-    album_dict = {}
+    return rows_to_table(iter_album_rows(artist_ids, spotify), 'album')
 
-    for id in artist_ids:
-        album_info = get_album_info(id)
-        for album_id in album_info.keys():
-            album_dict[album_id] = album_info[album_id]
-
-    album_table = pd.DataFrame.from_dict(album_dict, orient='index')
+def iter_album_rows(artist_ids: list, spotify: SpotifyClient = None):
+    """
+    Yields the album info for every album of every artist
 
-    # clean up the df
-    album_table.reset_index(inplace=True)
-    album_table.drop('index', axis=1, inplace=True)
+    :param artist_ids: list of strings of artist IDs
+    :param spotify: shared Spotify client, passed on to every request
+    :return: generator of album dictionaries
+    """
 
-    return album_table
+    # an artist listed twice is only requested once
+    for id in dict.fromkeys(artist_ids):
+        albums_found = 0
+        for album_info in iter_album_info(id, spotify):
+            yield album_info
+            albums_found += 1
+        if albums_found == 0:
+            raise Exception('No albums returned for this artist')
 
 def get_album_ids(album_table: pd.DataFrame) -> list:
     """
@@ -281,107 +488,129 @@ def get_album_ids(album_table: pd.DataFrame) -> list:
 # **********
 # TRACK functions
 
-def get_track_info(album_id: str) -> dict:
+def get_track_info(album_id: str, spotify: SpotifyClient = None) -> dict:
     """
     Gets track information from the Spotify API
 
     :param album_id: ID (string) for album as retrieved by get_album_ids
+    :param spotify: shared Spotify client; the session-wide client is used if none is given
     :return: dictionary of all available track information for album
     """
 
-    spotify = spotipy.Spotify(auth_manager=SpotifyClientCredentials())
-    results = spotify.album_tracks(album_id=album_id, limit=50)
-    tracks = results['items']
+    # create dictionary of track details
+    complete_tracks_dict = {}
 
-    # if the search returns no results, items will be an empty list
-    if len(tracks) == 0:
+    for track_dict in iter_track_info(album_id, spotify):
+        complete_tracks_dict[track_dict['track_id']] = track_dict
+
+    # if the search returns no results, there will be nothing in the dictionary
+    if len(complete_tracks_dict) == 0:
         # raise Exception('No tracks returned for this album')
         return None
 
-    # create dictionary of track details
-    complete_tracks_dict = {}
+    return complete_tracks_dict
 
-    for track in tracks:
-        track_dict = {}
-        # each item is validated before being inserted into the track_dict dictionary
+def iter_track_info(album_id: str, spotify: SpotifyClient = None, first_page: dict = None):
+    """
+    Yields validated track information for an album one track at a time, reading every page of results
 
-        #     track_id ('id')
-        if len(track['id']) > 0 and isinstance(track['id'], str):
-            track_dict['track_id'] = track['id']
-        else:
-            raise Exception('Album does not have a unique identifier.')
+    :param album_id: ID (string) for album as retrieved by get_album_ids
+    :param spotify: shared Spotify client; the session-wide client is used if none is given
+    :param first_page: first page of the album's tracks if already at hand (e.g. embedded in an album object)
+    :return: generator of track dictionaries
+    """
 
-        #     song_name ('name')
-        if len(track['name']) > 0 and isinstance(track['name'], str):
-            track_dict['song_name'] = track['name']
-        else:
-            track_dict['song_name'] = None
+    if spotify is None:
+        spotify = get_spotify_client()
 
-        #     external_url ('external_urls'['spotify'])
-        if len(track['external_urls']['spotify']) > 0 and isinstance(track['external_urls']['spotify'], str):
-            track_dict['external_url'] = track['external_urls']['spotify']
-        else:
-            track_dict['external_url'] = None
+    def fetch_page(offset: int) -> dict:
+        return spotify.album_tracks(album_id=album_id, limit=PAGE_LIMIT, offset=offset)
 
-        #     duration_ms ('duration_ms')
-        if isinstance(track['duration_ms'], int):
-            track_dict['duration_ms'] = track['duration_ms']
-        else:
-            track_dict['duration_ms'] = None
+    if first_page is None:
+        first_page = fetch_page(0)
 
-        #     explicit ('explicit')
-        if isinstance(track['explicit'], bool):
-            track_dict['explicit'] = track['explicit']
-        else:
-            track_dict['explicit'] = None
+    # each page of tracks is validated against the track schema as a batch
+    yield from TRACK_SCHEMA.iter_rows(iter_pages(first_page, fetch_page, spotify), batch_size=PAGE_LIMIT,
+                                      album_id=album_id)
 
-        #     disc_number ('disc_number')
-        if isinstance(track['disc_number'], int):
-            track_dict['disc_number'] = track['disc_number']
-        else:
-            track_dict['disc_number'] = None
+def get_track_info_batch(album_ids: list, spotify: SpotifyClient = None) -> dict:
+    """
+    Gets track information from the Spotify API for many albums at once, using the several-albums endpoint
+    (SEVERAL_ALBUMS_BATCH_SIZE album IDs per request) and the track listing embedded in each album
 
-        #     type ('type')
-        if len(track['type']) > 0 and isinstance(track['type'], str):
-            track_dict['type'] = track['type']
-        else:
-            track_dict['type'] = None
+    :param album_ids: list of strings of album IDs
+    :param spotify: shared Spotify client; the session-wide client is used if none is given
+    :return: dictionary keyed by album ID of the same dictionaries get_track_info returns
+    """
 
-        #     song_uri ('uri')
-        if len(track['uri']) > 0 and isinstance(track['uri'], str):
-            track_dict['song_uri'] = track['uri']
-        else:
-            track_dict['song_uri'] = None
+    if spotify is None:
+        spotify = get_spotify_client()
+
+    # an album asked for twice is only requested once
+    album_ids = list(dict.fromkeys(album_ids))
+    complete_albums_dict = {}
 
-        #     album_id
-        track_dict['album_id'] = album_id
+    for start in range(0, len(album_ids), SEVERAL_ALBUMS_BATCH_SIZE):
+        chunk = album_ids[start:start + SEVERAL_ALBUMS_BATCH_SIZE]
+        results = spotify.albums(chunk)['albums']
 
-        complete_tracks_dict[track_dict['track_id']] = track_dict
+        if len(results) != len(chunk):
+            raise Exception(f'Several-albums response does not match the {len(chunk)} album IDs requested.')
 
-    return complete_tracks_dict
+        for album_id, album in zip(chunk, results):
+            # unknown album IDs come back as null
+            if album is None:
+                complete_albums_dict[album_id] = None
+                continue
+
+            # Only albums with more tracks than are embedded need further requests
+            complete_tracks_dict = {}
+            for track_dict in iter_track_info(album_id, spotify, first_page=album['tracks']):
+                complete_tracks_dict[track_dict['track_id']] = track_dict
 
-def make_track_table(album_ids: list) -> pd.DataFrame:
+            if len(complete_tracks_dict) == 0:
+                complete_albums_dict[album_id] = None
+            else:
+                complete_albums_dict[album_id] = complete_tracks_dict
+
+    return complete_albums_dict
+
+def make_track_table(album_ids: list, spotify: SpotifyClient = None, batch_albums: bool = True) -> pd.DataFrame:
     """
     Takes the list of album IDs and returns a pandas DataFrame of all tracks for all albums
 
     :param album_ids: list of strings of album IDs
+    :param spotify: shared Spotify client, passed on to every request
+    :param batch_albums: fetch albums SEVERAL_ALBUMS_BATCH_SIZE at a time instead of one request per album
     :return: pd.DataFrame of all track info
     """
 
-    track_dict = {}
-
-    for id in album_ids:
-        track_info = get_track_info(id)
-        for track_id in track_info.keys():
-            track_dict[track_id] = track_info[track_id]
+    return rows_to_table(iter_track_rows(album_ids, spotify, batch_albums), 'track')
 
-    track_table = pd.DataFrame.from_dict(track_dict, orient='index')
+def iter_track_rows(album_ids: list, spotify: SpotifyClient = None, batch_albums: bool = True):
+    """
+    Yields the track info for every track of every album
 
-    # clean up the df
-    track_table.reset_index(inplace=True)
-    track_table.drop('index', axis=1, inplace=True)
+    :param album_ids: list of strings of album IDs
+    :param spotify: shared Spotify client, passed on to every request
+    :param batch_albums: fetch albums SEVERAL_ALBUMS_BATCH_SIZE at a time instead of one request per album
+    :return: generator of track dictionaries
+    """
 
-    return track_table
+    album_ids = list(dict.fromkeys(album_ids))
+
+    if batch_albums:
+        # one batch of albums at a time, so only that batch's tracks are ever held in memory
+        for start in range(0, len(album_ids), SEVERAL_ALBUMS_BATCH_SIZE):
+            album_tracks = get_track_info_batch(album_ids[start:start + SEVERAL_ALBUMS_BATCH_SIZE], spotify)
+            for track_info in album_tracks.values():
+                # albums without any tracks contribute nothing to the table
+                if track_info is None:
+                    continue
+                yield from track_info.values()
+    else:
+        for id in album_ids:
+            yield from iter_track_info(id, spotify)
 
 def get_track_ids(track_table: pd.DataFrame) -> list:
     """
@@ -398,15 +627,17 @@ def get_track_ids(track_table: pd.DataFrame) -> list:
 # **********
 # TRACK_FEATURE functions
 
-def get_track_features_info(track_id: str) -> dict:
+def get_track_features_info(track_id: str, spotify: SpotifyClient = None) -> dict:
     """
     Gets track feature information from the Spotify API
 
     :param track_id: ID (string) for track as retrieved by get_track_ids
+    :param spotify: shared Spotify client; the session-wide client is used if none is given
     :return: dictionary of all available track feature information for track
     """
 
-    spotify = spotipy.Spotify(auth_manager=SpotifyClientCredentials())
+    if spotify is None:
+        spotify = get_spotify_client()
     track_features = spotify.audio_features(tracks=[track_id])[0]
     # track_features = results['items']
 
@@ -415,148 +646,503 @@ def get_track_features_info(track_id: str) -> dict:
         # raise Exception('No tracks returned for this album')
         return {}
 
-    track_features_dict = {}
-    # each item is validated before being inserted into the track_features_dict dictionary
+    return TRACK_FEATURE_SCHEMA.validate_one(track_features) or {}
 
-    #     track_id ('id')
-    if len(track_features['id']) > 0 and isinstance(track_features['id'], str):
-        track_features_dict['track_id'] = track_features['id']
-    else:
-        raise Exception('Album does not have a unique identifier.')
-
-    #     danceability ('danceability')
-    if isinstance(track_features['danceability'], float):
-        track_features_dict['danceability'] = track_features['danceability']
-    else:
-        track_features_dict['danceability'] = None
-
-    #     energy ('energy')
-    if isinstance(track_features['energy'], float):
-        track_features_dict['energy'] = track_features['energy']
-    else:
-        track_features_dict['energy'] = None
-
-    #     instrumentalness ('instrumentalness')
-    if isinstance(track_features['instrumentalness'], float):
-        track_features_dict['instrumentalness'] = track_features['instrumentalness']
-    else:
-        track_features_dict['instrumentalness'] = None
-
-    #     liveness ('liveness')
-    if isinstance(track_features['liveness'], float):
-        track_features_dict['liveness'] = track_features['liveness']
-    else:
-        track_features_dict['liveness'] = None
+def get_track_features_batch(track_ids: list, spotify: SpotifyClient = None) -> dict:
+    """
+    Gets track feature information from the Spotify API for many tracks at once,
+    AUDIO_FEATURES_BATCH_SIZE track IDs per request
 
-    #     loudness ('loudness')
-    if isinstance(track_features['loudness'], float):
-        track_features_dict['loudness'] = track_features['loudness']
-    else:
-        track_features_dict['loudness'] = None
+    :param track_ids: list of strings of track IDs
+    :param spotify: shared Spotify client; the session-wide client is used if none is given
+    :return: dictionary keyed by track ID of track feature information, None for tracks Spotify doesn't know
+    """
 
-    #     speechiness ('speechiness')
-    if isinstance(track_features['speechiness'], float):
-        track_features_dict['speechiness'] = track_features['speechiness']
-    else:
-        track_features_dict['speechiness'] = None
+    if spotify is None:
+        spotify = get_spotify_client()
 
-    #     tempo ('tempo')
-    if isinstance(track_features['tempo'], float):
-        track_features_dict['tempo'] = track_features['tempo']
-    else:
-        track_features_dict['tempo'] = None
+    # a track asked for twice is only requested once
+    track_ids = list(dict.fromkeys(track_ids))
+    complete_features_dict = {}
 
-    #     type ('type')
-    if len(track_features['type']) > 0 and isinstance(track_features['type'], str):
-        track_features_dict['type'] = track_features['type']
-    else:
-        track_features_dict['type'] = None
+    for start in range(0, len(track_ids), AUDIO_FEATURES_BATCH_SIZE):
+        chunk = track_ids[start:start + AUDIO_FEATURES_BATCH_SIZE]
+        results = spotify.audio_features(tracks=chunk)
 
-    #     valence ('valence')
-    if isinstance(track_features['valence'], float):
-        track_features_dict['valence'] = track_features['valence']
-    else:
-        track_features_dict['valence'] = None
+        # The API answers with one entry per requested ID, in request order, and null for unknown tracks
+        if not isinstance(results, list) or len(results) != len(chunk):
+            raise Exception(f'Audio features response does not match the {len(chunk)} track IDs requested.')
 
-    #     song_uri ('uri')
-    if len(track_features['uri']) > 0 and isinstance(track_features['uri'], str):
-        track_features_dict['song_uri'] = track_features['uri']
-    else:
-        track_features_dict['song_uri'] = None
+        for track_id in chunk:
+            complete_features_dict[track_id] = None
+        # the whole batch is validated against the track feature schema at once;
+        # each result is then mapped back by its own ID rather than trusting its position in the list
+        found = [track_features for track_features in results if track_features]
+        for track_features_info in TRACK_FEATURE_SCHEMA.validate_rows(found):
+            if track_features_info['track_id'] in complete_features_dict:
+                complete_features_dict[track_features_info['track_id']] = track_features_info
 
-    return track_features_dict
+    return complete_features_dict
 
-def make_track_features_table(track_ids: list) -> pd.DataFrame:
+def make_track_features_table(track_ids: list, spotify: SpotifyClient = None) -> pd.DataFrame:
     """
     Takes the list of track IDs and returns a pandas DataFrame of all features for all tracks
 
     :param track_ids: list of strings of track IDs
+    :param spotify: shared Spotify client, passed on to every request
     :return: pd.DataFrame of all track features
     """
 
-    track_features_dict = {}
+    return rows_to_table(iter_track_features_rows(track_ids, spotify), 'track_feature')
 
-    for id in track_ids:
-        track_features_info = get_track_features_info(id)
-        track_features_dict[id] = track_features_info
+def iter_track_features_rows(track_ids: list, spotify: SpotifyClient = None):
+    """
+    Yields the track features for every track which has them
 
-    track_features_table = pd.DataFrame.from_dict(track_features_dict, orient='index')
+    :param track_ids: list of strings of track IDs
+    :param spotify: shared Spotify client, passed on to every request
+    :return: generator of track feature dictionaries
+    """
 
-    # clean up the df
-    track_features_table.reset_index(inplace=True)
-    track_features_table.drop('index', axis=1, inplace=True)
+    track_ids = list(dict.fromkeys(track_ids))
 
-    return track_features_table
+    # Tracks are requested in batches; tracks without audio features are left out of the table
+    for start in range(0, len(track_ids), AUDIO_FEATURES_BATCH_SIZE):
+        track_features_info = get_track_features_batch(track_ids[start:start + AUDIO_FEATURES_BATCH_SIZE], spotify)
+        for features in track_features_info.values():
+            if features is not None:
+                yield features
 
 # **********
 # INGEST pipeline
 
-def ingest(artist_list: list):
+def print_validation_stats():
+    """
+    Reports how many values of each table failed validation during the run
+    """
+
+    for schema in VALIDATION_SCHEMAS.values():
+        print(f'\t{schema.rejection_summary()}')
+
+def print_cache_stats(spotify: SpotifyClient):
+    """
+    Reports how the API calls were spread across the sets of credentials, and how many calls (or IDs of batched
+    calls) were shared with one in flight or answered from the on-disk response cache
+
+    :param spotify: client used for the run
+    """
+
+    shards = getattr(spotify, 'shards', [])
+    if len(shards) > 1:
+        for number, shard in enumerate(shards, start=1):
+            print(f'Credentials {number}: {shard.requests} requests, {shard.throttled} throttled')
+
+    coalesced = getattr(spotify, 'coalesced', 0)
+    if coalesced > 0:
+        print(f'Calls and batched IDs already in flight: {coalesced} answered without a request of their own')
+
+    cache = getattr(spotify, 'cache', None)
+    if cache is None:
+        return
+
+    stats = cache.stats()
+    print(f'Response cache: {stats["hits"]} hits, {stats["misses"]} misses '
+          f'({round(stats["hit_rate"] * 100, 1)}% hit rate), {round(stats["bytes"] / 1024 / 1024, 2)} MB stored')
+
+def ingest(artist_list: list, spotify: SpotifyClient = None, incremental: bool = False, resume: bool = False):
+    """
+    Retrieves artist, album, track and track feature info and stores each table in the raw_data directory
+
+    :param artist_list: list of strings of artist/band names
+    :param spotify: shared Spotify client; the session-wide client is used if none is given
+    :param incremental: start from the feathers already in raw_data, only descending into albums and tracks
+                        whose IDs are new, and carrying the unchanged rows forward; album listings are always
+                        requested afresh, never answered from the response cache
+    :param resume: pick up an interrupted run from its checkpoints, skipping the IDs it already fetched
+    """
 
     # Here's the pipeline!
     t0 = time.time()
 
-    # First we create a pd.DataFrame of all the artist info
+    # Every stage shares one client, so the whole run reuses a handful of pooled connections and a single token
+    if spotify is None:
+        spotify = get_spotify_client()
+
+    # For an incremental run, the earlier run's tables tell us which albums and tracks we already have.
+    # These tables are about to be overwritten, so their IDs are read up front and kept with the checkpoints,
+    # where a resumed run finds the same IDs again.
+    incremental = incremental and os.path.isfile('raw_data/track.feather')
+    if incremental:
+        known_album_ids = load_known_ids('album', lambda: read_stored_ids('album'), resume)
+        known_track_ids = load_known_ids('track_feature', lambda: read_stored_ids('track_feature'), resume)
+
+    # Album listings cached by an earlier run, even a recent one, wouldn't show what was released since
+    if incremental and getattr(spotify, 'cache', None) is not None:
+        spotify.cache.expire(INCREMENTAL_REFRESH_ENDPOINTS)
+
+    # Each stage streams its rows through checkpoint chunks into its raw feather, in record batches,
+    # so no stage holds a whole table in memory; the next stage only reads back the ID column.
+
+    # First we retrieve all the artist info
     t1 = time.time()
-    artist = make_artist_table(artist_list)
-    # Store the pd.DataFrame for transform access
-    artist.to_feather('raw_data/artist.feather')
-    print(f'Artist info for {artist.shape[0]} artists retrieved and stored successfully.\n'
+    checkpoint = run_checkpointed('artist', artist_list, iter_artist_rows, RAW_SCHEMAS['artist'], 'artist_id',
+                                  resume, spotify=spotify)
+    # Store the table for transform access
+    artist_count = store_table('artist', checkpoint.iter_batches())
+    print(f'Artist info for {artist_count} artists retrieved and stored successfully.\n'
           f'\tTotal time: {round(time.time() - t1, 2)}s')
 
     # In order to retrieve album info, we need artist ids from the artist table in a list
-    artist_ids = get_artist_ids(artist)
+    artist_ids = read_stored_ids('artist')
 
-    # Next we create a pd.DataFrame of all the album info (multiple albums per artist)
+    # Next we retrieve all the album info (multiple albums per artist)
     t1 = time.time()
-    album = make_album_table(artist_ids)
-    album.to_feather('raw_data/album.feather')
-    print(f'Album info for {album.shape[0]} albums retrieved and stored successfully.\n'
+    checkpoint = run_checkpointed('album', artist_ids, iter_album_rows, RAW_SCHEMAS['album'], 'album_id',
+                                  resume, spotify=spotify)
+    album_count = store_table('album', checkpoint.iter_batches())
+    print(f'Album info for {album_count} albums retrieved and stored successfully.\n'
           f'\tTotal time: {round(time.time() - t1, 2)}s')
 
     # In order to retrieve track info, we need album ids from the album table in a list
-    album_ids = get_album_ids(album)
+    album_ids = read_stored_ids('album')
 
-    # Next we create a pd.DataFrame of all the track info (multiple tracks per album)
+    # Next we retrieve all the track info (multiple tracks per album)
     t1 = time.time()
-    track = make_track_table(album_ids)
-    track.to_feather('raw_data/track.feather')
-    print(f'Track info for {track.shape[0]} tracks retrieved and stored successfully.\n'
+    if incremental:
+        # only albums we haven't seen before need their tracks fetched; freshly fetched rows are written first,
+        # so they win over the earlier run's rows
+        new_album_ids = [id for id in album_ids if id not in known_album_ids]
+        print(f'\t{len(new_album_ids)} new albums since the last run.')
+        checkpoint = run_checkpointed('track', new_album_ids, iter_track_rows, RAW_SCHEMAS['track'], 'track_id',
+                                      resume, spotify=spotify)
+        track_count = store_table('track', checkpoint.iter_batches(),
+                                  iter_previous_batches('track', 'album_id', album_ids))
+    else:
+        checkpoint = run_checkpointed('track', album_ids, iter_track_rows, RAW_SCHEMAS['track'], 'track_id',
+                                      resume, spotify=spotify)
+        track_count = store_table('track', checkpoint.iter_batches())
+    print(f'Track info for {track_count} tracks retrieved and stored successfully.\n'
           f'\tTotal time: {round(time.time() - t1, 2)}s')
 
     # In order to retrieve track features, we need track ids from the track table in a list
-    track_ids = get_track_ids(track)
+    track_ids = read_stored_ids('track')
 
-    # Finally we create at pd.DataFrame of all the track features (multiple features per track)
+    # Finally we retrieve all the track features (multiple features per track)
     t1 = time.time()
-    track_feature = make_track_features_table(track_ids)
-    track_feature.to_feather('raw_data/track_feature.feather')
-    print(f'Track feature info for {track_feature.shape[0]} tracks retrieved and stored successfully.\n'
+    if incremental:
+        # audio features never change, so only tracks we haven't seen before need them fetched
+        new_track_ids = [id for id in track_ids if id not in known_track_ids]
+        print(f'\t{len(new_track_ids)} new tracks since the last run.')
+        checkpoint = run_checkpointed('track_feature', new_track_ids, iter_track_features_rows,
+                                      RAW_SCHEMAS['track_feature'], 'track_id', resume, spotify=spotify)
+        track_feature_count = store_table('track_feature', checkpoint.iter_batches(),
+                                          iter_previous_batches('track_feature', 'track_id', track_ids))
+    else:
+        checkpoint = run_checkpointed('track_feature', track_ids, iter_track_features_rows,
+                                      RAW_SCHEMAS['track_feature'], 'track_id', resume, spotify=spotify)
+        track_feature_count = store_table('track_feature', checkpoint.iter_batches())
+    print(f'Track feature info for {track_feature_count} tracks retrieved and stored successfully.\n'
           f'\tTotal time: {round(time.time() - t1, 2)}s')
 
+    # Every table is stored, so the partial results are no longer needed
+    clear_checkpoints()
+
+    print_validation_stats()
+    print_cache_stats(spotify)
     print(f'Ingest completed successfully. Total ingest time: {round(time.time() - t0, 2)}s')
 
 
+# **********
+# ASYNC INGEST pipeline
+
+# Default number of API requests allowed in flight at once during ingest_async
+DEFAULT_MAX_CONCURRENCY = 8
+
+async def run_limited(semaphore: asyncio.Semaphore, function, *args):
+    """
+    Runs a blocking API function in a worker thread once the semaphore lets it through
+
+    :param semaphore: asyncio.Semaphore bounding the number of requests in flight
+    :param function: blocking function to run
+    :param args: positional arguments for the function
+    :return: whatever the function returns
+    """
+
+    async with semaphore:
+        return await asyncio.to_thread(function, *args)
+
+async def ingest_async_stages(artist_list: list, spotify: SpotifyClient, max_concurrency: int):
+    """
+    Runs the four stages of the ingest one after the other, as ingest() does, but with every request of a stage
+    in flight at once, up to max_concurrency: artist names are resolved, then the artists fetched in
+    several-artists batches, then album listings requested for every artist, then tracks for every batch of
+    albums, then audio features for every batch of tracks. Each stage stores its raw feather before the next
+    one reads back its IDs.
+
+    :param artist_list: list of strings of artist/band names
+    :param spotify: shared Spotify client
+    :param max_concurrency: maximum number of requests running at the same time
+    """
+
+    # Here's the pipeline!
+    t0 = time.time()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    # asyncio.to_thread runs on the loop's default executor, which needs a worker for every request in flight
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=max_concurrency))
+
+    # First every artist name is resolved to an ID at once, then the artists are fetched in several-artists batches
+    t1 = time.time()
+    artist_ids = await asyncio.gather(*[run_limited(semaphore, resolve_artist_id, name, spotify)
+                                        for name in artist_list])
+    # artists the search can't find are left out
+    artist_ids = [id for id in artist_ids if id is not None]
+    unique_artist_ids = list(dict.fromkeys(artist_ids))
+    artist_chunks = [unique_artist_ids[i:i + SEVERAL_ARTISTS_BATCH_SIZE]
+                     for i in range(0, len(unique_artist_ids), SEVERAL_ARTISTS_BATCH_SIZE)]
+    artists_info = {}
+    for chunk_info in await asyncio.gather(*[run_limited(semaphore, get_artist_info_batch, chunk, spotify)
+                                             for chunk in artist_chunks]):
+        artists_info.update(chunk_info)
+    artist_count = store_rows('artist', [artists_info[id] for id in artist_ids if artists_info[id] is not None])
+    print(f'Artist info for {artist_count} artists retrieved and stored successfully.\n'
+          f'\tTotal time: {round(time.time() - t1, 2)}s')
+
+    artist_ids = read_stored_ids('artist')
+
+    # Album listings are requested for every artist at once; results are merged in artist order as in ingest()
+    t1 = time.time()
+    album_results = await asyncio.gather(*[run_limited(semaphore, get_album_info, id, spotify)
+                                           for id in artist_ids])
+    album_count = store_rows('album', [album for album_info in album_results for album in album_info.values()])
+    print(f'Album info for {album_count} albums retrieved and stored successfully.\n'
+          f'\tTotal time: {round(time.time() - t1, 2)}s')
+
+    album_ids = read_stored_ids('album')
+
+    # Tracks are requested one several-albums batch per task
+    t1 = time.time()
+    album_chunks = [album_ids[i:i + SEVERAL_ALBUMS_BATCH_SIZE]
+                    for i in range(0, len(album_ids), SEVERAL_ALBUMS_BATCH_SIZE)]
+    track_results = await asyncio.gather(*[run_limited(semaphore, get_track_info_batch, chunk, spotify)
+                                           for chunk in album_chunks])
+    # albums without any tracks contribute nothing to the table
+    track_count = store_rows('track', [track for album_tracks in track_results for track_info in album_tracks.values()
+                                       if track_info is not None for track in track_info.values()])
+    print(f'Track info for {track_count} tracks retrieved and stored successfully.\n'
+          f'\tTotal time: {round(time.time() - t1, 2)}s')
+
+    track_ids = read_stored_ids('track')
+
+    # Finally the audio features, one batch of track IDs per task
+    t1 = time.time()
+    track_chunks = [track_ids[i:i + AUDIO_FEATURES_BATCH_SIZE]
+                    for i in range(0, len(track_ids), AUDIO_FEATURES_BATCH_SIZE)]
+    feature_results = await asyncio.gather(*[run_limited(semaphore, get_track_features_batch, chunk, spotify)
+                                             for chunk in track_chunks])
+    track_feature_count = store_rows('track_feature', [features for track_features_info in feature_results
+                                                       for features in track_features_info.values()
+                                                       if features is not None])
+    print(f'Track feature info for {track_feature_count} tracks retrieved and stored successfully.\n'
+          f'\tTotal time: {round(time.time() - t1, 2)}s')
+
+    print_validation_stats()
+    print_cache_stats(spotify)
+    print(f'Async ingest completed successfully. Total ingest time: {round(time.time() - t0, 2)}s')
+
+def ingest_async(artist_list: list, max_concurrency: int = DEFAULT_MAX_CONCURRENCY, spotify: SpotifyClient = None):
+    """
+    Runs the same ingest as ingest(), writing the same four raw feathers, but with up to max_concurrency
+    API requests in flight at once
+
+    :param artist_list: list of strings of artist/band names
+    :param max_concurrency: maximum number of requests running at the same time
+    :param spotify: shared Spotify client; one with a large enough connection pool is created if none is given
+    """
+
+    # Each request in flight needs its own pooled connection
+    if spotify is None:
+        spotify = create_spotify_client(pool_size=max(DEFAULT_POOL_SIZE, max_concurrency * PAGE_PREFETCH))
+
+    asyncio.run(ingest_async_stages(artist_list, spotify, max_concurrency))
+
+
+# **********
+# PIPELINED INGEST
+
+# Default number of workers fetching albums, tracks and track features, each
+DEFAULT_PIPELINE_WORKERS = 4
+
+async def ingest_pipelined_stages(artist_list: list, spotify: SpotifyClient, workers: int, queue_size: int):
+    """
+    Runs the stages of the ingest at the same time, connected by bounded queues: artists are fetched in
+    several-artists batches as their names are resolved, and every artist found is queued for the album workers, every batch of newly found albums for the track workers, and every batch of newly
+    found tracks for the feature workers. Rows are written to the four raw feathers as they arrive, which
+    replace the old ones once every stage has finished; if any stage fails, the old feathers are left as they were
+    and the stage's error is raised.
+
+    :param artist_list: list of strings of artist/band names
+    :param spotify: shared Spotify client
+    :param workers: number of workers per stage
+    :param queue_size: maximum number of batches waiting between two stages
+    """
+
+    # Here's the pipeline!
+    # Instead of waiting for a whole stage to finish, every artist's album IDs flow straight into the track queue,
+    # and track IDs flow in batches into the feature queue, so the network waits of all stages overlap.
+    # The queues are bounded: a stage which runs ahead waits for the next one to catch up.
+    t0 = time.time()
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=4 * workers))
+    main_task = asyncio.current_task()
+
+    album_queue = asyncio.Queue(maxsize=queue_size)
+    track_queue = asyncio.Queue(maxsize=queue_size)
+    feature_queue = asyncio.Queue(maxsize=queue_size)
+
+    # Rows go straight into their feathers; a writer skips IDs it has already written,
+    # and only newly written IDs are passed on to the next stage
+    writers = {table_name: FeatherBatchWriter(f'raw_data/{table_name}.feather', RAW_SCHEMAS[table_name],
+                                              key_column=RAW_KEYS[table_name])
+               for table_name in RAW_SCHEMAS}
+    pending_track_ids = []
+    stage_times = {}
+    errors = []
+
+    async def album_worker():
+        while True:
+            artist_id = await album_queue.get()
+            if artist_id is None:
+                return
+            album_info = await asyncio.to_thread(get_album_info, artist_id, spotify)
+            new_album_ids = [album_id for album_id, album in album_info.items() if writers['album'].append(album)]
+            for start in range(0, len(new_album_ids), SEVERAL_ALBUMS_BATCH_SIZE):
+                await track_queue.put(new_album_ids[start:start + SEVERAL_ALBUMS_BATCH_SIZE])
+
+    async def track_worker():
+        while True:
+            album_ids = await track_queue.get()
+            if album_ids is None:
+                return
+            album_tracks = await asyncio.to_thread(get_track_info_batch, album_ids, spotify)
+            for track_info in album_tracks.values():
+                # albums without any tracks contribute nothing to the table
+                if track_info is None:
+                    continue
+                for track_id, track in track_info.items():
+                    if writers['track'].append(track):
+                        pending_track_ids.append(track_id)
+            while len(pending_track_ids) >= AUDIO_FEATURES_BATCH_SIZE:
+                track_ids = pending_track_ids[:AUDIO_FEATURES_BATCH_SIZE]
+                del pending_track_ids[:AUDIO_FEATURES_BATCH_SIZE]
+                await feature_queue.put(track_ids)
+
+    async def feature_worker():
+        while True:
+            track_ids = await feature_queue.get()
+            if track_ids is None:
+                return
+            track_features_info = await asyncio.to_thread(get_track_features_batch, track_ids, spotify)
+            for features in track_features_info.values():
+                if features is not None:
+                    writers['track_feature'].append(features)
+
+    def start(worker) -> asyncio.Task:
+        # a failing worker stops the whole pipeline instead of leaving the others waiting on its queue
+        async def supervised():
+            try:
+                await worker()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                errors.append(e)
+                main_task.cancel()
+        return asyncio.create_task(supervised())
+
+    async def finish_stage(queue: asyncio.Queue, tasks: list, stage: str):
+        for _ in tasks:
+            await queue.put(None)
+        await asyncio.gather(*tasks)
+        stage_times[stage] = time.time() - t0
+
+    album_tasks = [start(album_worker) for _ in range(workers)]
+    track_tasks = [start(track_worker) for _ in range(workers)]
+    feature_tasks = [start(feature_worker) for _ in range(workers)]
+    try:
+        # Artist names are resolved concurrently; every several-artists batch of IDs is fetched as soon as it fills
+        # up, and its artists handed to the album workers
+        semaphore = asyncio.Semaphore(workers)
+        lookups = [run_limited(semaphore, resolve_artist_id, name, spotify) for name in artist_list]
+        pending_artist_ids = []
+
+        async def store_artists(artist_ids: list):
+            artists_info = await asyncio.to_thread(get_artist_info_batch, artist_ids, spotify)
+            for artist_id in artist_ids:
+                artist_info = artists_info[artist_id]
+                if artist_info is not None and writers['artist'].append(artist_info):
+                    await album_queue.put(artist_id)
+
+        for lookup in asyncio.as_completed(lookups):
+            artist_id = await lookup
+            # artists the search can't find are left out
+            if artist_id is not None:
+                pending_artist_ids.append(artist_id)
+            if len(pending_artist_ids) == SEVERAL_ARTISTS_BATCH_SIZE:
+                await store_artists(pending_artist_ids[:])
+                pending_artist_ids.clear()
+        if len(pending_artist_ids) > 0:
+            await store_artists(pending_artist_ids)
+        stage_times['artist'] = time.time() - t0
+
+        await finish_stage(album_queue, album_tasks, 'album')
+        await finish_stage(track_queue, track_tasks, 'track')
+        # the last, partial batch of track IDs
+        if len(pending_track_ids) > 0:
+            await feature_queue.put(list(pending_track_ids))
+            pending_track_ids.clear()
+        await finish_stage(feature_queue, feature_tasks, 'track_feature')
+    except BaseException as e:
+        # whatever stopped the pipeline, the feathers already in raw_data are left as they were
+        for writer in writers.values():
+            writer.abort()
+        # a worker's failure reaches this task as a cancellation, so its own error is raised instead
+        if isinstance(e, asyncio.CancelledError) and len(errors) > 0:
+            raise errors[0]
+        raise
+    finally:
+        for task in album_tasks + track_tasks + feature_tasks:
+            task.cancel()
+
+    for table_name, writer in writers.items():
+        rows = writer.close()
+        print(f'{table_name} info for {rows} rows retrieved and stored successfully.\n'
+              f'\tStage finished after: {round(stage_times[table_name], 2)}s')
+
+    print_validation_stats()
+    print_cache_stats(spotify)
+    print(f'Pipelined ingest completed successfully. Total ingest time: {round(time.time() - t0, 2)}s')
+
+def ingest_pipelined(artist_list: list, workers: int = DEFAULT_PIPELINE_WORKERS, queue_size: int = None,
+                     spotify: SpotifyClient = None):
+    """
+    Runs the ingest as a pipeline of producer/consumer stages, each with its own worker pool and bounded queue,
+    writing the same four raw feathers as ingest() (rows may come out in a different order)
+
+    :param artist_list: list of strings of artist/band names
+    :param workers: number of workers per stage
+    :param queue_size: maximum number of batches waiting between two stages; twice the workers if not given
+    :param spotify: shared Spotify client; one with a large enough connection pool is created if none is given
+    """
+
+    if queue_size is None:
+        queue_size = 2 * workers
+
+    # Every worker of every stage may have a request in flight
+    if spotify is None:
+        spotify = create_spotify_client(pool_size=max(DEFAULT_POOL_SIZE, 3 * workers * PAGE_PREFETCH))
+
+    asyncio.run(ingest_pipelined_stages(artist_list, spotify, workers, queue_size))
+
+
 if __name__ == '__main__':
     artist_list = [
         'hilary hahn',
@@ -1,8 +1,8 @@
 import os
-import pandas as pd
 import sqlite3
 import sqlalchemy
 import time
+from feather_io import read_feather_df
 
 def create_connection():
     try:
@@ -13,18 +13,28 @@ def create_connection():
 
     return conn
 
-def make_table_dict_from_df(directory_path) -> dict:
+def make_table_dict_from_df(directory_path, columns: dict = None) -> dict:
+    """
+    Reads every feather of the directory, each through a memory map of the file
+
+    :param directory_path: folder holding the cleaned feathers
+    :param columns: dictionary of table name to the columns to load of it; every column of a table not in it
+    :return: dictionary of table name to pd.DataFrame
+    """
+
+    columns = {} if columns is None else columns
     filenames = []
     for filename in os.listdir(directory_path):
         f = os.path.join(directory_path, filename)
-        if os.path.isfile(f):
+        # A writer cut short leaves its .feather.partial file behind, which isn't a table to load
+        if os.path.isfile(f) and filename.endswith('.feather'):
             filenames.append(f)
 
     table_dict = {}
     for name in filenames:
         feather_stripped_name = name.split('.')[0]
         table_name = feather_stripped_name[21:]
-        table_dict[table_name] = pd.read_feather(name)
+        table_dict[table_name] = read_feather_df(name, columns.get(table_name))
 
     return table_dict
 
@@ -35,13 +45,13 @@ def create_and_load_tables(tables: dict):
         tables[table].to_sql(table, engine, if_exists='replace', index=False)
     conn.close()
 
-def load(directory_path: str):
+def load(directory_path: str, columns: dict = None):
 
     # Here's the pipeline!
     t0 = time.time()
 
     # First we take all the feather files in the cleaned_data directory and store in a dict of pd.DataFrames
-    table_dict = make_table_dict_from_df(directory_path)
+    table_dict = make_table_dict_from_df(directory_path, columns)
 
     # Then those pd.DataFrames can be loaded into the SQLite database using the SQLAlchemy engine
     # and the pandas native SQL support
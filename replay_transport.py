@@ -0,0 +1,121 @@
+"""
+The purpose of this script is to capture the Spotify API's responses during a real ingest run and play them back
+later, so the same run can be repeated deterministically, at full speed and without a network connection.
+
+"""
+
+import json
+import os
+import threading
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+
+# Access token handed to the client while replaying; tokens are never recorded
+REPLAY_TOKEN = 'replay-token'
+
+# Responses which only say "try again later" aren't worth replaying
+UNRECORDED_STATUSES = (429, 500, 502, 503, 504)
+
+
+class ReplayMissError(requests.exceptions.RequestException):
+    """
+    Raised when a replayed run makes a request the recording doesn't have
+    """
+
+
+def make_request_key(request: requests.PreparedRequest) -> str:
+    """
+    Identifies a request by its method, path and query parameters (in a fixed order). The host is left out,
+    so a run recorded against a stand-in server replays for the live API's URLs and the other way round.
+
+    :param request: request about to be sent
+    :return: key the response is recorded under
+    """
+
+    url = urlsplit(request.url)
+    query = urlencode(sorted(parse_qsl(url.query, keep_blank_values=True)))
+
+    return f'{request.method} {urlunsplit(("", "", url.path.rstrip("/"), query, ""))}'
+
+
+def is_token_request(request: requests.PreparedRequest) -> bool:
+    return urlsplit(request.url).path.rstrip('/') == '/api/token'
+
+
+class RecordReplayAdapter(HTTPAdapter):
+    """
+    Transport adapter which either records every API response it passes on into a JSON lines file,
+    or answers every request from such a file without touching the network
+    """
+
+    def __init__(self, path: str, mode: str, **kwargs):
+        """
+        :param path: JSON lines file the responses are recorded in
+        :param mode: 'record' or 'replay'
+        :param kwargs: passed on to HTTPAdapter (pool size, retries)
+        """
+
+        if mode not in ('record', 'replay'):
+            raise ValueError(f"mode must be 'record' or 'replay', not {mode!r}")
+
+        super().__init__(**kwargs)
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.responses = {}
+
+        if mode == 'replay':
+            with open(path) as recording:
+                for line in recording:
+                    entry = json.loads(line)
+                    # a request recorded more than once is answered with its latest response
+                    self.responses[entry['key']] = entry
+        else:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        if self.mode == 'replay':
+            return self.replay(request)
+
+        response = super().send(request, **kwargs)
+        # the token response holds live credentials, so it is never written down
+        if not is_token_request(request) and response.status_code not in UNRECORDED_STATUSES:
+            self.record(request, response)
+
+        return response
+
+    def record(self, request: requests.PreparedRequest, response: requests.Response):
+        entry = {
+            'key': make_request_key(request),
+            'status': response.status_code,
+            'headers': {'Content-Type': response.headers.get('Content-Type', 'application/json')},
+            'body': response.text
+        }
+        with self.lock:
+            with open(self.path, 'a') as recording:
+                recording.write(json.dumps(entry) + '\n')
+
+    def replay(self, request: requests.PreparedRequest) -> requests.Response:
+        if is_token_request(request):
+            entry = {'status': 200, 'headers': {'Content-Type': 'application/json'},
+                     'body': json.dumps({'access_token': REPLAY_TOKEN, 'token_type': 'Bearer', 'expires_in': 3600})}
+        else:
+            entry = self.responses.get(make_request_key(request))
+            if entry is None:
+                raise ReplayMissError(f'No recorded response for {make_request_key(request)}', request=request)
+
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response._content = entry['body'].encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        response.reason = 'OK' if entry['status'] < 400 else 'Error'
+
+        return response
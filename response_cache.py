@@ -0,0 +1,184 @@
+"""
+The purpose of this script is to keep Spotify API responses on disk, so re-running the ingest doesn't request
+data which hasn't changed.
+
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+
+DAY = 24 * 60 * 60
+
+# How long a cached response stays valid, per endpoint.
+# Audio features of a track never change; album listings of an artist change whenever something is released.
+CACHE_TTLS = {
+    'search': 7 * DAY,
+    'artists': 1 * DAY,
+    'artist_albums': 1 * DAY,
+    'albums': 30 * DAY,
+    'album_tracks': 30 * DAY,
+    'audio_features': 365 * DAY,
+    'next': 1 * DAY
+}
+
+DEFAULT_CACHE_PATH = 'cache/spotify_responses.sqlite'
+
+# Once the stored responses take more than this many (compressed) bytes, the least recently used ones are evicted
+DEFAULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Eviction frees space down to this share of the maximum, so it doesn't run again on the very next insert
+EVICT_TO = 0.9
+
+
+def make_cache_key(endpoint: str, args: tuple, kwargs: dict) -> str:
+    """
+    Hashes an API request into the key its response is stored under
+
+    :param endpoint: name of the API call, e.g. 'audio_features'
+    :param args: positional arguments of the call
+    :param kwargs: keyword arguments of the call
+    :return: hex digest identifying the request
+    """
+
+    request = json.dumps([endpoint, args, kwargs], sort_keys=True, default=str)
+
+    return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite-backed store of zlib-compressed JSON responses, with per-endpoint expiry
+    and least-recently-used eviction by total size
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_bytes: int = DEFAULT_CACHE_MAX_BYTES,
+                 ttls: dict = None):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.max_bytes = max_bytes
+        self.ttls = dict(CACHE_TTLS) if ttls is None else ttls
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS response (
+                key TEXT PRIMARY KEY,
+                endpoint TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL,
+                size INTEGER NOT NULL,
+                body BLOB NOT NULL
+            )''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS response_accessed ON response (accessed)')
+        self.conn.commit()
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM response').fetchone()[0]
+
+    def get(self, endpoint: str, key: str):
+        """
+        Looks up a stored response
+
+        :param endpoint: name of the API call, used to pick the TTL
+        :param key: key from make_cache_key
+        :return: (True, response) if a fresh response is stored, otherwise (False, None)
+        """
+
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT created, size, body FROM response WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return False, None
+
+            created, size, body = row
+            if now - created > self.ttls.get(endpoint, 0):
+                # expired responses are removed straight away
+                self.conn.execute('DELETE FROM response WHERE key = ?', (key,))
+                self.conn.commit()
+                self.total_bytes -= size
+                self.misses += 1
+                return False, None
+
+            self.conn.execute('UPDATE response SET accessed = ? WHERE key = ?', (now, key))
+            self.conn.commit()
+            self.hits += 1
+
+        return True, json.loads(zlib.decompress(body))
+
+    def put(self, endpoint: str, key: str, response):
+        """
+        Stores a response, evicting the least recently used ones if the cache grows past max_bytes
+
+        :param endpoint: name of the API call
+        :param key: key from make_cache_key
+        :param response: decoded JSON response
+        """
+
+        body = zlib.compress(json.dumps(response).encode('utf-8'))
+        now = time.time()
+        with self.lock:
+            old = self.conn.execute('SELECT size FROM response WHERE key = ?', (key,)).fetchone()
+            if old is not None:
+                self.total_bytes -= old[0]
+            self.conn.execute('INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?, ?)',
+                              (key, endpoint, now, now, len(body), body))
+            self.total_bytes += len(body)
+            if self.total_bytes > self.max_bytes:
+                self.evict(int(self.max_bytes * EVICT_TO))
+            self.conn.commit()
+
+    def expire(self, endpoints: list):
+        """
+        Deletes every stored response of the given endpoints, so the next calls to them reach the API
+
+        :param endpoints: names of API calls, e.g. ['artist_albums']
+        """
+
+        with self.lock:
+            for endpoint in endpoints:
+                self.conn.execute('DELETE FROM response WHERE endpoint = ?', (endpoint,))
+            self.conn.commit()
+            self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM response').fetchone()[0]
+
+    def evict(self, target_bytes: int):
+        """
+        Deletes least recently used responses until the cache holds at most target_bytes (caller holds the lock)
+
+        :param target_bytes: size to shrink the cache to
+        """
+
+        evicted = []
+        for key, size in self.conn.execute('SELECT key, size FROM response ORDER BY accessed'):
+            if self.total_bytes <= target_bytes:
+                break
+            evicted.append((key,))
+            self.total_bytes -= size
+        self.conn.executemany('DELETE FROM response WHERE key = ?', evicted)
+
+    def stats(self) -> dict:
+        """
+        Reports how well the cache has been doing
+
+        :return: dictionary of hits, misses, hit rate and stored bytes
+        """
+
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+            'bytes': self.total_bytes
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,614 @@
+"""
+The purpose of this script is to provide one shared, pooled and rate-limited connection to the Spotify API
+for the whole ingest run.
+
+"""
+
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+import requests
+from requests.adapters import HTTPAdapter
+import spotipy
+from spotipy.cache_handler import MemoryCacheHandler
+from spotipy.exceptions import SpotifyException
+from spotipy.oauth2 import SpotifyClientCredentials
+from response_cache import DEFAULT_CACHE_PATH, ResponseCache, make_cache_key
+from replay_transport import RecordReplayAdapter
+
+
+# Number of keep-alive connections held open to api.spotify.com
+DEFAULT_POOL_SIZE = 16
+
+# Seconds to wait on a single request before giving up
+DEFAULT_TIMEOUT = 10
+
+# Sustained request rate and burst size allowed by the token bucket
+DEFAULT_REQUESTS_PER_SECOND = 10.0
+DEFAULT_BURST = 20
+
+# How many times a throttled or failed request is tried again before the error is raised
+MAX_RETRIES = 6
+
+# Exponential backoff for transient errors: BACKOFF_BASE * 2 ** attempt seconds, capped, with full jitter
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+
+# Wait used when a 429 arrives without a Retry-After header
+DEFAULT_RETRY_AFTER = 5.0
+
+# Server errors worth trying again
+TRANSIENT_STATUSES = (500, 502, 503, 504)
+
+# Adaptive concurrency: the share of recent requests which may be throttled before the limit is halved,
+# how many recent requests that share is measured over, and how many clean requests in a row earn one more slot
+THROTTLE_RATE = 0.05
+THROTTLE_WINDOW = 50
+INCREASE_AFTER = 50
+
+# Environment variable listing several sets of app credentials to shard requests across,
+# as comma-separated client_id:client_secret pairs
+CREDENTIALS_ENV_VAR = 'SPOTIFY_CREDENTIALS'
+
+# Environment variables pointing the ingest somewhere other than the live API: the base URL of a stand-in server
+# (see stand_in_api.py), or a file to record the API's responses in or to replay them from
+API_URL_ENV_VAR = 'SPOTIFY_API_URL'
+RECORD_PATH_ENV_VAR = 'SPOTIFY_RECORD_PATH'
+REPLAY_PATH_ENV_VAR = 'SPOTIFY_REPLAY_PATH'
+
+# Credentials used when no real ones are needed (a stand-in server or a replay accepts any)
+OFFLINE_CREDENTIALS = [('offline', 'offline')]
+
+# A replay has no rate limit to respect, so the token bucket is opened up this far
+REPLAY_REQUESTS_PER_SECOND = 1000000.0
+
+# Endpoints looking up a batch of resources by ID, which answer with one item per ID in request order:
+# the key the items are listed under in the response, or None if the response is the list itself
+BATCH_ENDPOINTS = {'artists': 'artists', 'albums': 'albums', 'audio_features': None}
+
+# Holds the client shared by every fetcher which isn't handed one explicitly
+_shared_client = None
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: each request takes one token, tokens refill at a steady rate,
+    and the whole bucket can be paused (e.g. for a Retry-After penalty window)
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available and takes it
+        """
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """
+        Stops handing out tokens for the given number of seconds
+
+        :param seconds: length of the pause
+        """
+
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            # whatever had built up is spent once the pause is over, so requests don't all fire at once
+            self.tokens = 0.0
+
+
+class AdaptiveConcurrency:
+    """
+    Limits the number of requests in flight, halving the limit when too many recent requests were throttled
+    and raising it again one slot at a time while requests go through cleanly
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = 1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = max_limit
+        self.in_flight = 0
+        self.clean_streak = 0
+        self.recent = deque(maxlen=THROTTLE_WINDOW)
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Blocks until a request slot is free and takes it
+        """
+
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled: bool):
+        """
+        Gives back a request slot and records whether the request was throttled
+
+        :param throttled: True if the request came back with a 429
+        """
+
+        with self.condition:
+            self.in_flight -= 1
+            self.recent.append(throttled)
+            if throttled:
+                self.clean_streak = 0
+                if sum(self.recent) / len(self.recent) > THROTTLE_RATE and self.limit > self.min_limit:
+                    self.limit = max(self.min_limit, self.limit // 2)
+                    # start measuring afresh at the new limit
+                    self.recent.clear()
+            else:
+                self.clean_streak += 1
+                if self.clean_streak >= INCREASE_AFTER and self.limit < self.max_limit:
+                    self.limit += 1
+                    self.clean_streak = 0
+            self.condition.notify_all()
+
+
+class SharedTokenCredentials(SpotifyClientCredentials):
+    """
+    Client credentials whose access token is requested by one thread at a time: threads which need a token
+    while another is requesting it wait for that one, instead of each requesting a token of their own
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.token_lock = threading.Lock()
+
+    def get_access_token(self, *args, **kwargs):
+        with self.token_lock:
+            return super().get_access_token(*args, **kwargs)
+
+
+class ClientShard:
+    """
+    One set of app credentials: its own spotipy.Spotify object (and so its own access token),
+    token bucket and adaptive concurrency limit
+    """
+
+    def __init__(self, spotify: spotipy.Spotify, requests_per_second: float, burst: int, max_concurrency: int):
+        self.spotify = spotify
+        self.bucket = TokenBucket(requests_per_second, burst)
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+        self.requests = 0
+        self.throttled = 0
+
+    def headroom(self) -> int:
+        """
+        :return: free request slots under the shard's current concurrency limit
+        """
+
+        return self.concurrency.limit - self.concurrency.in_flight
+
+
+class SpotifyClient:
+    """
+    Wraps spotipy.Spotify objects so every API call used by the ingest goes through a token bucket
+    and adaptive concurrency limit, waits out 429 Retry-After windows and retries transient errors.
+    Given several spotipy.Spotify objects (one per set of app credentials), requests are spread across them,
+    each with rate limits of its own, and a throttled one is drained until its Retry-After window is over.
+    If given a ResponseCache, calls are answered from it whenever a fresh response is stored.
+    """
+
+    def __init__(self, spotify, requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND,
+                 burst: int = DEFAULT_BURST, max_concurrency: int = DEFAULT_POOL_SIZE, cache: ResponseCache = None,
+                 recording_mode: str = None):
+        """
+        :param spotify: spotipy.Spotify object, or a list of them to shard requests across
+        :param requests_per_second: sustained request rate allowed per spotipy.Spotify object
+        :param burst: token bucket size per spotipy.Spotify object
+        :param max_concurrency: requests in flight allowed per spotipy.Spotify object
+        :param cache: on-disk response cache shared by every shard
+        :param recording_mode: 'record' or 'replay' if the client's responses are recorded or replayed
+                               (see RecordReplayAdapter), otherwise None
+        """
+
+        spotifys = spotify if isinstance(spotify, list) else [spotify]
+        self.shards = [ClientShard(s, requests_per_second, burst, max_concurrency) for s in spotifys]
+        self.spotify = self.shards[0].spotify
+        self.cache = cache
+        self.recording_mode = recording_mode
+        # calls currently being made, and resources being looked up by batched calls, by cache key,
+        # so concurrent calls needing the same response (or the same resource) can share it
+        self.inflight = {}
+        self.inflight_lock = threading.Lock()
+        self.coalesced = 0
+        self.turn = 0
+
+    def pick_shard(self) -> ClientShard:
+        """
+        Chooses the shard the next request goes to: the one with the most headroom among those not waiting out
+        a Retry-After window, or the one whose window ends first if they all are
+
+        :return: ClientShard object
+        """
+
+        if len(self.shards) == 1:
+            return self.shards[0]
+
+        now = time.monotonic()
+        available = [shard for shard in self.shards if shard.bucket.paused_until <= now]
+        if len(available) == 0:
+            return min(self.shards, key=lambda shard: shard.bucket.paused_until)
+
+        # ties go to the shards in turn, so equally idle credentials share the load
+        with self.inflight_lock:
+            self.turn = (self.turn + 1) % len(available)
+        available = available[self.turn:] + available[:self.turn]
+
+        return max(available, key=ClientShard.headroom)
+
+    def call(self, endpoint: str, *args, **kwargs):
+        """
+        Makes one API call under the rate limits, trying it again after throttling or transient errors
+
+        :param endpoint: name of the spotipy method to call, e.g. 'audio_features'
+        :return: the decoded JSON response
+        """
+
+        for attempt in range(MAX_RETRIES + 1):
+            shard = self.pick_shard()
+            shard.bucket.acquire()
+            shard.concurrency.acquire()
+            shard.requests += 1
+            throttled = False
+            try:
+                return getattr(shard.spotify, endpoint)(*args, **kwargs)
+            except SpotifyException as e:
+                throttled = e.http_status == 429
+                if attempt == MAX_RETRIES or not (throttled or e.http_status in TRANSIENT_STATUSES):
+                    raise
+                if throttled:
+                    # every thread stops using this shard for the penalty window, not only the one which was
+                    # throttled; the retry goes straight to another shard if there is one
+                    shard.throttled += 1
+                    shard.bucket.pause(retry_after_seconds(e))
+                    wait = 0
+                else:
+                    wait = backoff_delay(attempt)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt == MAX_RETRIES:
+                    raise
+                wait = backoff_delay(attempt)
+            finally:
+                shard.concurrency.release(throttled)
+
+            # the request slot is given back before sleeping so other requests can use it
+            time.sleep(wait)
+
+    def request(self, endpoint: str, *args, **kwargs):
+        """
+        Answers an API call from the response cache if possible, otherwise makes it and stores the response.
+        Identical calls made at the same time from several threads share one request.
+
+        :param endpoint: name of the spotipy method to call, also used for the cache key and TTL
+        :return: the decoded JSON response
+        """
+
+        # a 'next' call is identified by the URL it follows, not by the whole page it was handed
+        if endpoint == 'next':
+            key = make_cache_key(endpoint, (args[0]['next'],), {})
+        else:
+            key = make_cache_key(endpoint, args, kwargs)
+
+        with self.inflight_lock:
+            future = self.inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.inflight[key] = future
+            else:
+                self.coalesced += 1
+
+        # another thread is already making this exact call, so wait for its response
+        if not leader:
+            return future.result()
+
+        try:
+            response = self.cached_call(endpoint, key, *args, **kwargs)
+            future.set_result(response)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.inflight_lock:
+                del self.inflight[key]
+
+        return response
+
+    def request_ids(self, endpoint: str, ids: list, **kwargs):
+        """
+        Makes a batched API call one resource ID at a time: an ID with a fresh response in the cache is answered
+        from it, an ID another call is already looking up waits for that call, and only the remaining IDs are
+        requested, in a single call. Each resource's response is cached under its own ID, whatever batch it came in.
+
+        A recorded or replayed client makes the whole call as given instead, so the requests of a replay are the
+        same as those recorded, however the calls of the two runs overlapped.
+
+        :param endpoint: name of a batched spotipy method, one of BATCH_ENDPOINTS
+        :param ids: IDs of the resources to look up
+        :return: the decoded JSON response, as the API would answer the whole call
+        """
+
+        if self.recording_mode is not None:
+            return self.request(endpoint, ids, **kwargs)
+
+        keys = [make_cache_key(endpoint, (id,), kwargs) for id in ids]
+        futures = {}
+        leading = {}
+        with self.inflight_lock:
+            for id, key in zip(ids, keys):
+                if key in futures:
+                    continue
+                future = self.inflight.get(key)
+                if future is None:
+                    future = Future()
+                    self.inflight[key] = future
+                    leading[key] = id
+                else:
+                    self.coalesced += 1
+                futures[key] = future
+
+        # The IDs this call leads are looked up before waiting on any other call, so two calls each waiting
+        # for a resource the other looks up can't block one another
+        if len(leading) > 0:
+            try:
+                self.fetch_ids(endpoint, leading, futures, kwargs)
+            except BaseException as e:
+                for key in leading:
+                    if not futures[key].done():
+                        futures[key].set_exception(e)
+                raise
+            finally:
+                with self.inflight_lock:
+                    for key in leading:
+                        del self.inflight[key]
+
+        items = [futures[key].result() for key in keys]
+
+        return items if BATCH_ENDPOINTS[endpoint] is None else {BATCH_ENDPOINTS[endpoint]: items}
+
+    def fetch_ids(self, endpoint: str, leading: dict, futures: dict, kwargs: dict):
+        """
+        Looks up the resources a batched call leads, from the response cache if possible, otherwise in one request,
+        and hands each its response through its future
+
+        :param endpoint: name of a batched spotipy method, one of BATCH_ENDPOINTS
+        :param leading: dictionary of cache key to resource ID, of the IDs to look up
+        :param futures: dictionary of cache key to the Future of each ID's response
+        :param kwargs: keyword arguments of the call
+        """
+
+        missing = {}
+        for key, id in leading.items():
+            found, item = self.cache.get(endpoint, key) if self.cache is not None else (False, None)
+            if found:
+                futures[key].set_result(item)
+            else:
+                missing[key] = id
+
+        if len(missing) == 0:
+            return
+
+        response = self.call(endpoint, list(missing.values()), **kwargs)
+        items = response if BATCH_ENDPOINTS[endpoint] is None else response[BATCH_ENDPOINTS[endpoint]]
+        if not isinstance(items, list) or len(items) != len(missing):
+            raise Exception(f'The {endpoint} response does not match the {len(missing)} IDs requested.')
+
+        for key, item in zip(missing, items):
+            # unknown IDs come back as null, which isn't cached, as a later run may find them
+            if self.cache is not None and item is not None:
+                self.cache.put(endpoint, key, item)
+            futures[key].set_result(item)
+
+    def cached_call(self, endpoint: str, key: str, *args, **kwargs):
+        """
+        Answers an API call from the response cache if possible, otherwise makes it and stores the response
+
+        :param endpoint: name of the spotipy method to call, also used for the TTL
+        :param key: key from make_cache_key
+        :return: the decoded JSON response
+        """
+
+        if self.cache is None:
+            return self.call(endpoint, *args, **kwargs)
+
+        found, response = self.cache.get(endpoint, key)
+        if found:
+            return response
+
+        response = self.call(endpoint, *args, **kwargs)
+        if response is not None:
+            self.cache.put(endpoint, key, response)
+
+        return response
+
+    # The API calls made by ingest.py
+
+    def search(self, *args, **kwargs):
+        return self.request('search', *args, **kwargs)
+
+    def artists(self, artists: list, **kwargs):
+        return self.request_ids('artists', artists, **kwargs)
+
+    def artist_albums(self, *args, **kwargs):
+        return self.request('artist_albums', *args, **kwargs)
+
+    def albums(self, albums: list, **kwargs):
+        return self.request_ids('albums', albums, **kwargs)
+
+    def album_tracks(self, *args, **kwargs):
+        return self.request('album_tracks', *args, **kwargs)
+
+    def audio_features(self, tracks: list, **kwargs):
+        return self.request_ids('audio_features', tracks, **kwargs)
+
+    def next(self, *args, **kwargs):
+        return self.request('next', *args, **kwargs)
+
+
+def retry_after_seconds(error: SpotifyException) -> float:
+    """
+    Reads the Retry-After header of a 429 response
+
+    :param error: SpotifyException raised for the 429 response
+    :return: seconds to wait before making another request
+    """
+
+    retry_after = error.headers.get('Retry-After') if error.headers else None
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+
+def backoff_delay(attempt: int) -> float:
+    """
+    Exponential backoff with full jitter
+
+    :param attempt: number of attempts made so far, starting at 0
+    :return: seconds to sleep before the next attempt
+    """
+
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def read_credentials() -> list:
+    """
+    Reads the sets of app credentials to shard requests across from the SPOTIFY_CREDENTIALS environment variable
+
+    :return: list of (client_id, client_secret) tuples; [(None, None)] if the variable isn't set,
+             which leaves spotipy to read the usual SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET
+    """
+
+    value = os.environ.get(CREDENTIALS_ENV_VAR, '').strip()
+    if not value:
+        return [(None, None)]
+
+    credentials = []
+    for pair in value.split(','):
+        client_id, _, client_secret = pair.strip().partition(':')
+        if not client_id or not client_secret:
+            raise ValueError(f'{CREDENTIALS_ENV_VAR} must hold comma-separated client_id:client_secret pairs.')
+        credentials.append((client_id, client_secret))
+
+    return credentials
+
+
+def create_spotify_client(pool_size: int = DEFAULT_POOL_SIZE, requests_timeout: int = DEFAULT_TIMEOUT,
+                          requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND,
+                          cache_path: str = DEFAULT_CACHE_PATH, credentials: list = None, api_url: str = None,
+                          record_path: str = None, replay_path: str = None) -> SpotifyClient:
+    """
+    Builds a rate-limited client backed by a single pooled HTTP session and one access token per set of credentials
+
+    :param pool_size: maximum number of keep-alive connections kept open to the API (and requests in flight),
+                      per set of credentials
+    :param requests_timeout: seconds to wait on a single request
+    :param requests_per_second: sustained request rate allowed by the token bucket, per set of credentials
+    :param cache_path: file the on-disk response cache is kept in; None turns the cache off
+    :param credentials: list of (client_id, client_secret) tuples to shard requests across;
+                        read from the environment if None
+    :param api_url: base URL of a stand-in server to send requests to instead of the live API,
+                    e.g. 'http://127.0.0.1:8765'; read from SPOTIFY_API_URL if None
+    :param record_path: file every API response is recorded in; read from SPOTIFY_RECORD_PATH if None
+    :param replay_path: file of recorded responses to answer every request from, without any network traffic;
+                        read from SPOTIFY_REPLAY_PATH if None. The replayed run must make the same requests as the
+                        recorded one, so both should be the sequential ingest() over the same artists.
+                        While recording or replaying, the response cache is off, so every call is recorded
+                        and replayed responses are never stored.
+    :return: SpotifyClient object ready to be passed to the ingest functions
+    """
+
+    api_url = api_url or os.environ.get(API_URL_ENV_VAR)
+    record_path = record_path or os.environ.get(RECORD_PATH_ENV_VAR)
+    replay_path = replay_path or os.environ.get(REPLAY_PATH_ENV_VAR)
+    offline = api_url is not None or replay_path is not None
+
+    if credentials is None:
+        credentials = read_credentials()
+        if offline and credentials == [(None, None)]:
+            credentials = OFFLINE_CREDENTIALS
+    if replay_path is not None:
+        requests_per_second = REPLAY_REQUESTS_PER_SECOND
+        recording_mode = 'replay'
+    elif record_path is not None:
+        recording_mode = 'record'
+    else:
+        recording_mode = None
+    # a call answered from the cache would never reach the recording
+    if recording_mode is not None:
+        cache_path = None
+
+    # One requests.Session means one connection pool, so consecutive calls reuse the same TCP/TLS connection
+    # instead of opening a new one for every track.
+    # Retries are left to SpotifyClient, so 429 responses reach it with their Retry-After header.
+    session = requests.Session()
+    pool_options = {'pool_connections': 2, 'pool_maxsize': pool_size * len(credentials), 'max_retries': 0}
+    if replay_path is not None:
+        adapter = RecordReplayAdapter(replay_path, 'replay', **pool_options)
+    elif record_path is not None:
+        adapter = RecordReplayAdapter(record_path, 'record', **pool_options)
+    else:
+        adapter = HTTPAdapter(**pool_options)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    # The credentials are still read from the environment variables on the local machine.
+    # Each set of credentials keeps its own token in memory and only requests it again once it has expired,
+    # however many threads need it at the same time.
+    spotifys = []
+    for client_id, client_secret in credentials:
+        auth_manager = SharedTokenCredentials(client_id=client_id,
+                                              client_secret=client_secret,
+                                              requests_session=session,
+                                              requests_timeout=requests_timeout,
+                                              cache_handler=MemoryCacheHandler())
+        spotify = spotipy.Spotify(auth_manager=auth_manager, requests_session=session,
+                                  requests_timeout=requests_timeout)
+        if api_url is not None:
+            auth_manager.OAUTH_TOKEN_URL = f'{api_url.rstrip("/")}/api/token'
+            spotify.prefix = f'{api_url.rstrip("/")}/v1/'
+        spotifys.append(spotify)
+
+    cache = ResponseCache(cache_path) if cache_path is not None else None
+
+    return SpotifyClient(spotifys, requests_per_second=requests_per_second, max_concurrency=pool_size, cache=cache,
+                         recording_mode=recording_mode)
+
+
+def get_spotify_client() -> SpotifyClient:
+    """
+    Returns the client shared across the ingest run, creating it on first use
+
+    :return: SpotifyClient object
+    """
+
+    global _shared_client
+    if _shared_client is None:
+        _shared_client = create_spotify_client()
+
+    return _shared_client
@@ -0,0 +1,337 @@
+"""
+The purpose of this script is to stand in for the Spotify Web API on the local machine, serving a catalog read
+from raw feathers (recorded by an earlier ingest, or synthetic), so the ingest can be run and timed
+without credentials or a network connection.
+
+"""
+
+import json
+import random
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+import pyarrow.feather as feather
+from artist_index import normalize_artist_name
+from validation import FIRST
+from ingest import (AUDIO_FEATURES_BATCH_SIZE, PAGE_LIMIT, SEVERAL_ALBUMS_BATCH_SIZE, SEVERAL_ARTISTS_BATCH_SIZE,
+                    VALIDATION_SCHEMAS)
+
+
+DEFAULT_PORT = 8765
+
+# Token handed out for any client credentials
+STAND_IN_TOKEN = 'stand-in-token'
+
+
+def build_record(schema, row: dict) -> dict:
+    """
+    Turns a stored row back into the API record it was validated from, following each field's path in reverse
+
+    :param schema: TableSchema of the row's table
+    :param row: row dictionary as stored in the raw feather
+    :return: JSON record shaped like the API's
+    """
+
+    record = {}
+    for field in schema.fields:
+        # context fields came from the request, not the record
+        if field.context is not None:
+            continue
+        value = row.get(field.name)
+        if isinstance(value, datetime):
+            value = value.strftime('%Y-%m-%d')
+
+        path = field.path
+        if FIRST in path:
+            # FIRST stood for the first item of a list, e.g. ('images', FIRST, 'url'); null means an empty list
+            head, tail = path[:path.index(FIRST)], path[path.index(FIRST) + 1:]
+            item = value
+            for key in reversed(tail):
+                item = {key: item}
+            path, value = head, [item] if value is not None else []
+
+        target = record
+        for key in path[:-1]:
+            target = target.setdefault(key, {})
+        target[path[-1]] = value
+
+    return record
+
+
+class StandInCatalog:
+    """
+    Artists, albums, tracks and audio features the stand-in serves, held as API records
+    """
+
+    def __init__(self, directory: str = 'raw_data'):
+        """
+        :param directory: folder holding artist, album, track and track_feature feathers as ingest writes them
+        """
+
+        rows = {table_name: feather.read_table(f'{directory}/{table_name}.feather').to_pylist()
+                for table_name in VALIDATION_SCHEMAS}
+
+        self.artists = {row['artist_id']: build_record(VALIDATION_SCHEMAS['artist'], row) for row in rows['artist']}
+
+        self.albums = {}
+        self.artist_albums = {artist_id: [] for artist_id in self.artists}
+        for row in rows['album']:
+            album = build_record(VALIDATION_SCHEMAS['album'], row)
+            album['artists'] = [{'id': row['artist_id']}]
+            self.albums.setdefault(row['album_id'], album)
+            self.artist_albums.setdefault(row['artist_id'], []).append(album)
+
+        self.album_tracks = {album_id: [] for album_id in self.albums}
+        for row in rows['track']:
+            self.album_tracks.setdefault(row['album_id'], []).append(build_record(VALIDATION_SCHEMAS['track'], row))
+
+        self.features = {row['track_id']: build_record(VALIDATION_SCHEMAS['track_feature'], row)
+                         for row in rows['track_feature']}
+
+    def search_artists(self, query: str) -> list:
+        """
+        :param query: search string, e.g. 'artist: bela fleck'
+        :return: artist records whose name matches, exact matches first
+        """
+
+        if query.lower().startswith('artist:'):
+            query = query[len('artist:'):]
+        words = normalize_artist_name(query).split()
+        if len(words) == 0:
+            return []
+
+        exact = []
+        partial = []
+        for artist in self.artists.values():
+            name = normalize_artist_name(artist.get('name') or '')
+            if name.split() == words:
+                exact.append(artist)
+            elif all(word in name.split() for word in words):
+                partial.append(artist)
+
+        return exact + partial
+
+
+class StandInError(Exception):
+    """
+    Makes the handler answer with an API error response
+    """
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    HTTP server answering the API calls made by the ingest, with configurable latency, page size and 429s
+    """
+
+    daemon_threads = True
+
+    def __init__(self, catalog: StandInCatalog, port: int = DEFAULT_PORT, latency: float = 0.0,
+                 latency_jitter: float = 0.0, max_page_limit: int = PAGE_LIMIT, throttle_rate: float = 0.0,
+                 retry_after: float = 1.0, seed: int = None):
+        """
+        :param catalog: StandInCatalog to serve
+        :param port: port to listen on (0 picks a free one)
+        :param latency: seconds every response is held back
+        :param latency_jitter: up to this many further seconds, drawn at random per response
+        :param max_page_limit: largest page the listing endpoints hand out, whatever limit is asked for
+        :param throttle_rate: share of API calls answered with a 429 instead
+        :param retry_after: Retry-After sent with every 429, in seconds
+        :param seed: seed of the random draws for jitter and 429s
+        """
+
+        super().__init__(('127.0.0.1', port), StandInHandler)
+        self.catalog = catalog
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.max_page_limit = max_page_limit
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = {}
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def count(self, endpoint: str):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def draw(self) -> tuple:
+        """
+        :return: (seconds to hold the response back, whether to answer with a 429)
+        """
+
+        with self.lock:
+            delay = self.latency + self.random.uniform(0, self.latency_jitter)
+            throttled = self.random.random() < self.throttle_rate
+
+        return delay, throttled
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Routes each request to the catalog and shapes the answer like the API's
+    """
+
+    # keep-alive, so the client's connection pool is exercised as it is against the real API
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        # one line per request would drown out the ingest's own output
+        pass
+
+    def send_json(self, status: int, body, headers: dict = None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        # client credentials token requests: any credentials are accepted
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if urlsplit(self.path).path.rstrip('/') == '/api/token':
+            self.server.count('token')
+            self.send_json(200, {'access_token': STAND_IN_TOKEN, 'token_type': 'Bearer', 'expires_in': 3600})
+        else:
+            self.send_json(404, {'error': {'status': 404, 'message': 'Not found.'}})
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+
+        delay, throttled = self.server.draw()
+        time.sleep(delay)
+        if throttled:
+            self.server.count('throttled')
+            self.send_json(429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}},
+                           headers={'Retry-After': str(self.server.retry_after)})
+            return
+
+        try:
+            if len(parts) < 2 or parts[0] != 'v1':
+                raise StandInError(404, 'Service not found')
+            self.send_json(200, self.route(parts[1:], params))
+        except StandInError as e:
+            self.send_json(e.status, {'error': {'status': e.status, 'message': e.message}})
+
+    def route(self, parts: list, params: dict):
+        catalog = self.server.catalog
+
+        if parts == ['search']:
+            self.server.count('search')
+            artists = catalog.search_artists(params.get('q', ''))
+            return {'artists': self.page(parts, params, artists, default_limit=10)}
+
+        if parts == ['artists']:
+            self.server.count('artists')
+            ids = self.ids(params, SEVERAL_ARTISTS_BATCH_SIZE)
+            return {'artists': [catalog.artists.get(id) for id in ids]}
+
+        if len(parts) == 3 and parts[0] == 'artists' and parts[2] == 'albums':
+            self.server.count('artist_albums')
+            if parts[1] not in catalog.artists:
+                raise StandInError(404, 'Resource not found')
+            return self.page(parts, params, catalog.artist_albums[parts[1]], default_limit=20)
+
+        if parts == ['albums']:
+            self.server.count('albums')
+            albums = []
+            for id in self.ids(params, SEVERAL_ALBUMS_BATCH_SIZE):
+                album = catalog.albums.get(id)
+                if album is not None:
+                    # a full album embeds the first page of its tracks
+                    album = dict(album)
+                    album['tracks'] = self.page(['albums', id, 'tracks'], {}, catalog.album_tracks[id],
+                                                default_limit=PAGE_LIMIT)
+                albums.append(album)
+            return {'albums': albums}
+
+        if len(parts) == 3 and parts[0] == 'albums' and parts[2] == 'tracks':
+            self.server.count('album_tracks')
+            if parts[1] not in catalog.albums:
+                raise StandInError(404, 'Resource not found')
+            return self.page(parts, params, catalog.album_tracks[parts[1]], default_limit=20)
+
+        if parts == ['audio-features']:
+            self.server.count('audio_features')
+            ids = self.ids(params, AUDIO_FEATURES_BATCH_SIZE)
+            return {'audio_features': [catalog.features.get(id) for id in ids]}
+
+        raise StandInError(404, 'Service not found')
+
+    def ids(self, params: dict, max_ids: int) -> list:
+        ids = [id for id in params.get('ids', '').split(',') if id]
+        if len(ids) == 0 or len(ids) > max_ids:
+            raise StandInError(400, f'Between 1 and {max_ids} ids are allowed')
+        return ids
+
+    def page(self, parts: list, params: dict, items: list, default_limit: int) -> dict:
+        """
+        Cuts one paging object out of a listing
+
+        :param parts: path of the listing, below /v1
+        :param params: query parameters of the request
+        :param items: the whole listing
+        :param default_limit: page size used when the request doesn't give one
+        :return: paging object, with a 'next' link if the listing goes on
+        """
+
+        try:
+            limit = min(int(params.get('limit', default_limit)), self.server.max_page_limit)
+            offset = int(params.get('offset', 0))
+        except ValueError:
+            raise StandInError(400, 'Invalid limit or offset')
+
+        def link(page_offset: int) -> str:
+            query = dict(params, offset=page_offset, limit=limit)
+            return f'{self.server.url}/v1/{"/".join(parts)}?{urlencode(query)}'
+
+        return {
+            'href': link(offset),
+            'items': items[offset:offset + limit],
+            'limit': limit,
+            'offset': offset,
+            'total': len(items),
+            'next': link(offset + limit) if offset + limit < len(items) else None,
+            'previous': link(max(0, offset - limit)) if offset > 0 else None
+        }
+
+
+def start_stand_in_server(catalog: StandInCatalog = None, port: int = 0, **options) -> StandInServer:
+    """
+    Starts a stand-in server on a background thread
+
+    :param catalog: StandInCatalog to serve; the one in raw_data is read if None
+    :param port: port to listen on; a free one is picked if 0
+    :param options: latency, latency_jitter, max_page_limit, throttle_rate, retry_after and seed, see StandInServer
+    :return: the running StandInServer; pass its url to create_spotify_client(api_url=...) and call shutdown() when done
+    """
+
+    if catalog is None:
+        catalog = StandInCatalog()
+
+    server = StandInServer(catalog, port=port, **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+if __name__ == '__main__':
+    server = StandInServer(StandInCatalog(), latency=0.05, latency_jitter=0.05)
+    print(f'Stand-in Spotify API serving raw_data at {server.url} '
+          f'(set SPOTIFY_API_URL={server.url} to run the ingest against it)')
+    server.serve_forever()
@@ -0,0 +1,371 @@
+"""
+The purpose of this script is to generate a synthetic catalog of any size, written as the same four raw feathers
+ingest.ingest() writes, so transform, load and the views can be tried out at many times the size of the real data.
+A rule file naming the synthetic artists is written next to the feathers, for transform.transform(rules_path=...).
+
+"""
+
+import os
+import time
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import yaml
+from feather_io import FeatherBatchWriter, iter_feather_batches
+from ingest import RAW_SCHEMAS
+from transform_rules import DEFAULT_RULES_PATH
+
+
+DEFAULT_DIRECTORY = 'synthetic_data'
+
+# Rule file written next to the feathers: the default rules, with every synthetic artist in the roster
+# sorting artists by kind, so the missing instrumentalness of their tracks is imputed like the real artists'
+RULES_FILE_NAME = 'transform_rules.yaml'
+ARTIST_KIND_COLUMN = 'artist_kind'
+
+# Tracks generated between two record batches written to the feathers
+DEFAULT_CHUNK_TRACKS = 250000
+
+# Spotify IDs are 22 base-62 characters
+ID_ALPHABET = np.array(list('0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'))
+ID_LENGTH = 22
+
+# The distributions below are fitted by eye to the 20-artist catalog in raw_data
+ALBUMS_PER_ARTIST_MEAN = 28
+# the mean of the track counts drawn in make_album_batch, outliers included
+TRACKS_PER_ALBUM_MEAN = 14
+ALBUM_TYPES = np.array(['album', 'single', 'compilation'])
+ALBUM_TYPE_SHARES = [0.61, 0.20, 0.19]
+# share of albums with more than 60 tracks (box sets, complete works), which transform removes as outliers
+OUTLIER_ALBUM_SHARE = 0.016
+GENRES = np.array(['classical performance', 'permanent wave', 'new age', 'disco', 'adult standards', 'bluegrass',
+                   'banjo', 'christian music', 'american modern classical', 'uk alternative pop',
+                   '21st century classical', 'college a cappella', 'jazz', 'indie folk', 'soul', 'art pop'])
+NULL_GENRE_SHARE = 0.45
+# share of artists who are mostly instrumental; their tracks lean towards high instrumentalness
+INSTRUMENTAL_ARTIST_SHARE = 0.6
+NULL_INSTRUMENTALNESS_SHARE = 0.15
+# other audio features are missing now and then, and a few tracks have no audio features at all
+NULL_FEATURE_SHARE = 0.001
+MISSING_FEATURES_SHARE = 0.0005
+EXPLICIT_SHARE = 0.026
+FIRST_RELEASE = np.datetime64('1957-01-01')
+LAST_RELEASE = np.datetime64('2022-09-30')
+
+NAME_WORDS = np.array(['Bright', 'Hour', 'Love', 'Earth', 'Within', 'Days', 'Time', 'Momentum', 'Rose', 'Light',
+                       'River', 'Song', 'Night', 'Morning', 'Dance', 'Sonata', 'Suite', 'Variations', 'Blue',
+                       'Home', 'Road', 'Fire', 'Wind', 'Chariot', 'Helen', 'Paris', 'Last', 'September'])
+
+
+def random_ids(rng: np.random.Generator, n: int) -> pa.Array:
+    """
+    :param rng: random generator
+    :param n: number of IDs
+    :return: pa.Array of n random Spotify-style IDs
+    """
+
+    characters = ID_ALPHABET[rng.integers(0, len(ID_ALPHABET), size=(n, ID_LENGTH))]
+
+    return pa.array(np.ascontiguousarray(characters).view(f'<U{ID_LENGTH}').ravel())
+
+
+def random_names(rng: np.random.Generator, n: int, words: int) -> pa.Array:
+    """
+    :param rng: random generator
+    :param n: number of names
+    :param words: number of words per name
+    :return: pa.Array of n names made of random words
+    """
+
+    picks = [pa.array(NAME_WORDS[rng.integers(0, len(NAME_WORDS), size=n)]) for _ in range(words)]
+
+    return pc.binary_join_element_wise(*picks, ' ')
+
+
+def prefixed(prefix: str, ids: pa.Array) -> pa.Array:
+    """
+    :return: pa.Array of prefix + id, e.g. URIs or URLs built from IDs
+    """
+
+    return pc.binary_join_element_wise(pa.scalar(prefix), ids, '')
+
+
+def with_nulls(rng: np.random.Generator, values: np.ndarray, share: float) -> pa.Array:
+    """
+    :return: pa.Array of the values, with about the given share of them null
+    """
+
+    return pa.array(values, mask=rng.random(len(values)) < share)
+
+
+def make_artist_batch(rng: np.random.Generator, first_number: int, n: int) -> pa.RecordBatch:
+    """
+    Generates n artists
+
+    :param rng: random generator
+    :param first_number: number of the first artist, used to give every artist a distinct name
+    :param n: number of artists
+    :return: pa.RecordBatch with the raw artist schema
+    """
+
+    ids = random_ids(rng, n)
+    numbers = pa.array(np.arange(first_number, first_number + n).astype(str))
+    followers = np.floor(rng.lognormal(mean=7.5, sigma=3.0, size=n)).astype(np.int64)
+    # popularity roughly follows the log of the follower count
+    popularity = np.clip(np.log1p(followers) * 4.5 + rng.normal(0, 5, size=n), 0, 100).astype(np.int64)
+
+    columns = {
+        'artist_id': ids,
+        'artist_name': pc.binary_join_element_wise(random_names(rng, n, 2), numbers, ' '),
+        'external url': prefixed('https://open.spotify.com/artist/', ids),
+        'genre': with_nulls(rng, GENRES[rng.integers(0, len(GENRES), size=n)], NULL_GENRE_SHARE),
+        'image_url': prefixed('https://i.scdn.co/image/', random_ids(rng, n)),
+        'followers': pa.array(followers),
+        'popularity': pa.array(popularity),
+        'type': pa.array(['artist'] * n),
+        'artist_uri': prefixed('spotify:artist:', ids)
+    }
+
+    return pa.RecordBatch.from_arrays(list(columns.values()), schema=RAW_SCHEMAS['artist'])
+
+
+def make_album_batch(rng: np.random.Generator, artist_ids: np.ndarray) -> pa.RecordBatch:
+    """
+    Generates the albums of the given artists
+
+    :param rng: random generator
+    :param artist_ids: IDs of the artists
+    :return: pa.RecordBatch with the raw album schema
+    """
+
+    albums_per_artist = rng.geometric(1 / ALBUMS_PER_ARTIST_MEAN, size=len(artist_ids))
+    album_artist_ids = np.repeat(artist_ids, albums_per_artist)
+    n = len(album_artist_ids)
+
+    album_types = ALBUM_TYPES[rng.choice(len(ALBUM_TYPES), size=n, p=ALBUM_TYPE_SHARES)]
+    # singles have one to three tracks; albums and compilations around a dozen, with a long tail of outliers
+    total_tracks = np.maximum(1, np.round(rng.lognormal(mean=np.log(12), sigma=0.45, size=n))).astype(np.int64)
+    total_tracks[album_types == 'single'] = rng.integers(1, 4, size=(album_types == 'single').sum())
+    outliers = (rng.random(n) < OUTLIER_ALBUM_SHARE) & (album_types != 'single')
+    total_tracks[outliers] = rng.integers(61, 500, size=outliers.sum())
+
+    days = (LAST_RELEASE - FIRST_RELEASE).astype(int)
+    release_dates = FIRST_RELEASE + rng.integers(0, days, size=n).astype('timedelta64[D]')
+
+    ids = random_ids(rng, n)
+    columns = {
+        'album_id': ids,
+        'album_name': random_names(rng, n, 3),
+        'external_url': prefixed('https://open.spotify.com/album/', ids),
+        'image_url': prefixed('https://i.scdn.co/image/', random_ids(rng, n)),
+        'release_date': pa.array(release_dates.astype('datetime64[ns]')),
+        'total_tracks': pa.array(total_tracks),
+        'type': pa.array(album_types),
+        'album_uri': prefixed('spotify:album:', ids),
+        'artist_id': pa.array(album_artist_ids)
+    }
+
+    return pa.RecordBatch.from_arrays(list(columns.values()), schema=RAW_SCHEMAS['album'])
+
+
+def make_track_batch(rng: np.random.Generator, album_ids: np.ndarray, total_tracks: np.ndarray) -> pa.RecordBatch:
+    """
+    Generates every track of the given albums
+
+    :param rng: random generator
+    :param album_ids: IDs of the albums
+    :param total_tracks: number of tracks of each album
+    :return: pa.RecordBatch with the raw track schema
+    """
+
+    track_album_ids = np.repeat(album_ids, total_tracks)
+    n = len(track_album_ids)
+
+    # long albums are split over discs of 12 to 30 tracks
+    starts = np.repeat(np.cumsum(total_tracks) - total_tracks, total_tracks)
+    position = np.arange(n) - starts
+    disc_size = np.repeat(np.where(total_tracks > 30, rng.integers(12, 31, size=len(total_tracks)), 30), total_tracks)
+
+    ids = random_ids(rng, n)
+    columns = {
+        'track_id': ids,
+        'song_name': random_names(rng, n, 2),
+        'external_url': prefixed('https://open.spotify.com/track/', ids),
+        'duration_ms': pa.array(np.clip(rng.lognormal(mean=np.log(230000), sigma=0.45, size=n), 13000, 1900000)
+                                .astype(np.int64)),
+        'explicit': pa.array(rng.random(n) < EXPLICIT_SHARE),
+        'disc_number': pa.array((1 + position // disc_size).astype(np.int64)),
+        'type': pa.array(['track'] * n),
+        'song_uri': prefixed('spotify:track:', ids),
+        'album_id': pa.array(track_album_ids)
+    }
+
+    return pa.RecordBatch.from_arrays(list(columns.values()), schema=RAW_SCHEMAS['track'])
+
+
+def make_track_feature_batch(rng: np.random.Generator, tracks: pa.RecordBatch,
+                             instrumental: np.ndarray) -> pa.RecordBatch:
+    """
+    Generates the audio features of the given tracks
+
+    :param rng: random generator
+    :param tracks: record batch of tracks, with the raw track schema
+    :param instrumental: whether each track's artist is mostly instrumental
+    :return: pa.RecordBatch with the raw track_feature schema
+    """
+
+    keep = rng.random(tracks.num_rows) >= MISSING_FEATURES_SHARE
+    tracks = tracks.filter(pa.array(keep))
+    instrumental = instrumental[keep]
+    n = tracks.num_rows
+
+    def feature(values: np.ndarray) -> pa.Array:
+        return with_nulls(rng, np.round(values, 4), NULL_FEATURE_SHARE)
+
+    instrumentalness = np.where(instrumental, rng.beta(5.0, 1.5, size=n), rng.beta(0.3, 5.0, size=n))
+    columns = {
+        'track_id': tracks.column('track_id'),
+        'danceability': feature(rng.beta(3.5, 4.2, size=n)),
+        'energy': feature(rng.beta(1.0, 1.6, size=n)),
+        'instrumentalness': with_nulls(rng, np.round(instrumentalness, 4), NULL_INSTRUMENTALNESS_SHARE),
+        'liveness': feature(rng.beta(1.2, 4.5, size=n)),
+        'loudness': feature(np.clip(rng.normal(-14.5, 7.3, size=n), -60.0, 0.0)),
+        'speechiness': feature(rng.beta(0.8, 12.0, size=n)),
+        'tempo': feature(np.clip(rng.normal(115.0, 30.0, size=n), 40.0, 240.0)),
+        'type': pa.array(['audio_features'] * n),
+        'valence': feature(rng.beta(1.0, 1.5, size=n)),
+        'song_uri': tracks.column('song_uri')
+    }
+
+    return pa.RecordBatch.from_arrays(list(columns.values()), schema=RAW_SCHEMAS['track_feature'])
+
+
+def read_kind_rule(rules: dict) -> dict:
+    """
+    :param rules: rule file as read from YAML
+    :return: the artist table's classify rule sorting artists by kind, whose values map artist names to kinds
+    """
+
+    for rule in rules['tables']['artist'].get('classify', []):
+        if rule.get('column') == ARTIST_KIND_COLUMN and isinstance(rule.get('values'), dict):
+            return rule
+
+    raise ValueError(f'The rule file has no {ARTIST_KIND_COLUMN} classify rule for artists to add the synthetic '
+                     f'artists to.')
+
+
+def write_rules(path: str, rules: dict, artist_kinds: dict):
+    """
+    Writes the rules with the given artists added to the roster sorting artists by kind
+
+    :param path: path of the rule file
+    :param rules: rule file as read from YAML
+    :param artist_kinds: dictionary of artist name to 'instrumental' or 'vocal'
+    """
+
+    read_kind_rule(rules)['values'].update(artist_kinds)
+    with open(path, 'w', encoding='utf-8') as rules_file:
+        rules_file.write(f'# Written by synthetic_catalog.py: the rules of {os.path.basename(DEFAULT_RULES_PATH)}, '
+                         f'with every synthetic artist sorted by kind\n')
+        yaml.safe_dump(rules, rules_file, allow_unicode=True, sort_keys=False)
+
+
+def generate_catalog(n_tracks: int, seed: int = 0, directory: str = DEFAULT_DIRECTORY, seed_artists_path: str = None,
+                     chunk_tracks: int = DEFAULT_CHUNK_TRACKS) -> dict:
+    """
+    Writes artist, album, track and track_feature feathers with about n_tracks tracks into a directory,
+    and a rule file sorting every artist of the catalog by kind (see RULES_FILE_NAME)
+
+    Every artist, album, track and audio feature is generated, unless the artists of a recorded catalog
+    are to come first. The number of artists grows with n_tracks, and every artist written has albums, as in
+    a catalog ingest.ingest() stores.
+
+    :param n_tracks: number of tracks to generate (the last album may take it a little past this)
+    :param seed: seed of the random generator; the same seed, size and seed artists always give the same catalog
+    :param directory: folder the four feathers and the rule file are written to
+    :param seed_artists_path: artist feather whose artists are kept, e.g. 'raw_data/artist.feather';
+                              None generates every artist
+    :param chunk_tracks: about how many tracks are generated and written at a time
+    :return: dictionary of table name to number of rows written
+    """
+
+    t0 = time.time()
+    rng = np.random.default_rng(seed)
+    with open(DEFAULT_RULES_PATH, encoding='utf-8') as rules_file:
+        rules = yaml.safe_load(rules_file)
+    # artists the rules already sort by kind keep their kind; every other artist is added to the roster
+    roster = dict(read_kind_rule(rules)['values'])
+    artist_kinds = {}
+    os.makedirs(directory, exist_ok=True)
+    writers = {table_name: FeatherBatchWriter(f'{directory}/{table_name}.feather', schema)
+               for table_name, schema in RAW_SCHEMAS.items()}
+
+    # enough artists per chunk for about chunk_tracks tracks
+    artists_per_chunk = max(1, chunk_tracks // (ALBUMS_PER_ARTIST_MEAN * TRACKS_PER_ALBUM_MEAN))
+    artist_count = 0
+    track_count = 0
+
+    try:
+        if seed_artists_path is not None and os.path.isfile(seed_artists_path):
+            seed_batches = list(iter_feather_batches(seed_artists_path))
+        else:
+            seed_batches = []
+
+        while track_count < n_tracks:
+            if len(seed_batches) > 0:
+                artists = seed_batches.pop(0)
+            else:
+                # only as many artists as the tracks still to generate need, so the catalog keeps the same
+                # ratios of artists, albums and tracks at every size
+                remaining = n_tracks - track_count
+                artists = make_artist_batch(rng, artist_count + 1, min(artists_per_chunk, max(
+                    1, int(np.ceil(remaining / (ALBUMS_PER_ARTIST_MEAN * TRACKS_PER_ALBUM_MEAN))))))
+
+            albums = make_album_batch(rng, np.asarray(artists.column('artist_id').to_pylist(), dtype=object))
+            total_tracks = albums.column('total_tracks').to_numpy()
+            # the last chunk stops at the first album which reaches n_tracks
+            remaining = n_tracks - track_count
+            cut = int(np.searchsorted(np.cumsum(total_tracks), remaining)) + 1
+            if cut < albums.num_rows:
+                albums = albums.slice(0, cut)
+                total_tracks = total_tracks[:cut]
+                # the artists whose albums all fell past the cut are left out, as ingest never stores an artist
+                # without albums
+                artists = artists.filter(pc.is_in(artists.column('artist_id'), value_set=albums.column('artist_id')))
+            artist_count += artists.num_rows
+
+            instrumental_artists = rng.random(artists.num_rows) < INSTRUMENTAL_ARTIST_SHARE
+            artist_names = artists.column('artist_name').to_pylist()
+            for i, name in enumerate(artist_names):
+                if name in roster:
+                    instrumental_artists[i] = roster[name] == 'instrumental'
+                else:
+                    artist_kinds[name] = 'instrumental' if instrumental_artists[i] else 'vocal'
+            artist_instrumental = dict(zip(artists.column('artist_id').to_pylist(), instrumental_artists))
+            instrumental = np.repeat([artist_instrumental[id] for id in albums.column('artist_id').to_pylist()],
+                                     total_tracks)
+
+            tracks = make_track_batch(rng, np.asarray(albums.column('album_id').to_pylist(), dtype=object),
+                                      total_tracks)
+            track_count += tracks.num_rows
+
+            writers['artist'].write_batch(artists)
+            writers['album'].write_batch(albums)
+            writers['track'].write_batch(tracks)
+            writers['track_feature'].write_batch(make_track_feature_batch(rng, tracks, instrumental))
+    except BaseException:
+        for writer in writers.values():
+            writer.abort()
+        raise
+
+    counts = {table_name: writer.close() for table_name, writer in writers.items()}
+    write_rules(os.path.join(directory, RULES_FILE_NAME), rules, artist_kinds)
+    print(f'Synthetic catalog of {counts["artist"]} artists, {counts["album"]} albums, {counts["track"]} tracks '
+          f'written to {directory}. Total time: {round(time.time() - t0, 2)}s')
+
+    return counts
+
+
+if __name__ == '__main__':
+
+    generate_catalog(1000000)
@@ -0,0 +1,79 @@
+"""
+A resumed incremental ingest has to store the same tables as one which was never interrupted
+"""
+
+import os
+import shutil
+import pytest
+import artist_index
+import ingest
+from artist_index import ArtistAliasIndex
+from feather_io import read_feather_column
+from spotify_client import create_spotify_client
+from stand_in_api import StandInCatalog, start_stand_in_server
+
+
+CATALOG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'raw_data')
+
+# Albums of every artist released since the earlier run
+NEW_ALBUMS_PER_ARTIST = 3
+
+
+def stored_ids() -> dict:
+    return {table_name: set(ingest.read_stored_ids(table_name)) for table_name in ingest.RAW_SCHEMAS}
+
+
+@pytest.fixture
+def stand_in(tmp_path, monkeypatch):
+    """
+    Stand-in server over the recorded catalog, with the ingest writing into an empty working directory
+    """
+
+    catalog = StandInCatalog(CATALOG_DIR)
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('raw_data')
+    # names resolved in other runs must not skip the search
+    monkeypatch.setattr(artist_index, '_shared_index', ArtistAliasIndex(None))
+
+    server = start_stand_in_server(catalog)
+    yield server
+    server.shutdown()
+
+
+def test_resumed_incremental_ingest_matches_uninterrupted_one(stand_in, monkeypatch):
+    full_catalog = stand_in.catalog
+    artist_names = [artist['name'] for artist in full_catalog.artists.values()]
+    spotify = create_spotify_client(api_url=stand_in.url, cache_path=None)
+
+    # The earlier run was made before the latest albums of every artist came out
+    earlier_catalog = StandInCatalog(CATALOG_DIR)
+    for artist_id, albums in earlier_catalog.artist_albums.items():
+        if len(albums) > NEW_ALBUMS_PER_ARTIST:
+            earlier_catalog.artist_albums[artist_id] = albums[:-NEW_ALBUMS_PER_ARTIST]
+    stand_in.catalog = earlier_catalog
+    ingest.ingest(artist_names, spotify)
+    shutil.copytree('raw_data', 'earlier_raw_data')
+
+    stand_in.catalog = full_catalog
+    ingest.ingest(artist_names, spotify, incremental=True)
+    expected = stored_ids()
+    assert len(expected['album']) > len(set(read_feather_column('earlier_raw_data/album.feather', 'album_id')))
+
+    # The same incremental run again, from the same earlier tables, but crashing in the track stage
+    # after the album table was already overwritten
+    shutil.rmtree('raw_data')
+    shutil.copytree('earlier_raw_data', 'raw_data')
+
+    def crash(*args, **kwargs):
+        raise RuntimeError('crashed while fetching tracks')
+        yield
+
+    iter_track_rows = ingest.iter_track_rows
+    monkeypatch.setattr(ingest, 'iter_track_rows', crash)
+    with pytest.raises(RuntimeError):
+        ingest.ingest(artist_names, spotify, incremental=True)
+    monkeypatch.setattr(ingest, 'iter_track_rows', iter_track_rows)
+
+    ingest.ingest(artist_names, spotify, incremental=True, resume=True)
+
+    assert stored_ids() == expected
@@ -0,0 +1,48 @@
+"""
+Concurrent batched calls have to share the lookups of the resources they have in common
+"""
+
+import threading
+from spotify_client import SpotifyClient
+
+
+class BlockingSpotify:
+    """
+    Stands in for spotipy.Spotify: records the album IDs of every several-albums request, and holds the first
+    request until released
+    """
+
+    def __init__(self):
+        self.requested = []
+        self.first_started = threading.Event()
+        self.release = threading.Event()
+
+    def albums(self, albums: list):
+        self.requested.append(list(albums))
+        if len(self.requested) == 1:
+            self.first_started.set()
+            self.release.wait(5)
+        return {'albums': [{'id': album_id} for album_id in albums]}
+
+
+def test_overlapping_batches_request_each_album_once():
+    spotify = BlockingSpotify()
+    client = SpotifyClient(spotify)
+    responses = {}
+
+    first = threading.Thread(target=lambda: responses.update(first=client.albums(['a', 'b'])))
+    first.start()
+    assert spotify.first_started.wait(5)
+
+    # b is in flight with the first call, so the second only requests c, then waits for b
+    second = threading.Thread(target=lambda: responses.update(second=client.albums(['b', 'c'])))
+    second.start()
+    second.join(0.5)
+    spotify.release.set()
+    first.join(5)
+    second.join(5)
+
+    assert spotify.requested == [['a', 'b'], ['c']]
+    assert responses['first'] == {'albums': [{'id': 'a'}, {'id': 'b'}]}
+    assert responses['second'] == {'albums': [{'id': 'b'}, {'id': 'c'}]}
+    assert client.coalesced == 1
@@ -0,0 +1,21 @@
+"""
+A synthetic catalog has to keep the shape of an ingested one whatever its size
+"""
+
+import pandas as pd
+import pytest
+from synthetic_catalog import ALBUMS_PER_ARTIST_MEAN, TRACKS_PER_ALBUM_MEAN, generate_catalog
+
+
+@pytest.mark.parametrize('n_tracks', [10000, 100000, 400000])
+def test_catalog_ratios_hold_at_every_size(tmp_path, n_tracks):
+    counts = generate_catalog(n_tracks, seed=1, directory=str(tmp_path))
+    artists = pd.read_feather(tmp_path / 'artist.feather')
+    albums = pd.read_feather(tmp_path / 'album.feather')
+
+    assert n_tracks <= counts['track'] < n_tracks + 500
+    # every artist has albums, and every album an artist
+    assert artists['artist_id'].isin(albums['artist_id']).all()
+    assert albums['artist_id'].isin(artists['artist_id']).all()
+    assert 0.7 * ALBUMS_PER_ARTIST_MEAN <= counts['album'] / counts['artist'] <= 1.3 * ALBUMS_PER_ARTIST_MEAN
+    assert 0.8 * TRACKS_PER_ALBUM_MEAN <= counts['track'] / counts['album'] <= 1.2 * TRACKS_PER_ALBUM_MEAN
@@ -0,0 +1,124 @@
+"""
+Cleaning a catalog in memory, chunk by chunk or incrementally has to leave the same cleaned tables
+"""
+
+import os
+import shutil
+import pandas as pd
+import pytest
+import transform
+from synthetic_catalog import RULES_FILE_NAME, generate_catalog
+from transform_rules import TableRules
+
+
+TABLE_NAMES = ['artist', 'album', 'track', 'track_feature']
+SEED = 7
+# Smaller than every table but the artists', so each is cleaned over several chunks
+CHUNK_ROWS = 50
+
+
+def read_cleaned_tables() -> dict:
+    return {table_name: pd.read_feather(f'cleaned_data/cleaned_{table_name}.feather') for table_name in TABLE_NAMES}
+
+
+def assert_same_tables(expected: dict, cleaned: dict):
+    for table_name in TABLE_NAMES:
+        pd.testing.assert_frame_equal(cleaned[table_name], expected[table_name], obj=table_name)
+
+
+@pytest.fixture(scope='module')
+def catalog(tmp_path_factory) -> str:
+    """
+    Small synthetic catalog, in which one artist's first album (neither a compilation nor an outlier, so it's kept)
+    is about to become a compilation, which drops it. The artist's tracks are all given an instrumentalness, as
+    the values imputed at random in a partition cleaned again are drawn afresh.
+    """
+
+    raw_dir = str(tmp_path_factory.mktemp('catalog') / 'raw_data')
+    generate_catalog(3000, seed=SEED, directory=raw_dir)
+
+    albums = pd.read_feather(f'{raw_dir}/album.feather')
+    tracks = pd.read_feather(f'{raw_dir}/track.feather')
+    features = pd.read_feather(f'{raw_dir}/track_feature.feather')
+    kept = albums[(albums['type'] == 'album') & (albums['total_tracks'] <= 60)]
+    artist_id = kept['artist_id'].iloc[0]
+    artist_tracks = tracks['album_id'].isin(albums.loc[albums['artist_id'] == artist_id, 'album_id'])
+    fill = features['track_id'].isin(tracks.loc[artist_tracks, 'track_id']) & features['instrumentalness'].isna()
+    assert features['instrumentalness'].isna().sum() > fill.sum() > 0
+    features.loc[fill, 'instrumentalness'] = 0.5
+    features.to_feather(f'{raw_dir}/track_feature.feather')
+
+    return raw_dir, artist_id, kept['album_id'].iloc[0]
+
+
+def run_transform(workdir, raw_dir: str, **kwargs) -> dict:
+    """
+    Transforms the raw tables of raw_dir in their own working directory
+
+    :return: dictionary of table name to cleaned DataFrame
+    """
+
+    os.chdir(workdir)
+    if not os.path.isdir('raw_data'):
+        shutil.copytree(raw_dir, 'raw_data')
+        os.makedirs('cleaned_data')
+    transform.transform(seed=SEED, rules_path=f'raw_data/{RULES_FILE_NAME}', **kwargs)
+
+    return read_cleaned_tables()
+
+
+def make_compilation(album_id: str):
+    albums = pd.read_feather('raw_data/album.feather')
+    albums.loc[albums['album_id'] == album_id, 'type'] = 'compilation'
+    albums.to_feather('raw_data/album.feather')
+
+
+def test_chunked_transform_matches_in_memory_one(catalog, tmp_path, monkeypatch):
+    raw_dir, _, _ = catalog
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('in_memory')
+    os.makedirs('chunked')
+
+    expected = run_transform(tmp_path / 'in_memory', raw_dir, incremental=False)
+    assert all(len(expected[table_name]) > CHUNK_ROWS for table_name in TABLE_NAMES[1:])
+    # the rows imputed at random are compared too
+    assert expected['track_feature']['instrumentalness'].notna().all()
+
+    assert_same_tables(expected, run_transform(tmp_path / 'chunked', raw_dir, chunk_rows=CHUNK_ROWS))
+
+
+def test_incremental_transform_matches_full_one_and_cleans_only_changed_partition(catalog, tmp_path, monkeypatch):
+    raw_dir, artist_id, album_id = catalog
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('full')
+    os.makedirs('incremental')
+
+    run_transform(tmp_path / 'full', raw_dir, incremental=False)
+    make_compilation(album_id)
+    expected = run_transform(tmp_path / 'full', raw_dir, incremental=False)
+    assert album_id not in set(expected['album']['album_id'])
+
+    run_transform(tmp_path / 'incremental', raw_dir)
+    make_compilation(album_id)
+
+    # every row cleaned again is recorded, by table
+    cleaned_keys = {}
+    clean = TableRules.clean
+
+    def recording_clean(rules, df, *args, **kwargs):
+        cleaned_keys.setdefault(rules.name, set()).update(df[rules.key])
+        return clean(rules, df, *args, **kwargs)
+
+    monkeypatch.setattr(TableRules, 'clean', recording_clean)
+    assert_same_tables(expected, run_transform(tmp_path / 'incremental', raw_dir))
+
+    # only the artist whose album changed is cleaned again, in the album table and the two below it
+    albums = pd.read_feather('raw_data/album.feather')
+    tracks = pd.read_feather('raw_data/track.feather')
+    artist_album_ids = set(albums.loc[albums['artist_id'] == artist_id, 'album_id'])
+    artist_track_ids = set(tracks.loc[tracks['album_id'].isin(artist_album_ids), 'track_id'])
+    assert set(cleaned_keys) == {'album', 'track', 'track_feature'}
+    assert cleaned_keys['album'] == artist_album_ids
+    assert cleaned_keys['track'] == artist_track_ids
+    assert 0 < len(cleaned_keys['track_feature']) and cleaned_keys['track_feature'] <= artist_track_ids
+    assert len(artist_album_ids) < len(albums)
@@ -1,191 +1,201 @@
+import numpy as np
+import os
 import pandas as pd
-import random
+import pyarrow as pa
 import time
+from contextlib import ExitStack
+from feather_io import FeatherBatchWriter, iter_feather_chunks, read_feather_df, read_feather_schema, write_feather_df
+from transform_rules import DEFAULT_RULES_PATH, RulePlan, load_rules, rules_digest
+from transform_state import (PARTITION_COLUMN, TransformState, file_digest, make_result_frame, partition_digests,
+                             result_digests, result_from_frame, row_partitions)
 
-# **********
-# ARTIST table cleaning
-
-def clean_artist(artist_df: pd.DataFrame) -> (pd.DataFrame, (list, list)):
-
-    # Since I know the genres, I'll impute the missing values manually
-    performers = ['Erik Rohde', 'Korey Konkol', 'Jacob Tews', 'Clare Longendyke']
-    composers = ['Christopher Walczak', 'Michael-Thomas Foumai', 'Elliott Miles McKinley']
-
-    # This pulls the index of each row where the genre is None
-    none_indexes = artist_df.index[artist_df['genre'].isna()].tolist()
-
-    for i in none_indexes:
-        if artist_df.loc[i, 'artist_name'] in performers:
-            artist_df.loc[i, 'genre'] = 'classical performance'
-        elif artist_df.loc[i, 'artist_name'] in composers:
-            artist_df.loc[i, 'genre'] = '21st century classical'
-        elif artist_df.loc[i, 'artist_name'] == 'Deborah Klemme':
-            artist_df.loc[i, 'genre'] = 'christian music'
-        elif artist_df.loc[i, 'artist_name'] == '7 Days A Cappella':
-            artist_df.loc[i, 'genre'] = 'college a cappella'
+# The cleaning rules of every table (which rows to drop, and how to impute missing values)
+# live in transform_rules.yaml and are compiled by transform_rules.py
 
-    # For use in imputing instrumentalness values in the track_feature table, I'll need the artist ids by type
-    instrumentals = ['Hilary Hahn', 'Jim Brickman', 'Chris Thile', 'Béla Fleck', 'Elliott Carter',
-                     'Michael-Thomas Foumai', 'Augusta Read Thomas', 'Elliott Miles McKinley', 'Jacob Tews',
-                     'Christopher Walczak', 'Korey Konkol', 'Clare Longendyke', 'Erik Rohde']
-    vocals = ['Ben Folds', 'Earth, Wind & Fire', 'Chicago', 'Fernando Ortega', 'Jacob Collier', 'Deborah Klemme',
-              '7 Days A Cappella']
+# Number of rows cleaned at a time by the streaming transform
+DEFAULT_CHUNK_ROWS = 250000
 
-    instrumental_ids = [artist_df.loc[artist_df['artist_name'] == artist_name, 'artist_id'].item() for artist_name
-                        in instrumentals]
-    vocal_ids = [artist_df.loc[artist_df['artist_name'] == artist_name, 'artist_id'].item() for artist_name in
-                 vocals]
-
-    return artist_df, (instrumental_ids, vocal_ids)
+# The cleaned feathers are written uncompressed, so load and the visualizations read them zero-copy
+# from a memory map, only paging in the columns they use
+CLEANED_COMPRESSION = None
 
 # **********
-# ALBUM table cleaning
-
-def clean_album(album_df: pd.DataFrame, artist_ids: (list, list)) -> (pd.DataFrame, list, (list, list)):
-
-    # We will treat albums with more than 60 tracks as outliers which can be removed.
-    outlier_df = album_df[album_df['total_tracks'] > 60]
-    # In order to remove from the tracks table all the tracks from these outlier albums, we save the ids
-    outlier_ids = outlier_df['album_id'].tolist()
-    album_df.drop(outlier_df.index, inplace=True)
-
-    # I am not interested in data from albums which are compilations. A few might be pertinent, but most are not.
-    compilations_df = album_df[album_df['type'] == 'compilation']
-    # In order to remove from the tracks table all the tracks from these compilation albums, we add the ids to the
-    # outlier_ids list
-    compilation_ids = compilations_df['album_id'].tolist()
-    for id in compilation_ids:
-        outlier_ids.append(id)
-    album_df.drop(compilations_df.index, inplace=True)
-
-
-    # For use in imputing instrumentalness values in the track_feature table, I'll need the album ids
-    # from the albums sorted by whether the artist is primarily instrumental or vocal
-    instrumental_album_ids = []
-    instrumental_ids = artist_ids[0]
-    for album_list in [album_df.loc[album_df['artist_id'] == artist_id, 'album_id'].tolist() for artist_id in
-                       instrumental_ids]:
-        for id in album_list:
-            instrumental_album_ids.append(id)
-    vocal_album_ids = []
-    vocal_ids = artist_ids[1]
-    for album_list in [album_df.loc[album_df['artist_id'] == artist_id, 'album_id'].tolist() for artist_id in
-                       vocal_ids]:
-        for id in album_list:
-            vocal_album_ids.append(id)
-
-    # To save as a feather, we need to reset the pandas index
-    album_df.reset_index(inplace=True)
-
-    # When rows are dropped, a new column called 'index' (not the actual pandas index) is created.
-    # It needs to be removed
-    try:
-        album_df.drop('index', axis=1, inplace=True)
-    except:
-        pass
-
-    return album_df, outlier_ids, (instrumental_album_ids, vocal_album_ids)
+# Incremental transform
+
+def splice_partitions(key: str, raw_keys: pd.Index, in_stale: np.ndarray, previous_df: pd.DataFrame,
+                      cleaned_stale_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Replaces the rows of the stale partitions in the previous cleaned table with their newly cleaned rows
+
+    :param key: key column of the table
+    :param raw_keys: unique keys of the raw table, in order
+    :param in_stale: boolean mask of the raw rows in a partition which was cleaned again
+    :param previous_df: cleaned table of the last transform
+    :param cleaned_stale_df: newly cleaned rows of the stale partitions
+    :return: cleaned table, its rows in the order of the raw table as a full transform would leave them
+    """
+
+    # The other partitions' raw rows haven't changed, so each previous row is still in its key's partition;
+    # rows whose key is gone from the raw table are left out
+    previous_positions = raw_keys.get_indexer(previous_df[key])
+    kept = (previous_positions >= 0) & ~in_stale[previous_positions]
+    positions = np.concatenate([previous_positions[kept], raw_keys.get_indexer(cleaned_stale_df[key])])
+
+    cleaned_df = pd.concat([previous_df[kept], cleaned_stale_df], ignore_index=True)
+    return cleaned_df.iloc[np.argsort(positions, kind='stable')].reset_index(drop=True)
+
+
+def transform_incrementally(rule_plan: RulePlan, seed: int = None, incremental: bool = True,
+                            state: TransformState = None):
+    """
+    Cleans every table, building on the last transform: a table whose raw feather, rules and parent's drop sets and
+    classes are all unchanged keeps its cleaned feather, and in a table which did change only the partitions
+    (e.g. artists) whose raw rows or parent rows changed are cleaned again.
+    Values imputed at random in the partitions which are kept stay as they were drawn.
+
+    :param rule_plan: compiled cleaning rules
+    :param seed: seed of the random imputations
+    :param incremental: False cleans every table in full, as if there were no last transform
+    :param state: TransformState of the last transform; the one in the cache directory if None
+    """
+
+    state = TransformState() if state is None else state
+    rng = np.random.default_rng(seed)
+    parents = {rules.parent for rules in rule_plan.tables}
+    # result frames of this run by table, and the partitions whose drop sets or classes changed (None for all)
+    frames = {}
+    changed = {}
+    manifest = {}
+
+    for rules in rule_plan.tables:
+        raw_path = f'raw_data/{rules.name}.feather'
+        cleaned_path = f'cleaned_data/cleaned_{rules.name}.feather'
+        entry = state.tables.get(rules.name) if incremental else None
+        input_digest = file_digest(raw_path)
+        table_rules_digest = rules_digest([rules.digest, seed])
+        parent_changed = changed[rules.parent] if rules.parent is not None else set()
+
+        # The last cleaned feather can only be built on if it's the one recorded, cleaned under the same rules
+        usable = (entry is not None and entry['rules'] == table_rules_digest
+                  and entry['output'] == file_digest(cleaned_path)
+                  and (rules.name not in parents or os.path.isfile(state.result_path(rules.name))))
+
+        if usable and entry['input'] == input_digest and parent_changed is not None and len(parent_changed) == 0:
+            print(f'\t{rules.name}: unchanged, cleaned feather reused')
+            manifest[rules.name] = entry
+            changed[rules.name] = set()
+            continue
+
+        # The parent's drop sets and classes, from this run or else as stored by the last one
+        parent_frame = None
+        if rules.parent is not None:
+            if rules.parent not in frames:
+                frames[rules.parent] = state.read_result_frame(rules.parent)
+            parent_frame = frames[rules.parent]
+        parent_result = result_from_frame(parent_frame, rules.parent_key) if parent_frame is not None else None
+
+        raw_df = read_feather_df(raw_path)
+        partitions = row_partitions(rules, raw_df, parent_frame)
+        digests = partition_digests(raw_df, partitions)
+
+        raw_keys = pd.Index(raw_df[rules.key])
+        stale = None
+        if usable and parent_changed is not None and raw_keys.is_unique:
+            stale = {partition for partition, digest in digests.items() if entry['partitions'].get(partition) != digest}
+            stale |= set(parent_changed)
+            # partitions whose rows are all gone are stale too, so their previous rows are left out
+            stale |= set(entry['partitions']) - set(digests)
+
+        if stale is None:
+            cleaned_df, result = rules.clean(raw_df, parent_result, rng)
+            if rules.name in parents:
+                frame = make_result_frame(rules, raw_df, partitions, result)
+        else:
+            in_stale = partitions.isin(stale).to_numpy()
+            cleaned_stale_df, result = rules.clean(raw_df[in_stale], parent_result, rng)
+            cleaned_df = splice_partitions(rules.key, raw_keys, in_stale, read_feather_df(cleaned_path),
+                                           cleaned_stale_df)
+            if rules.name in parents:
+                previous_frame = state.read_result_frame(rules.name)
+                frame = pd.concat([previous_frame[~previous_frame[PARTITION_COLUMN].isin(stale)],
+                                   make_result_frame(rules, raw_df[in_stale], partitions[in_stale], result)],
+                                  ignore_index=True)
+            print(f'\t{rules.name}: {len(stale)} of {len(digests)} partitions cleaned again')
+
+        write_feather_df(cleaned_df, cleaned_path, CLEANED_COMPRESSION)
+        manifest[rules.name] = {'input': input_digest, 'rules': table_rules_digest,
+                                'output': file_digest(cleaned_path), 'partitions': digests}
+
+        # Only tables with children hand down drop sets and classes, which the children's partitions are checked
+        # against
+        if rules.name in parents:
+            results = result_digests(frame)
+            if entry is not None and entry['rules'] == table_rules_digest:
+                previous_results = entry.get('results', {})
+                changed[rules.name] = ({partition for partition, digest in results.items()
+                                        if previous_results.get(partition) != digest}
+                                       | (set(previous_results) - set(results)))
+            else:
+                changed[rules.name] = None
+            manifest[rules.name]['results'] = results
+            frames[rules.name] = frame
+            state.write_result_frame(rules.name, frame)
+
+    state.save(manifest, rule_plan.version)
 
 # **********
-# TRACK table cleaning
-
-def clean_track(track_df: pd.DataFrame, deleted_albums: list, sorted_album_ids: (list, list))\
-        -> (pd.DataFrame, list, (list, list)):
-
-    # Tracks from albums which have been removed should also be removed.
-    outlier_tracks = track_df[track_df['album_id'].isin(deleted_albums)]
-    # Just like with the album table, we need to save the ids of the outlier tracks
-    outlier_track_ids = outlier_tracks['track_id'].tolist()
-    track_df.drop(outlier_tracks.index, inplace=True)
-
-    # For use in imputing instrumentalness values in the track_feature table, I'll need the track ids
-    # sorted by whether the artist is primarily instrumental or vocal
-    instrumental_track_ids = []
-    instrumental_album_ids = sorted_album_ids[0]
-    for album_list in [track_df.loc[track_df['album_id'] == album_id, 'track_id'].tolist() for album_id in
-                       instrumental_album_ids]:
-        for id in album_list:
-            instrumental_track_ids.append(id)
-    vocal_track_ids = []
-    vocal_album_ids = sorted_album_ids[1]
-    for album_list in [track_df.loc[track_df['album_id'] == album_id, 'track_id'].tolist() for album_id in
-                       vocal_album_ids]:
-        for id in album_list:
-            vocal_track_ids.append(id)
-
-    # To save as a feather, we reset the pandas index
-    track_df.reset_index(inplace=True)
-
-    # When rows are dropped, a new column called 'index' (not the actual pandas index) is created.
-    # It needs to be removed
-    try:
-        track_df.drop('index', axis=1, inplace=True)
-    except:
-        pass
-
-    return track_df, outlier_track_ids, (instrumental_track_ids, vocal_track_ids)
-
+# Streaming transform
 
-# **********
-# TRACK_FEATURES table cleaning
+def transform_in_chunks(rule_plan: RulePlan, seed: int = None, chunk_rows: int = DEFAULT_CHUNK_ROWS):
+    """
+    Streams every raw table through the rules in chunks of chunk_rows rows, writing each cleaned chunk as it goes,
+    so a catalog too large for memory can be cleaned. The small artist and album tables are usually a single chunk.
 
-def clean_track_features(track_features_df: pd.DataFrame, outlier_track_ids: list, track_ids: (list, list))\
-        -> pd.DataFrame:
+    :param rule_plan: compiled cleaning rules
+    :param seed: seed of the random imputations
+    :param chunk_rows: number of rows read, cleaned and written at a time
+    """
 
-    # Tracks from which have been removed in the track table cleaning should also be removed.
-    drop_indexes = track_features_df[track_features_df['track_id'].isin(outlier_track_ids)].index
-    track_features_df.drop(drop_indexes, inplace=True)
+    def read_chunks(table_name: str):
+        return lambda: (table.to_pandas() for table in
+                        iter_feather_chunks(f'raw_data/{table_name}.feather', chunk_rows))
 
-    # Now we impute a random instrumentalness value for the nulls, based on the sorting done earlier in the pipeline
-    instrumental_track_ids = track_ids[0]
-    vocal_track_ids = track_ids[1]
-    none_indexes = track_features_df.index[track_features_df['instrumentalness'].isna()].tolist()
-    for index in none_indexes:
-        if track_features_df.loc[index, 'track_id'] in instrumental_track_ids:
-            track_features_df.loc[index, 'instrumentalness'] = random.uniform(0.7, 0.9959)
-        elif track_features_df.loc[index, 'track_id'] in vocal_track_ids:
-            track_features_df.loc[index, 'instrumentalness'] = random.uniform(0.0001, 0.3)
+    chunks = {table_name: read_chunks(table_name) for table_name in rule_plan.table_names}
 
-    # To save as a feather, we reset the pandas index
-    track_features_df.reset_index(inplace=True)
+    # Every cleaned feather only replaces the old one once all of its chunks are written
+    with ExitStack() as stack:
+        writers = {table_name: stack.enter_context(FeatherBatchWriter(
+            f'cleaned_data/cleaned_{table_name}.feather', read_feather_schema(f'raw_data/{table_name}.feather'),
+            compression=CLEANED_COMPRESSION)) for table_name in rule_plan.table_names}
 
-    # When rows are dropped, a new column called 'index' (not the actual pandas index) is created.
-    # It needs to be removed
-    try:
-        track_features_df.drop('index', axis=1, inplace=True)
-    except:
-        pass
-
-    return track_features_df
+        for table_name, cleaned_df in rule_plan.run_in_chunks(chunks, seed):
+            for batch in pa.Table.from_pandas(cleaned_df, preserve_index=False).to_batches():
+                writers[table_name].write_batch(batch)
 
 # **********
 # Transform pipeline
 
-def transform():
+def transform(seed: int = None, rules_path: str = DEFAULT_RULES_PATH, chunk_rows: int = None,
+              incremental: bool = True):
 
     # Here's the pipeline!
     t0 = time.time()
 
-    # First, retrieve the four dataframes from the raw_data directory
-    artist_df = pd.read_feather('raw_data/artist.feather')
-    album_df = pd.read_feather('raw_data/album.feather')
-    track_df = pd.read_feather('raw_data/track.feather')
-    track_features_df = pd.read_feather('raw_data/track_feature.feather')
-
-    # Next clean each dataframe
-    cleaned_artist_df, artist_ids = clean_artist(artist_df)
-    cleaned_album_df, deleted_albums, album_ids = clean_album(album_df, artist_ids)
-    cleaned_track_df, deleted_tracks, track_ids = clean_track(track_df, deleted_albums, album_ids)
-    cleaned_track_features_df = clean_track_features(track_features_df, deleted_tracks, track_ids)
+    # First, compile the cleaning rules
+    rule_plan = load_rules(rules_path)
 
-    # Finally, store the cleaned dataframes as feathers in the clean_data directory
-    cleaned_artist_df.to_feather('cleaned_data/cleaned_artist.feather')
-    cleaned_album_df.to_feather('cleaned_data/cleaned_album.feather')
-    cleaned_track_df.to_feather('cleaned_data/cleaned_track.feather')
-    cleaned_track_features_df.to_feather('cleaned_data/cleaned_track_feature.feather')
+    if chunk_rows is not None:
+        # Catalogs too large for memory are streamed through the rules chunk by chunk instead. These cleaned feathers
+        # aren't recorded, so the next incremental transform starts over.
+        TransformState().clear()
+        transform_in_chunks(rule_plan, seed, chunk_rows)
+    else:
+        # Then clean each table from the raw_data directory, every table after the table its rows belong to,
+        # into the clean_data directory. Only what changed since the last transform is cleaned again.
+        transform_incrementally(rule_plan, seed, incremental)
 
     print(f'Transform completed successfully. Total transform time: {round(time.time() - t0, 2)}s')
 
 if __name__ == '__main__':
 
-    transform()
\ No newline at end of file
+    transform()
@@ -0,0 +1,516 @@
+"""
+The purpose of this script is to read the cleaning rules of the transform from a rule file and compile them, once,
+into vectorized pandas operations, which are then run over each table in dependency order.
+
+"""
+
+import hashlib
+import json
+import os
+from functools import cached_property
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import yaml
+
+
+# The rule file ships next to this script, so it is found whichever directory the transform runs in
+DEFAULT_RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'transform_rules.yaml')
+
+# Operators a drop filter may use, each turning (column, value) into a boolean mask of the rows to drop
+FILTER_OPS = {
+    '==': lambda column, value: column == value,
+    '!=': lambda column, value: column != value,
+    '>': lambda column, value: column > value,
+    '>=': lambda column, value: column >= value,
+    '<': lambda column, value: column < value,
+    '<=': lambda column, value: column <= value,
+    'in': lambda column, value: column.isin(value),
+    'not in': lambda column, value: ~column.isin(value),
+    'is null': lambda column, value: column.isna(),
+    'not null': lambda column, value: column.notna()
+}
+
+
+class RuleError(Exception):
+    """
+    Raised when a rule file describes something the transform can't run
+    """
+
+
+class TableResult:
+    """
+    What a cleaned table hands down to the tables below it: the keys of the rows it dropped,
+    and the class columns of the rows it kept
+    """
+
+    def __init__(self, key: str, dropped: pd.Series, classes: pd.DataFrame, kept: np.ndarray = None):
+        """
+        :param key: key column of the table
+        :param dropped: key values of the dropped rows
+        :param classes: DataFrame of the key column and one column per class, one row per kept row
+        :param kept: boolean mask of the kept rows among the rows cleaned, if the result is of one cleaning
+        """
+
+        self.key = key
+        self.dropped = dropped
+        self.classes = classes
+        self.kept = kept
+
+    # Both are indexed once, when a child table first looks them up, so every chunk of it is looked up without
+    # hashing them again (and the results of chunks, which no child looks up, are never indexed at all)
+    @cached_property
+    def dropped_index(self) -> pd.Index:
+        return pd.Index(self.dropped.drop_duplicates())
+
+    @cached_property
+    def class_index(self) -> pd.DataFrame:
+        return self.classes.drop_duplicates(self.key).set_index(self.key)
+
+    def was_dropped(self, keys: pd.Series) -> pd.Series:
+        """
+        :param keys: key values of this table, e.g. a child table's column holding them
+        :return: boolean mask of the keys whose row was dropped
+        """
+
+        return pd.Series(self.dropped_index.get_indexer(keys) >= 0, index=keys.index)
+
+    def classes_of(self, keys: pd.Series) -> pd.DataFrame:
+        """
+        :param keys: key values of this table
+        :return: DataFrame of the class columns of each key's row, nulls for keys without a kept row
+        """
+
+        return self.class_index.reindex(keys.to_numpy())
+
+
+def pack_keys(keys: pd.Series) -> np.ndarray:
+    """
+    :param keys: key values of a table
+    :return: numpy array of the keys, as fixed-width UTF-8 bytes unless they are numbers, which holds each key in
+             its own bytes rather than in a Python object
+    """
+
+    if pd.api.types.is_numeric_dtype(keys):
+        return keys.to_numpy()
+
+    # Keys all of one length (as Spotify IDs are) are viewed straight out of their Arrow buffer
+    binary_keys = pa.array(keys.fillna(''), type=pa.large_string())
+    if isinstance(binary_keys, pa.ChunkedArray):
+        binary_keys = binary_keys.combine_chunks()
+    binary_keys = binary_keys.cast(pa.large_binary())
+    lengths = pc.min_max(pc.binary_length(binary_keys)).as_py()
+    if len(binary_keys) > 0 and lengths['min'] == lengths['max'] > 0:
+        width = lengths['max']
+        fixed_keys = binary_keys.cast(pa.binary(width))
+        return np.frombuffer(fixed_keys.buffers()[1], dtype=f'S{width}', count=len(fixed_keys),
+                             offset=fixed_keys.offset * width)
+
+    return np.array(keys.fillna('').str.encode('utf-8').to_numpy(), dtype=np.bytes_)
+
+
+class PackedTableResult(TableResult):
+    """
+    What a table cleaned chunk by chunk hands down to the tables below it. Its keys are held in one sorted array
+    of packed keys, and its classes as one integer code per key and class column, so a large table costs a few
+    dozen bytes a row, looked up by binary search, rather than pandas objects and the hash indexes over them.
+
+    The results of its chunks are added one at a time with add(), then packed with pack() before any lookup.
+    """
+
+    def __init__(self, key: str):
+        """
+        :param key: key column of the table
+        """
+
+        self.key = key
+        self.kept = None
+        self.chunks = []
+        self.value_codes = {}
+        self.keys = None
+        self.dropped = None
+        self.class_codes = None
+        self.class_values = None
+
+    def add(self, result: TableResult):
+        """
+        :param result: TableResult of the table's next chunk
+        """
+
+        keys = pd.concat([result.classes[self.key], result.dropped], ignore_index=True)
+        classes = result.classes.drop(columns=self.key).reset_index(drop=True)
+        class_codes = {}
+        for column in classes.columns:
+            # Each class value gets the next code the first time it's met; the rows without a class (or without
+            # a kept row) get -1
+            codes = self.value_codes.setdefault(column, {})
+            for value in classes[column].dropna().unique():
+                codes.setdefault(value, len(codes))
+            class_codes[column] = np.full(len(keys), -1, dtype=np.int32)
+            class_codes[column][:len(classes)] = classes[column].map(codes).fillna(-1).to_numpy(dtype=np.int32)
+
+        self.chunks.append((pack_keys(keys), np.arange(len(keys)) >= len(classes), class_codes))
+
+    def pack(self) -> 'PackedTableResult':
+        """
+        Sorts the keys of every chunk added, once, for the lookups
+
+        :return: this PackedTableResult
+        """
+
+        keys = np.concatenate([chunk[0] for chunk in self.chunks])
+        dropped = np.concatenate([chunk[1] for chunk in self.chunks])
+        class_codes = {column: np.concatenate([chunk[2][column] for chunk in self.chunks])
+                       for column in self.value_codes}
+        self.chunks = []
+
+        # A key held by several rows is dropped if any of its rows was, and has the classes of its first kept row,
+        # as in TableResult: the stable sort puts its kept rows first, in table order
+        order = np.lexsort((dropped, keys))
+        keys = keys[order]
+        firsts = np.ones(len(keys), dtype=bool)
+        firsts[1:] = keys[1:] != keys[:-1]
+        if firsts.all():
+            self.keys = keys
+            self.dropped = dropped[order]
+        else:
+            firsts = np.flatnonzero(firsts)
+            self.keys = keys[firsts]
+            self.dropped = np.logical_or.reduceat(dropped[order], firsts)
+            order = order[firsts]
+        self.class_codes = {column: codes[order] for column, codes in class_codes.items()}
+        # Code -1 picks the null put after the values
+        self.class_values = {column: np.array(list(codes) + [np.nan], dtype=object)
+                             for column, codes in self.value_codes.items()}
+
+        return self
+
+    def positions(self, keys: pd.Series) -> (np.ndarray, np.ndarray):
+        """
+        :param keys: key values of this table
+        :return: (position of each key among the packed keys, boolean mask of the keys found there)
+        """
+
+        packed_keys = pack_keys(keys)
+        if len(self.keys) == 0:
+            return np.zeros(len(packed_keys), dtype=np.intp), np.zeros(len(packed_keys), dtype=bool)
+        # Searching the keys in sorted order walks the packed keys once, rather than jumping all over them
+        order = np.argsort(packed_keys)
+        positions = np.empty(len(packed_keys), dtype=np.intp)
+        positions[order] = np.searchsorted(self.keys, packed_keys[order])
+        positions = positions.clip(max=len(self.keys) - 1)
+
+        return positions, self.keys[positions] == packed_keys
+
+    def was_dropped(self, keys: pd.Series) -> pd.Series:
+        positions, found = self.positions(keys)
+
+        return pd.Series(found & self.dropped[positions], index=keys.index)
+
+    def classes_of(self, keys: pd.Series) -> pd.DataFrame:
+        positions, found = self.positions(keys)
+        classes = {}
+        for column, codes in self.class_codes.items():
+            classes[column] = self.class_values[column][np.where(found, codes[positions], -1)]
+
+        return pd.DataFrame(classes, index=keys.to_numpy())
+
+
+class TableRules:
+    """
+    Compiled rules of one table
+    """
+
+    def __init__(self, name: str, key: str, parent: str = None, parent_key: str = None, filters: list = None,
+                 classifiers: list = None, imputers: list = None, partition: str = None, digest: str = None):
+        """
+        :param name: table name
+        :param key: column identifying a row
+        :param parent: name of the parent table, or None
+        :param parent_key: key column of the parent table, also held by this table
+        :param filters: functions of a DataFrame returning a boolean mask of the rows to drop
+        :param classifiers: (class column, function of (DataFrame, classes) returning the class of every row)
+        :param imputers: functions of (DataFrame, classes, rng) filling missing values in place
+        :param partition: column splitting the rows of a table without a parent into partitions (e.g. artist_id),
+                          which its children's rows fall into through their parent
+        :param digest: hash of this table's rules and those of its parents, which changes whenever any of them do
+        """
+
+        self.name = name
+        self.key = key
+        self.parent = parent
+        self.parent_key = parent_key
+        self.filters = filters or []
+        self.classifiers = classifiers or []
+        self.imputers = imputers or []
+        self.partition = partition
+        self.digest = digest
+
+    def drop_mask(self, df: pd.DataFrame, parent_result: TableResult = None) -> pd.Series:
+        """
+        :return: boolean mask of the rows matching a filter, or whose parent row was dropped
+        """
+
+        drop = pd.Series(False, index=df.index)
+        if parent_result is not None:
+            drop |= parent_result.was_dropped(df[self.parent_key])
+        for matches in self.filters:
+            drop |= matches(df)
+
+        return drop
+
+    def clean(self, df: pd.DataFrame, parent_result: TableResult = None, rng: np.random.Generator = None)\
+            -> (pd.DataFrame, TableResult):
+        """
+        Drops, classifies and imputes the rows of one table (or of one chunk of it)
+
+        :param df: raw rows of the table
+        :param parent_result: TableResult of the parent table, or None
+        :param rng: generator the imputations draw from
+        :return: (cleaned DataFrame with a fresh index, TableResult to hand down)
+        """
+
+        drop = self.drop_mask(df, parent_result)
+        dropped = df.loc[drop, self.key]
+        # To save as a feather, we need a fresh pandas index; the class columns below line up with it
+        df = df.loc[~drop].reset_index(drop=True)
+
+        # The parent's classes are carried down onto this table's rows through the parent's key
+        key_columns = list(dict.fromkeys([self.key] + ([self.parent_key] if self.parent is not None else [])))
+        classes = df[key_columns].copy()
+        if parent_result is not None:
+            inherited = parent_result.classes_of(df[self.parent_key])
+            for column in inherited.columns:
+                classes[column] = inherited[column].to_numpy()
+
+        for column, classify in self.classifiers:
+            classes[column] = classify(df, classes)
+
+        for impute in self.imputers:
+            impute(df, classes, rng)
+
+        class_columns = [column for column in classes.columns if column not in key_columns]
+        return df, TableResult(self.key, dropped, classes[[self.key] + class_columns], kept=~drop.to_numpy())
+
+
+class RulePlan:
+    """
+    Compiled rules of every table, in the order the tables have to be cleaned
+    """
+
+    def __init__(self, version, tables: list):
+        """
+        :param version: version of the rule file
+        :param tables: TableRules of every table, parents before their children
+        """
+
+        self.version = version
+        self.tables = tables
+
+    @property
+    def table_names(self) -> list:
+        return [rules.name for rules in self.tables]
+
+    def run(self, dfs: dict, seed: int = None) -> dict:
+        """
+        Cleans every table, each after its parent
+
+        :param dfs: dictionary of table name to raw DataFrame
+        :param seed: seed of the random imputations; the same seed always draws the same values
+        :return: dictionary of table name to cleaned DataFrame
+        """
+
+        rng = np.random.default_rng(seed)
+        results = {}
+        cleaned_dfs = {}
+        for rules in self.tables:
+            cleaned_dfs[rules.name], results[rules.name] = rules.clean(dfs[rules.name], results.get(rules.parent),
+                                                                      rng)
+
+        return cleaned_dfs
+
+    def run_in_chunks(self, chunks: dict, seed: int = None):
+        """
+        Cleans every table chunk by chunk, each after its parent. Only the dropped keys and the classes of the tables
+        which have children are kept between chunks, packed (see PackedTableResult), so memory is bounded by the
+        chunk size plus a few dozen bytes per row of those tables.
+        With the same seed, the values drawn are the same as run()'s, whatever the chunk size.
+
+        :param chunks: dictionary of table name to a function returning an iterable of raw DataFrame chunks
+        :param seed: seed of the random imputations
+        :return: generator of (table name, cleaned DataFrame chunk), in table order
+        """
+
+        rng = np.random.default_rng(seed)
+        parents = {rules.parent for rules in self.tables}
+        results = {}
+        for rules in self.tables:
+            packed_result = PackedTableResult(rules.key) if rules.name in parents else None
+            for df in chunks[rules.name]():
+                cleaned_df, result = rules.clean(df, results.get(rules.parent), rng)
+                if packed_result is not None:
+                    packed_result.add(result)
+                yield rules.name, cleaned_df
+            if packed_result is not None and len(packed_result.chunks) > 0:
+                results[rules.name] = packed_result.pack()
+
+
+def column_values(df: pd.DataFrame, classes: pd.DataFrame, column: str) -> pd.Series:
+    """
+    :return: the named class column if there is one, otherwise the named column of the table
+    """
+
+    return classes[column] if column in classes.columns else df[column]
+
+
+def compile_filter(table_name: str, rule: dict):
+    """
+    :param rule: drop rule, e.g. {'column': 'total_tracks', 'op': '>', 'value': 60}
+    :return: function of a DataFrame returning a boolean mask of the rows to drop
+    """
+
+    if rule.get('op') not in FILTER_OPS or 'column' not in rule:
+        raise RuleError(f'Drop rule {rule} of table {table_name} needs a column and one of the ops {list(FILTER_OPS)}.')
+    column, test, value = rule['column'], FILTER_OPS[rule['op']], rule.get('value')
+
+    return lambda df: test(df[column], value).fillna(False).astype(bool)
+
+
+def compile_classifier(table_name: str, rule: dict) -> tuple:
+    """
+    :param rule: classify rule, e.g. {'column': 'artist_kind', 'lookup': 'artist_name', 'values': {...}}
+    :return: (class column, function of (DataFrame, classes) returning every row's class)
+    """
+
+    if 'column' not in rule or 'lookup' not in rule or not isinstance(rule.get('values'), dict):
+        raise RuleError(f'Classify rule {rule} of table {table_name} needs a column, a lookup column and values.')
+    lookup, values = rule['lookup'], rule['values']
+
+    return rule['column'], lambda df, classes: column_values(df, classes, lookup).map(values)
+
+
+def compile_imputer(table_name: str, rule: dict):
+    """
+    :param rule: impute rule, either {'column', 'lookup', 'values'} or {'column', 'by', 'uniform'}
+    :return: function of (DataFrame, classes, rng) filling the column's missing values in place
+    """
+
+    column = rule.get('column')
+    if column is None:
+        raise RuleError(f'Impute rule {rule} of table {table_name} needs a column.')
+
+    if 'lookup' in rule and isinstance(rule.get('values'), dict):
+        lookup, values = rule['lookup'], rule['values']
+
+        def impute(df: pd.DataFrame, classes: pd.DataFrame, rng: np.random.Generator):
+            # only the missing values are filled, each from the value of its row's lookup column
+            df[column] = df[column].fillna(column_values(df, classes, lookup).map(values))
+
+        return impute
+
+    if 'by' in rule and isinstance(rule.get('uniform'), dict):
+        by, ranges = rule['by'], rule['uniform']
+        for bounds in ranges.values():
+            if not (isinstance(bounds, list) and len(bounds) == 2 and bounds[0] <= bounds[1]):
+                raise RuleError(f'Impute rule {rule} of table {table_name} needs [low, high] ranges.')
+        lows = {value: bounds[0] for value, bounds in ranges.items()}
+        highs = {value: bounds[1] for value, bounds in ranges.items()}
+
+        def impute(df: pd.DataFrame, classes: pd.DataFrame, rng: np.random.Generator):
+            # every missing value is drawn at once, each from the range of its row's class;
+            # rows of a class without a range keep their null
+            by_values = column_values(df, classes, by)
+            low = by_values.map(lows)
+            high = by_values.map(highs)
+            missing = df[column].isna() & low.notna()
+            df.loc[missing, column] = rng.uniform(low[missing], high[missing])
+
+        return impute
+
+    raise RuleError(f'Impute rule {rule} of table {table_name} needs either lookup and values, or by and uniform.')
+
+
+def rules_digest(rules) -> str:
+    """
+    :param rules: rules as read from the rule file
+    :return: hash of the rules, the same for the same rules however the file is laid out
+    """
+
+    return hashlib.sha256(json.dumps(rules, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def order_tables(tables: dict) -> list:
+    """
+    :param tables: dictionary of table name to the table's rules
+    :return: table names, every parent before its children
+    """
+
+    ordered = []
+    visiting = set()
+
+    def visit(name: str):
+        if name in ordered:
+            return
+        if name in visiting:
+            raise RuleError(f'The parents of table {name} loop back to it.')
+        visiting.add(name)
+        parent = tables[name].get('parent')
+        if parent is not None:
+            if parent not in tables:
+                raise RuleError(f'Table {name} has parent {parent}, which has no rules.')
+            visit(parent)
+        ordered.append(name)
+
+    for name in tables:
+        visit(name)
+
+    return ordered
+
+
+def compile_rules(rules: dict) -> RulePlan:
+    """
+    Compiles the rules read from a rule file
+
+    :param rules: dictionary with a version and the rules of each table
+    :return: RulePlan
+    """
+
+    tables = rules.get('tables') or {}
+    compiled = []
+    digests = {}
+    for name in order_tables(tables):
+        table = tables[name]
+        if 'key' not in table:
+            raise RuleError(f'Table {name} needs a key column.')
+        parent = table.get('parent')
+        if parent is not None and 'partition' in table:
+            raise RuleError(f'Table {name} has a parent, so its rows take their partition from it.')
+        digests[name] = rules_digest([rules.get('version'), table, digests.get(parent)])
+        compiled.append(TableRules(
+            name,
+            table['key'],
+            parent=parent,
+            parent_key=tables[parent]['key'] if parent is not None else None,
+            filters=[compile_filter(name, rule) for rule in table.get('drop') or []],
+            classifiers=[compile_classifier(name, rule) for rule in table.get('classify') or []],
+            imputers=[compile_imputer(name, rule) for rule in table.get('impute') or []],
+            partition=table.get('partition'),
+            digest=digests[name]
+        ))
+
+    return RulePlan(rules.get('version'), compiled)
+
+
+def load_rules(path: str = DEFAULT_RULES_PATH) -> RulePlan:
+    """
+    Reads and compiles a rule file
+
+    :param path: path to the YAML rule file
+    :return: RulePlan
+    """
+
+    with open(path, encoding='utf-8') as rules_file:
+        rules = yaml.safe_load(rules_file)
+
+    return compile_rules(rules)
@@ -0,0 +1,189 @@
+"""
+The purpose of this script is to remember what the transform built last time: content hashes of the raw feathers
+and of each partition of their rows, hashes of the rules, and the drop sets and classes each table handed down.
+With these, the transform only cleans again the tables, and the partitions of their rows, whose inputs changed.
+
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from feather_io import read_feather_df, write_feather_df
+from transform_rules import TableResult, TableRules
+
+
+DEFAULT_STATE_DIR = 'cache/transform_state'
+
+# Columns the stored drop sets and classes keep next to each row's key and class columns
+PARTITION_COLUMN = '_partition'
+DROPPED_COLUMN = '_dropped'
+
+# Partition of the rows of a table without a partition column, and of rows whose parent row doesn't exist
+NO_PARTITION = ''
+
+# Number of bytes of a file hashed at a time
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def file_digest(path: str) -> str:
+    """
+    :param path: path to a file
+    :return: hash of the file's contents, or None if there is no such file
+    """
+
+    if not os.path.isfile(path):
+        return None
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as hashed_file:
+        for block in iter(lambda: hashed_file.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def partition_digests(df: pd.DataFrame, partitions: pd.Series) -> dict:
+    """
+    Hashes the rows of each partition, in their order, so a partition's hash changes whenever any of its rows
+    are added, removed, changed or reordered
+
+    :param df: rows to hash
+    :param partitions: partition of every row, lined up with df
+    :return: dictionary of partition to hash
+    """
+
+    row_hashes = pd.util.hash_pandas_object(df, index=False, categorize=False).to_numpy()
+    codes, names = pd.factorize(partitions)
+
+    # a stable sort keeps each partition's rows in table order
+    order = np.argsort(codes, kind='stable')
+    row_hashes = row_hashes[order]
+    counts = np.bincount(codes, minlength=len(names))
+    ends = np.cumsum(counts)
+    starts = ends - counts
+
+    return {name: hashlib.blake2b(row_hashes[start:end].tobytes(), digest_size=16).hexdigest()
+            for name, start, end in zip(names, starts, ends)}
+
+
+def row_partitions(rules: TableRules, df: pd.DataFrame, parent_frame: pd.DataFrame = None) -> pd.Series:
+    """
+    :param rules: TableRules of the table
+    :param df: raw rows of the table
+    :param parent_frame: result frame of the parent table (see make_result_frame), if the table has a parent
+    :return: partition of every row, lined up with df
+    """
+
+    if rules.parent is None:
+        if rules.partition is None:
+            return pd.Series(NO_PARTITION, index=df.index, dtype=object)
+        return df[rules.partition].fillna(NO_PARTITION).astype(str)
+
+    partition_by_key = parent_frame.drop_duplicates(rules.parent_key).set_index(rules.parent_key)[PARTITION_COLUMN]
+    return df[rules.parent_key].map(partition_by_key).fillna(NO_PARTITION).astype(str)
+
+
+def make_result_frame(rules: TableRules, df: pd.DataFrame, partitions: pd.Series, result: TableResult)\
+        -> pd.DataFrame:
+    """
+    Lays out what a cleaned table hands down as one row per raw row, so it can be stored, hashed per partition,
+    and partly replaced
+
+    :param rules: TableRules of the table
+    :param df: raw rows the result was cleaned from
+    :param partitions: partition of every raw row, lined up with df
+    :param result: TableResult of cleaning df
+    :return: DataFrame of the key, partition and dropped flag of every raw row, and the class columns of kept rows
+    """
+
+    frame = pd.DataFrame({rules.key: df[rules.key].to_numpy(), PARTITION_COLUMN: partitions.to_numpy(),
+                          DROPPED_COLUMN: ~result.kept})
+    # the classes are those of the kept rows, in table order
+    for column in result.classes.columns.drop(rules.key):
+        frame[column] = None
+        frame.loc[result.kept, column] = result.classes[column].to_numpy()
+
+    return frame
+
+
+def result_from_frame(frame: pd.DataFrame, key: str) -> TableResult:
+    """
+    :param frame: DataFrame built by make_result_frame
+    :param key: key column of the table
+    :return: the TableResult the frame was laid out from
+    """
+
+    class_columns = [column for column in frame.columns if column not in (key, PARTITION_COLUMN, DROPPED_COLUMN)]
+    dropped = frame[DROPPED_COLUMN].to_numpy()
+
+    return TableResult(key, frame.loc[dropped, key], frame.loc[~dropped, [key] + class_columns])
+
+
+def result_digests(frame: pd.DataFrame) -> dict:
+    """
+    :param frame: DataFrame built by make_result_frame
+    :return: dictionary of partition to hash of the drop set and classes the partition hands down
+    """
+
+    # hashed as strings, so a frame hashes the same before and after a round trip through a feather,
+    # whichever dtype and kind of null its columns come back with
+    values = frame.drop(columns=PARTITION_COLUMN).astype('string').fillna('')
+    return partition_digests(values, frame[PARTITION_COLUMN])
+
+
+class TransformState:
+    """
+    Manifest of the last transform, with the drop sets and classes of every table which has children
+    """
+
+    def __init__(self, directory: str = DEFAULT_STATE_DIR):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, 'manifest.json')
+        self.tables = {}
+
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path) as manifest_file:
+                self.tables = json.load(manifest_file).get('tables', {})
+
+    def result_path(self, table_name: str) -> str:
+        return os.path.join(self.directory, f'{table_name}_result.feather')
+
+    def read_result_frame(self, table_name: str) -> pd.DataFrame:
+        """
+        :return: the stored drop sets and classes of the table, or None if there are none
+        """
+
+        path = self.result_path(table_name)
+        return read_feather_df(path) if os.path.isfile(path) else None
+
+    def write_result_frame(self, table_name: str, frame: pd.DataFrame):
+        os.makedirs(self.directory, exist_ok=True)
+        write_feather_df(frame, self.result_path(table_name))
+
+    def save(self, tables: dict, version):
+        """
+        Replaces the manifest
+
+        :param tables: dictionary of table name to its manifest entry
+        :param version: version of the rule file the tables were cleaned with
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        # written to a temporary file first, so a crash never leaves half a manifest behind
+        temp_path = self.manifest_path + '.partial'
+        with open(temp_path, 'w') as manifest_file:
+            json.dump({'version': version, 'tables': tables}, manifest_file, indent=1)
+        os.replace(temp_path, self.manifest_path)
+        self.tables = tables
+
+    def clear(self):
+        """
+        Forgets the last transform, e.g. after cleaned feathers were written without being recorded
+        """
+
+        if os.path.isdir(self.directory):
+            shutil.rmtree(self.directory)
+        self.tables = {}
@@ -0,0 +1,254 @@
+"""
+The purpose of this script is to validate the JSON records returned by the Spotify API against a declarative
+schema per table, one column at a time over a whole batch of records.
+
+"""
+
+import threading
+from collections import Counter
+from datetime import datetime
+from itertools import islice
+import pyarrow as pa
+
+
+# Path element meaning "the first item if this is a list, the value itself otherwise"
+# (e.g. an artist's genres, or an album's images)
+FIRST = object()
+
+# Stands in for a value whose path doesn't exist in the record
+MISSING = object()
+
+# Number of records validated together when validating a stream of records
+DEFAULT_VALIDATION_BATCH = 50
+
+
+def parse_release_date(release_str: str) -> datetime:
+    """
+    Album release dates vary in precision: year only, year and month, or year, month and day
+
+    :param release_str: release date string as sent by the API
+    :return: datetime, or None if the string has none of the three formats
+    """
+
+    formats = {4: '%Y', 7: '%Y-%m', 10: '%Y-%m-%d'}
+    try:
+        return datetime.strptime(release_str, formats[len(release_str)])
+    except (KeyError, ValueError):
+        return None
+
+
+def coerce_int(value) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def check_string(values: list, coerce: bool) -> list:
+    return [v if type(v) is str and len(v) > 0 else None for v in values]
+
+
+def check_int(values: list, coerce: bool) -> list:
+    if coerce:
+        return [coerce_int(v) if type(v) is not bool else None for v in values]
+    return [v if type(v) is int else None for v in values]
+
+
+def check_float(values: list, coerce: bool) -> list:
+    if coerce:
+        return [float(v) if type(v) in (int, float) else None for v in values]
+    return [v if type(v) is float else None for v in values]
+
+
+def check_bool(values: list, coerce: bool) -> list:
+    return [v if type(v) is bool else None for v in values]
+
+
+def check_timestamp(values: list, coerce: bool) -> list:
+    return [parse_release_date(v) if type(v) is str else None for v in values]
+
+
+# Each check turns a whole column of raw values into valid values, with None wherever a value is invalid.
+# With coerce=True, values of the wrong type are converted when that can be done safely, instead of rejected.
+COLUMN_CHECKS = {
+    'string': check_string,
+    'int': check_int,
+    'float': check_float,
+    'bool': check_bool,
+    'timestamp': check_timestamp
+}
+
+ARROW_TYPES = {
+    'string': pa.string(),
+    'int': pa.int64(),
+    'float': pa.float64(),
+    'bool': pa.bool_(),
+    'timestamp': pa.timestamp('ns')
+}
+
+
+class Field:
+    """
+    One column of a table: where its value sits in the API record, what type it must have,
+    and whether a record without a valid value is kept (with a null) or rejected
+    """
+
+    def __init__(self, name: str, kind: str, path: tuple = None, nullable: bool = True, coerce: bool = False,
+                 constant=None, context: str = None):
+        """
+        :param name: column name in the stored table
+        :param kind: one of the COLUMN_CHECKS, e.g. 'string'
+        :param path: keys (and FIRST) leading to the value in the API record; defaults to (name,)
+        :param nullable: if False, records without a valid value are rejected altogether
+        :param coerce: convert values of the wrong type instead of rejecting them
+        :param constant: value every row gets, regardless of the record
+        :param context: name of a value passed in with the batch (e.g. the album the tracks were listed under)
+        """
+
+        self.name = name
+        self.kind = kind
+        self.path = (name,) if path is None else path
+        self.nullable = nullable
+        self.coerce = coerce
+        self.constant = constant
+        self.context = context
+
+
+def compile_getter(path: tuple):
+    """
+    Builds a function following a path of keys through a nested record
+
+    :param path: keys (and FIRST) leading to the value
+    :return: function taking a record and returning the value, or MISSING
+    """
+
+    def getter(record):
+        value = record
+        for key in path:
+            if key is FIRST:
+                if isinstance(value, list):
+                    if len(value) == 0:
+                        return MISSING
+                    value = value[0]
+            elif isinstance(value, dict) and key in value:
+                value = value[key]
+            else:
+                return MISSING
+        return value
+
+    return getter
+
+
+class TableSchema:
+    """
+    Declarative schema of one raw table, compiled once into a getter and a column check per field
+    """
+
+    def __init__(self, table_name: str, fields: list):
+        self.table_name = table_name
+        self.fields = fields
+        self.compiled = [(field, compile_getter(field.path), COLUMN_CHECKS[field.kind]) for field in fields]
+        self.rejections = Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def names(self) -> list:
+        return [field.name for field in self.fields]
+
+    def arrow_schema(self) -> pa.Schema:
+        """
+        :return: pa.Schema of the table, in field order
+        """
+
+        return pa.schema([(field.name, ARROW_TYPES[field.kind]) for field in self.fields])
+
+    def validate(self, records: list, **context) -> dict:
+        """
+        Validates a batch of API records column by column
+
+        :param records: list of JSON records (dictionaries) from the API
+        :param context: values for the fields declared with context=..., shared by the whole batch
+        :return: dictionary of column name to list of valid values, for the records which weren't rejected
+        """
+
+        columns = {}
+        keep = [True] * len(records)
+        rejections = Counter()
+
+        for field, getter, check in self.compiled:
+            if field.constant is not None:
+                columns[field.name] = [field.constant] * len(records)
+                continue
+            if field.context is not None:
+                columns[field.name] = [context[field.context]] * len(records)
+                continue
+
+            raw = [getter(record) for record in records]
+            valid = check(raw, field.coerce)
+            rejected = [value is None and raw_value is not None for raw_value, value in zip(raw, valid)]
+            rejections[field.name] += sum(rejected)
+            if not field.nullable:
+                keep = [k and value is not None for k, value in zip(keep, valid)]
+            columns[field.name] = valid
+
+        if not all(keep):
+            rejections['(rejected records)'] += keep.count(False)
+            columns = {name: [value for value, k in zip(column, keep) if k] for name, column in columns.items()}
+
+        with self.lock:
+            self.rejections.update(rejections)
+
+        return columns
+
+    def validate_rows(self, records: list, **context) -> list:
+        """
+        Validates a batch of API records and hands them back as row dictionaries
+
+        :param records: list of JSON records (dictionaries) from the API
+        :param context: values for the fields declared with context=...
+        :return: list of row dictionaries, one per record which wasn't rejected
+        """
+
+        columns = self.validate(records, **context)
+        names = list(columns.keys())
+
+        return [dict(zip(names, values)) for values in zip(*columns.values())]
+
+    def validate_one(self, record: dict, **context) -> dict:
+        """
+        Validates a single API record
+
+        :param record: JSON record (dictionary) from the API
+        :param context: values for the fields declared with context=...
+        :return: row dictionary, or None if the record was rejected
+        """
+
+        rows = self.validate_rows([record], **context)
+
+        return rows[0] if len(rows) > 0 else None
+
+    def iter_rows(self, records, batch_size: int = DEFAULT_VALIDATION_BATCH, **context):
+        """
+        Validates a stream of API records batch by batch
+
+        :param records: iterable of JSON records
+        :param batch_size: number of records validated together
+        :param context: values for the fields declared with context=...
+        :return: generator of row dictionaries
+        """
+
+        records = iter(records)
+        while True:
+            batch = list(islice(records, batch_size))
+            if len(batch) == 0:
+                return
+            yield from self.validate_rows(batch, **context)
+
+    def rejection_summary(self) -> str:
+        """
+        :return: one line listing how many values of each field were rejected so far
+        """
+
+        counts = ', '.join(f'{name}: {count}' for name, count in self.rejections.items() if count > 0)
+
+        return f'{self.table_name} rejections - {counts if counts else "none"}'